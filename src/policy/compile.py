@@ -22,6 +22,7 @@ import CongressParser
 import antlr3
 import logging
 import copy
+import weakref
 
 import runtime
 
@@ -71,7 +72,12 @@ class Location (object):
 
 class Term(object):
     """ Represents the union of Variable and ObjectConstant. Should
-        only be instantiated via factory method. """
+        only be instantiated via factory method.  Terms are immutable
+        and interned, so equal terms are identical.  Terms do not keep
+        a source location (the enclosing Atom does); the LOCATION
+        arguments of the constructors are ignored. """
+    __slots__ = ()
+
     def __init__(self):
         assert False, "Cannot instantiate Term directly--use factory method"
 
@@ -94,25 +100,50 @@ class Term(object):
 
 class Variable (Term):
     """ Represents a term without a fixed value. """
+    __slots__ = ['name', 'hash', '__weakref__']
+    location = None
+    # dictionary from name to the Variable with that name
+    interned = weakref.WeakValueDictionary()
+
+    def __new__(cls, name, location=None):
+        var = cls.interned.get(name)
+        if var is not None:
+            return var
+        var = super(Variable, cls).__new__(cls)
+        var.name = name
+        var.hash = hash(('Variable', name))
+        cls.interned[name] = var
+        return var
+
     def __init__(self, name, location=None):
-        self.name = name
-        self.location = location
+        # Initialization happens in __new__ so that interned
+        #   Variables are not reinitialized.
+        pass
+
+    def __reduce__(self):
+        return (Variable, (self.name,))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
 
     def __str__(self):
         return str(self.name)
 
     def __eq__(self, other):
-        return isinstance(other, Variable) and self.name == other.name
+        return self is other or (
+            isinstance(other, Variable) and self.name == other.name)
 
     def __ne__(self, other):
         return not self == other
 
     def __repr__(self):
-        # Use repr to hash rule--can't include location
         return "Variable(name={})".format(repr(self.name))
 
     def __hash__(self):
-        return hash(repr(self))
+        return self.hash
 
     def is_variable(self):
         return True
@@ -125,12 +156,37 @@ class ObjectConstant (Term):
     STRING = 'STRING'
     FLOAT = 'FLOAT'
     INTEGER = 'INTEGER'
+    __slots__ = ['name', 'type', 'hash', '__weakref__']
+    location = None
+    # dictionary from (name, type) to the ObjectConstant with that
+    #   name and type
+    interned = weakref.WeakValueDictionary()
+
+    def __new__(cls, name, type, location=None):
+        obj = cls.interned.get((name, type))
+        if obj is not None:
+            return obj
+        assert(type in [cls.STRING, cls.FLOAT, cls.INTEGER])
+        obj = super(ObjectConstant, cls).__new__(cls)
+        obj.name = name
+        obj.type = type
+        obj.hash = hash((name, type))
+        cls.interned[(name, type)] = obj
+        return obj
 
     def __init__(self, name, type, location=None):
-        assert(type in [self.STRING, self.FLOAT, self.INTEGER])
-        self.name = name
-        self.type = type
-        self.location = location
+        # Initialization happens in __new__ so that interned
+        #   ObjectConstants are not reinitialized.
+        pass
+
+    def __reduce__(self):
+        return (ObjectConstant, (self.name, self.type))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
 
     def __str__(self):
         if self.type == ObjectConstant.STRING:
@@ -139,17 +195,17 @@ class ObjectConstant (Term):
             return str(self.name)
 
     def __repr__(self):
-        # Use repr to hash rule--can't include location
         return "ObjectConstant(name={}, type={})".format(
             repr(self.name), repr(self.type))
 
     def __hash__(self):
-        return hash(repr(self))
+        return self.hash
 
     def __eq__(self, other):
-        return (isinstance(other, ObjectConstant) and
-                self.name == other.name and
-                self.type == other.type)
+        return self is other or (
+            isinstance(other, ObjectConstant) and
+            self.name == other.name and
+            self.type == other.type)
 
     def __ne__(self, other):
         return not self == other
@@ -162,11 +218,16 @@ class ObjectConstant (Term):
 
 class Atom (object):
     """ Represents an atomic statement, e.g. p(a, 17, b) """
+    __slots__ = ['table', 'arguments', 'location']
+
     def __init__(self, table, arguments, location=None):
         self.table = table
         self.arguments = arguments
         self.location = location
 
+    def __copy__(self):
+        return Atom(self.table, self.arguments, location=self.location)
+
     @classmethod
     def create_from_table_tuple(cls, table, tuple):
         """ LIST is a python list representing an atom, e.g.
@@ -197,13 +258,13 @@ class Atom (object):
         return not self == other
 
     def __repr__(self):
-        # Use repr to hash rule--can't include location
         return "Atom(table={}, arguments={})".format(
             repr(self.table),
             "[" + ",".join(repr(arg) for arg in self.arguments) + "]")
 
     def __hash__(self):
-        return hash(repr(self))
+        # Atoms are mutable, so compute from the (cached) term hashes
+        return hash((self.table, tuple(self.arguments)))
 
     def is_atom(self):
         return True
@@ -290,10 +351,16 @@ class Atom (object):
 
 class Literal(Atom):
     """ Represents either a negated atom or an atom. """
+    __slots__ = ['negated']
+
     def __init__(self, table, arguments, negated=False, location=None):
         Atom.__init__(self, table, arguments, location=location)
         self.negated = negated
 
+    def __copy__(self):
+        return Literal(self.table, self.arguments, negated=self.negated,
+                       location=self.location)
+
     def __str__(self):
         if self.negated:
             return "not {}".format(Atom.__str__(self))
@@ -304,17 +371,13 @@ class Literal(Atom):
         return (self.negated == other.negated and Atom.__eq__(self, other))
 
     def __repr__(self):
-        # Use repr to hash rule--can't include location
         return "Literal(table={}, arguments={}, negated={})".format(
             repr(self.table),
             "[" + ",".join(repr(arg) for arg in self.arguments) + "]",
             repr(self.negated))
 
     def __hash__(self):
-        return hash("Literal(table={}, arguments={}, negated={})".format(
-            repr(self.table),
-            "[" + ",".join(repr(arg) for arg in self.arguments) + "]",
-            repr(self.negated)))
+        return hash((self.table, tuple(self.arguments), self.negated))
 
     def is_negated(self):
         return self.negated
@@ -375,9 +438,7 @@ class Rule (object):
 
     def __hash__(self):
         # won't properly treat a positive literal and an atom as the same
-        return hash("Rule(head={}, body={})".format(
-            "[" + ",".join(repr(arg) for arg in self.heads) + "]",
-            "[" + ",".join(repr(arg) for arg in self.body) + "]"))
+        return hash((tuple(self.heads), tuple(self.body)))
 
     def is_atom(self):
         return False
@@ -639,25 +700,21 @@ class CongressSyntax (object):
     @classmethod
     def create_term(cls, antlr):
         # (TYPE (VALUE))
+        # Terms are interned, so they do not record their location
         op = antlr.getText()
-        loc = Location(line=antlr.children[0].token.line,
-                 col=antlr.children[0].token.charPositionInLine)
         if op == 'STRING_OBJ':
             value = antlr.children[0].getText()
             return ObjectConstant(value[1:len(value) - 1], # prune quotes
-                                  ObjectConstant.STRING,
-                                  location=loc)
+                                  ObjectConstant.STRING)
         elif op == 'INTEGER_OBJ':
             return ObjectConstant(int(antlr.children[0].getText()),
-                                  ObjectConstant.INTEGER,
-                                  location=loc)
+                                  ObjectConstant.INTEGER)
         elif op == 'FLOAT_OBJ':
             return ObjectConstant(float(antlr.children[0].getText()),
-                                  ObjectConstant.FLOAT,
-                                  location=loc)
+                                  ObjectConstant.FLOAT)
         elif op == 'VARIABLE':
             name = "".join([child.getText() for child in antlr.children])
-            return Variable(name, location=loc)
+            return Variable(name)
         else:
             raise CongressException("Unknown term operator: {}".format(op))
 
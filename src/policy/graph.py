@@ -0,0 +1,277 @@
+#! /usr/bin/python
+#
+# Copyright (c) 2013 VMware, Inc. All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+# The dependency graph of the tables of a collection of rules.
+# Theories keep one up to date as their rules are inserted and deleted
+#   and use it to answer questions like which tables a query depends on
+#   and in what order tables can be computed.
+
+class DependencyGraph(object):
+    """ The graph with an edge from the head table of each rule to
+        each table in its body, labeled negative if that table occurs
+        in a negated literal.  Edges are counted so that deleting a
+        rule only removes those no other rule needs.  The strongly
+        connected components, strata, and transitive dependencies
+        are computed when first asked for and remembered until an
+        edge is added or removed. """
+    def __init__(self, rules=None):
+        # dictionary from head table to dictionary from body table to
+        #   the number of rules with that head and body table
+        self.edges = {}
+        # dictionary from pair of head and body table to the number of
+        #   rules with that head and the body table under negation
+        self.negations = {}
+        # dictionary from head table to the number of rules for it
+        self.heads = {}
+        # dictionary from body table to the set of head tables
+        #   with an edge to it
+        self.reverse = {}
+        self.clear_cache()
+        if rules is not None:
+            for rule in rules:
+                self.formula_insert(rule)
+
+    def __str__(self):
+        return str(self.edges)
+
+    def __len__(self):
+        return len(self.heads)
+
+    def clear_cache(self):
+        # list of the strongly connected components, or None
+        self.components_cache = None
+        # dictionary from table to its component, or None
+        self.component_of = None
+        # dictionary from table to its stratum, or None
+        self.strata_cache = None
+        # dictionaries from table to the tables it depends on
+        #   and the tables that depend on it
+        self.dependencies_cache = {}
+        self.dependents_cache = {}
+
+    ############### Modification ###############
+
+    def formula_insert(self, rule):
+        """ Adds the edges of RULE, a compile.Rule or compile.Atom. """
+        head = rule.tablename()
+        self.heads[head] = self.heads.get(head, 0) + 1
+        if head not in self.edges:
+            self.edges[head] = {}
+            self.clear_cache()
+        if rule.is_atom():
+            return
+        for literal in rule.body:
+            table = literal.table
+            count = self.edges[head].get(table, 0)
+            self.edges[head][table] = count + 1
+            if count == 0:
+                self.reverse.setdefault(table, set()).add(head)
+                self.clear_cache()
+            if literal.is_negated():
+                key = (head, table)
+                count = self.negations.get(key, 0)
+                self.negations[key] = count + 1
+                if count == 0:
+                    self.clear_cache()
+
+    def formula_delete(self, rule):
+        """ Removes the edges of RULE, previously given to
+            FORMULA_INSERT. """
+        head = rule.tablename()
+        if head not in self.heads:
+            return
+        if not rule.is_atom():
+            for literal in rule.body:
+                table = literal.table
+                self.edges[head][table] -= 1
+                if self.edges[head][table] == 0:
+                    del self.edges[head][table]
+                    self.reverse[table].discard(head)
+                    if len(self.reverse[table]) == 0:
+                        del self.reverse[table]
+                    self.clear_cache()
+                if literal.is_negated():
+                    key = (head, table)
+                    self.negations[key] -= 1
+                    if self.negations[key] == 0:
+                        del self.negations[key]
+                        self.clear_cache()
+        self.heads[head] -= 1
+        if self.heads[head] == 0:
+            del self.heads[head]
+            del self.edges[head]
+            self.clear_cache()
+
+    def empty(self):
+        """ Removes all the edges. """
+        self.edges = {}
+        self.negations = {}
+        self.heads = {}
+        self.reverse = {}
+        self.clear_cache()
+
+    ############### Queries ###############
+
+    def is_head(self, table):
+        """ Returns True iff some rule has TABLE in its head. """
+        return table in self.heads
+
+    def body_tables(self, table):
+        """ Returns the set of tables occurring in the bodies of the
+            rules with TABLE in the head. """
+        return set(self.edges.get(table, ()))
+
+    def head_tables(self, table):
+        """ Returns the set of tables of the heads of the rules with
+            TABLE in the body. """
+        return set(self.reverse.get(table, ()))
+
+    def dependencies(self, table):
+        """ Returns the set of tables that TABLE is computed from,
+            directly or indirectly.  Includes TABLE only if it is
+            recursive. """
+        if table not in self.dependencies_cache:
+            self.dependencies_cache[table] = frozenset(
+                self.reachable(table, self.edges))
+        return self.dependencies_cache[table]
+
+    def dependents(self, table):
+        """ Returns the set of tables computed from TABLE, directly
+            or indirectly, i.e. the queries affected by changes to
+            TABLE.  Includes TABLE only if it is recursive. """
+        if table not in self.dependents_cache:
+            self.dependents_cache[table] = frozenset(
+                self.reachable(table, self.reverse))
+        return self.dependents_cache[table]
+
+    def reachable(self, table, edges):
+        """ Returns the set of tables reachable from TABLE by
+            following one or more of EDGES. """
+        results = set()
+        pending = list(edges.get(table, ()))
+        while len(pending) > 0:
+            current = pending.pop()
+            if current in results:
+                continue
+            results.add(current)
+            pending.extend(edges.get(current, ()))
+        return results
+
+    def components(self):
+        """ Returns the strongly connected components of the head
+            tables, as a list of sets in which each component comes
+            after all the components it depends on. """
+        if self.components_cache is None:
+            self.components_cache = self.compute_components()
+            self.component_of = {}
+            for component in self.components_cache:
+                for table in component:
+                    self.component_of[table] = component
+        return self.components_cache
+
+    def component(self, table):
+        """ Returns the strongly connected component of TABLE. """
+        self.components()
+        return self.component_of.get(table, frozenset([table]))
+
+    def is_recursive(self, table):
+        """ Returns True iff TABLE is computed from itself. """
+        return table in self.dependencies(table)
+
+    def is_stratified(self):
+        """ Returns True iff no table depends on itself through
+            a negated literal. """
+        for (head, table) in self.negations:
+            if table in self.component(head):
+                return False
+        return True
+
+    def strata(self):
+        """ Returns a dictionary from each table to its stratum:
+            0 for tables that are not the head of any rule, and
+            otherwise the least number no smaller than the strata of
+            the tables it is computed from and larger than those of the
+            tables it is computed from under negation (apart from its
+            own component, if the rules are not stratified). """
+        if self.strata_cache is not None:
+            return self.strata_cache
+        strata = {}
+        for component in self.components():
+            stratum = 0
+            for head in component:
+                for table in self.edges[head]:
+                    if table in component:
+                        continue
+                    lower = strata.get(table, 0)
+                    if (head, table) in self.negations:
+                        lower += 1
+                    stratum = max(stratum, lower)
+            for head in component:
+                strata[head] = stratum
+        for table in self.reverse:
+            if table not in strata:
+                strata[table] = 0
+        self.strata_cache = strata
+        return strata
+
+    def stratum(self, table):
+        """ Returns the stratum of TABLE. """
+        return self.strata().get(table, 0)
+
+    def compute_components(self):
+        # Tarjan's algorithm, with an explicit stack so that long
+        #   chains of rules do not exhaust the Python stack.
+        # It finishes a component only after all those reachable from it.
+        index = {}
+        lowlink = {}
+        stack = []
+        on_stack = set()
+        components = []
+        for root in self.edges:
+            if root in index:
+                continue
+            index[root] = lowlink[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            work = [(root, iter(self.edges[root]))]
+            while len(work) > 0:
+                table, children = work[-1]
+                child = next(children, None)
+                if child is not None:
+                    if child not in self.edges:
+                        continue
+                    if child not in index:
+                        index[child] = lowlink[child] = len(index)
+                        stack.append(child)
+                        on_stack.add(child)
+                        work.append((child, iter(self.edges[child])))
+                    elif child in on_stack:
+                        lowlink[table] = min(lowlink[table], index[child])
+                    continue
+                work.pop()
+                if len(work) > 0:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[table])
+                if lowlink[table] == index[table]:
+                    component = set()
+                    member = None
+                    while member != table:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.add(member)
+                    components.append(frozenset(component))
+        return components
@@ -0,0 +1,124 @@
+#! /usr/bin/python
+#
+# Copyright (c) 2013 VMware, Inc. All rights reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+#
+
+# Magic-sets rewriting.
+# Given rules and a query, produces rules that compute only the tuples
+#   of the query's table (and the tables it depends on) that are relevant
+#   to the query.  Each table is specialized to each pattern of bound
+#   ('b') and free ('f') arguments it is called with, and a "magic" table
+#   collects the values of the bound arguments it is called with.
+#   Rule bodies pass bindings from left to right.
+
+import copy
+
+import compile
+import graph
+
+def adorned_table(table, adornment):
+    """ Returns the name of the table computing the tuples of TABLE
+        needed when it is called with bound arguments ADORNMENT. """
+    return "___{}_{}".format(table, adornment)
+
+def magic_table(table, adornment):
+    """ Returns the name of the table holding the bound arguments
+        TABLE is called with when called with ADORNMENT. """
+    return "___magic_{}_{}".format(table, adornment)
+
+def adornment(atom, bound):
+    """ Returns the string with a 'b' for each argument of ATOM that is
+        an object constant or a variable in BOUND and an 'f' for the
+        others. """
+    return "".join(['b' if (arg.is_object() or arg in bound) else 'f'
+                    for arg in atom.arguments])
+
+def bound_arguments(atom, adornment):
+    """ Returns the arguments of ATOM bound according to ADORNMENT. """
+    return [arg for arg, mode in zip(atom.arguments, adornment)
+            if mode == 'b']
+
+def rewrite(formulas, query):
+    """ Returns the pair of the rules computing the instances of the
+        atom QUERY that follow from FORMULAS (rules and atoms), restricted
+        to those relevant to QUERY, and the atom to select from those
+        rules to find those instances (with the table of the rewritten
+        rules in place of that of QUERY).  Tables not defined by
+        FORMULAS are left as they are.  Negated tables defined by
+        FORMULAS are computed in full by their original rules, which
+        keeps the result stratified if FORMULAS are. """
+    rules = []
+    for formula in formulas:
+        if formula.is_atom():
+            formula = compile.Rule(formula, [], formula.location)
+        rules.append(formula)
+    definitions = {}
+    for rule in rules:
+        definitions.setdefault(rule.head.table, []).append(rule)
+    if query.table not in definitions:
+        return ([], query)
+
+    results = []
+    # tables computed in full because they occur negated
+    negated = set()
+    start = adornment(query, ())
+    results.append(compile.Rule(
+        compile.Atom(magic_table(query.table, start),
+                     bound_arguments(query, start)), []))
+    pending = [(query.table, start)]
+    done = set(pending)
+    while len(pending) > 0:
+        table, adorned = pending.pop()
+        for rule in definitions[table]:
+            arguments = bound_arguments(rule.head, adorned)
+            body = [compile.Literal(magic_table(table, adorned), arguments)]
+            bound = set(arg for arg in arguments if arg.is_variable())
+            for literal in rule.body:
+                if literal.table not in definitions:
+                    body.append(literal)
+                elif literal.is_negated():
+                    negated.add(literal.table)
+                    body.append(literal)
+                else:
+                    called = adornment(literal, bound)
+                    results.append(compile.Rule(
+                        compile.Atom(magic_table(literal.table, called),
+                                     bound_arguments(literal, called)),
+                        list(body)))
+                    body.append(compile.Literal(
+                        adorned_table(literal.table, called),
+                        literal.arguments))
+                    if (literal.table, called) not in done:
+                        done.add((literal.table, called))
+                        pending.append((literal.table, called))
+                if not literal.is_negated():
+                    bound |= literal.variables()
+            results.append(compile.Rule(
+                compile.Atom(adorned_table(table, adorned),
+                             rule.head.arguments), body))
+
+    # original rules for the negated tables and the tables they need
+    dependencies = graph.DependencyGraph(rules)
+    full = set(negated)
+    for table in negated:
+        full |= dependencies.dependencies(table)
+    results.extend(rule for rule in rules if rule.head.table in full)
+    # share no literals with FORMULAS or between rules, since delta
+    #   rules tell the literals of a rule apart by identity
+    results = [compile.Rule(copy.copy(rule.head),
+                            [copy.copy(literal) for literal in rule.body])
+               for rule in results]
+    return (results, compile.Atom(adorned_table(query.table, start),
+                                  query.arguments))
@@ -15,11 +15,15 @@
 #    under the License.
 #
 
+import array
 import collections
 import logging
 import copy
+import multiprocessing
 
 import compile
+import graph
+import magic
 import unify
 
 class Tracer(object):
@@ -72,6 +76,23 @@ class EventQueue(object):
     def dequeue(self):
         return self.queue.popleft()
 
+    def dequeue_batch(self):
+        """ Dequeues and returns the list of events at the front of the
+            queue that insert (or that delete) atoms into the same table
+            as the first event.  A rule event is always alone. """
+        first = self.queue.popleft()
+        batch = [first]
+        if not first.formula.is_atom():
+            return batch
+        while len(self.queue) > 0:
+            event = self.queue[0]
+            if (not event.formula.is_atom() or
+                    event.insert != first.insert or
+                    event.tablename() != first.tablename()):
+                break
+            batch.append(self.queue.popleft())
+        return batch
+
     def __len__(self):
         return len(self.queue)
 
@@ -79,6 +100,8 @@ class EventQueue(object):
         return "[" + ",".join([str(x) for x in self.queue]) + "]"
 
 class Event(object):
+    """ A change to FORMULA.  PROOFS is the list of Database.Proofs of
+        a derived atom or, with counting support, just their number. """
     def __init__(self, formula=None, insert=True, proofs=None):
         if proofs is None:
             proofs = []
@@ -95,6 +118,8 @@ class Event(object):
 
     def __str__(self):
         formula = self.formula.make_update(self.insert)
+        if isinstance(self.proofs, int):
+            return "{} with {} proofs".format(str(formula), self.proofs)
         return "{} with {}".format(str(formula),
             iterstr(self.proofs))
 
@@ -120,6 +145,11 @@ def list_to_database(atoms):
 def string_to_database(string):
     return list_to_database(compile.parse(string))
 
+def forked_select(query):
+    """ Selects QUERY in a worker process of TopDownTheory.PARALLEL_SELECT,
+        using the copy of the theory the worker was forked with. """
+    return TopDownTheory.forked_theory.select(query)
+
 ##############################################################################
 ## Logical Building Blocks
 ##############################################################################
@@ -157,6 +187,18 @@ class DeltaRule(object):
         self.head = head  # atom
         self.body = body  # list of literals
         self.original = original # Rule from which SELF was derived
+        # pair of the body list and the function RuleCompiler compiled
+        #   from it
+        self.compiled = None
+        # literals of BODY over the trigger's table that come before
+        #   the trigger in ORIGINAL
+        self.earlier = []
+        if original is not None and not original.is_atom():
+            for literal in original.body:
+                if literal is trigger:
+                    break
+                if literal.table == trigger.table:
+                    self.earlier.append(literal)
 
     def __str__(self):
         return "<trigger: {}, head: {}, body: {}>".format(
@@ -177,6 +219,15 @@ class DeltaRule(object):
             vs |= atom.variables()
         return vs
 
+    def is_self_join(self):
+        """ Returns True iff the trigger's table occurs in the body. """
+        return any(atom.table == self.trigger.table for atom in self.body)
+
+    def is_earlier(self, literal):
+        """ Returns True iff the body LITERAL comes before the trigger
+            in the original rule and is over the same table. """
+        return any(literal is earlier for earlier in self.earlier)
+
     def tables(self):
         """ Return the set of tablenames occurring in this delta rule. """
         tables = set()
@@ -187,6 +238,555 @@ class DeltaRule(object):
         return tables
 
 
+class IndexAdvisor(object):
+    """ Records which argument positions are bound each time a Database
+    looks up the tuples of a table and uses those statistics to decide
+    which column indexes are worth building and which to drop.
+    MAX_ENTRIES bounds the total number of tuples held by all indexes
+    (None means no bound).  MIN_LOOKUPS is the number of lookups with a
+    given binding pattern we see before building an index for it. """
+    def __init__(self, max_entries=None, min_lookups=2):
+        self.max_entries = max_entries
+        self.min_lookups = min_lookups
+        # dictionary from table name to dictionary from tuple of bound
+        #   column numbers to number of lookups with that pattern
+        self.lookups = {}
+        # dictionary from table name to number of lookups
+        #   that visited every tuple in that table
+        self.scans = {}
+
+    def record_lookup(self, table, columns):
+        """ Record a lookup into TABLE with the column numbers
+            COLUMNS bound. """
+        if table not in self.lookups:
+            self.lookups[table] = {}
+        patterns = self.lookups[table]
+        if columns in patterns:
+            patterns[columns] += 1
+        else:
+            patterns[columns] = 1
+
+    def record_scan(self, table):
+        """ Record that a lookup into TABLE visited every tuple. """
+        if table in self.scans:
+            self.scans[table] += 1
+        else:
+            self.scans[table] = 1
+
+    def lookup_count(self, table, columns):
+        if table not in self.lookups:
+            return 0
+        return self.lookups[table].get(columns, 0)
+
+    def choose_drops(self, table, columns, size, indexes):
+        """ Decide whether to build an index on TABLE for COLUMNS that
+            will hold SIZE tuples, given the existing INDEXES, a list of
+            (table, columns, size) triples.  Returns None if the index
+            should not be built; otherwise, returns the list of (table,
+            columns) pairs identifying the indexes to drop first. """
+        if self.lookup_count(table, columns) < self.min_lookups:
+            return None
+        if self.max_entries is None:
+            return []
+        total = sum(entry[2] for entry in indexes)
+        if total + size <= self.max_entries:
+            return []
+        # drop indexes used less than this one, least used first
+        value = self.lookup_count(table, columns)
+        candidates = [entry for entry in indexes
+                      if self.lookup_count(entry[0], entry[1]) < value]
+        candidates.sort(key=lambda entry: self.lookup_count(entry[0], entry[1]))
+        drops = []
+        for entry in candidates:
+            if total + size <= self.max_entries:
+                break
+            drops.append((entry[0], entry[1]))
+            total -= entry[2]
+        if total + size > self.max_entries:
+            return None
+        return drops
+
+    def choose_evictions(self, indexes):
+        """ Given the existing INDEXES, a list of (table, columns, size)
+            triples, return the list of (table, columns) pairs to drop so
+            the indexes fit within the budget, least used first. """
+        if self.max_entries is None:
+            return []
+        total = sum(entry[2] for entry in indexes)
+        ordered = sorted(indexes,
+            key=lambda entry: self.lookup_count(entry[0], entry[1]))
+        drops = []
+        for entry in ordered:
+            if total <= self.max_entries:
+                break
+            drops.append((entry[0], entry[1]))
+            total -= entry[2]
+        return drops
+
+    def statistics(self, table):
+        """ Returns a dictionary describing the lookups into TABLE. """
+        return {'scans': self.scans.get(table, 0),
+                'lookups': dict(self.lookups.get(table, {}))}
+
+
+class SymbolTable(object):
+    """ Dictionary between the values of ObjectConstants (e.g. the UUIDs
+    of VMs, networks and ports) and small integer codes, shared by
+    every Database of a Runtime.  Storing codes, or the one canonical
+    copy of each value, means a value appearing in many tables and
+    derived tuples is stored once, and that equal values from
+    different tables have equal codes.  Values of different
+    ObjectConstant types have different codes even if they are equal,
+    e.g. 1 and 1.0, so canonicalizing a value never changes its type.
+    Codes are never reused. """
+    def __init__(self):
+        # VALUES[code] is the value with CODE and CODES is the inverse,
+        #   keyed by KEY of the value
+        self.values = []
+        self.codes = {}
+
+    def __len__(self):
+        return len(self.values)
+
+    def __contains__(self, value):
+        return self.key(value) in self.codes
+
+    @classmethod
+    def key(cls, value):
+        """ Returns the pair of VALUE and the kind of ObjectConstant
+            it is the value of. """
+        if isinstance(value, basestring):
+            return (value, basestring)
+        if isinstance(value, long):
+            return (value, int)
+        return (value, type(value))
+
+    def encode(self, value):
+        """ Returns the code for VALUE, adding one if necessary. """
+        key = self.key(value)
+        code = self.codes.get(key)
+        if code is None:
+            code = len(self.values)
+            self.values.append(value)
+            self.codes[key] = code
+        return code
+
+    def lookup(self, value):
+        """ Returns the code for VALUE or None if it has none. """
+        return self.codes.get(self.key(value))
+
+    def decode(self, code):
+        """ Returns the value with CODE. """
+        return self.values[code]
+
+    def encode_tuple(self, values):
+        """ Returns the tuple of codes for VALUES or None if some
+            value in VALUES has no code. """
+        codes = []
+        for value in values:
+            code = self.codes.get(self.key(value))
+            if code is None:
+                return None
+            codes.append(code)
+        return tuple(codes)
+
+    def intern_tuple(self, values):
+        """ Returns a tuple equal to VALUES built from the canonical
+            copies of its values, adding codes as necessary. """
+        return tuple([self.values[self.encode(value)] for value in values])
+
+
+class SelectCache(object):
+    """ Least-recently-used cache of query results, keyed so that
+    queries differing only in the names of their variables share an
+    entry.  Each entry records
+    the tables its results were computed from, so that a change to one
+    of those tables removes just the entries depending on it.
+    MAX_ENTRIES bounds the number of entries (None means no bound
+    and 0 disables the cache). """
+    def __init__(self, max_entries=0):
+        self.max_entries = max_entries
+        # OrderedDict from key to (results, tables) pair, least
+        #   recently used first
+        self.entries = collections.OrderedDict()
+        # dictionary from table name to set of keys of the entries
+        #   computed from that table
+        self.dependents = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def enabled(self):
+        return self.max_entries is None or self.max_entries > 0
+
+    def get(self, key):
+        """ Returns the results cached for KEY or None. """
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries[key] = entry
+        return entry[0]
+
+    def put(self, key, results, tables):
+        """ Caches RESULTS for KEY, computed from the set TABLES. """
+        if not self.enabled():
+            return
+        if key in self.entries:
+            self.remove(key)
+        self.entries[key] = (results, tables)
+        for table in tables:
+            if table not in self.dependents:
+                self.dependents[table] = set()
+            self.dependents[table].add(key)
+        while (self.max_entries is not None and
+               len(self.entries) > self.max_entries):
+            self.remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def remove(self, key):
+        results, tables = self.entries.pop(key)
+        for table in tables:
+            keys = self.dependents[table]
+            keys.discard(key)
+            if len(keys) == 0:
+                del self.dependents[table]
+
+    def invalidate(self, tables):
+        """ Removes the entries computed from any of TABLES. """
+        for table in tables:
+            for key in list(self.dependents.get(table, [])):
+                self.remove(key)
+                self.invalidations += 1
+
+    def clear(self):
+        self.entries = collections.OrderedDict()
+        self.dependents = {}
+
+    @classmethod
+    def query_atoms(cls, query):
+        if isinstance(query, compile.Rule):
+            return query.heads + query.body
+        return [query]
+
+    @classmethod
+    def query_key(cls, query):
+        """ Returns a key that is the same for QUERY and its variants,
+            i.e. the queries that are the same up to the names of
+            variables. """
+        key = []
+        variables = {}
+        for atom in cls.query_atoms(query):
+            key.append(atom.table)
+            key.append(atom.is_negated())
+            key.append(len(atom.arguments))
+            for arg in atom.arguments:
+                if arg.is_variable():
+                    if arg not in variables:
+                        variables[arg] = len(variables)
+                    key.append((variables[arg],))
+                else:
+                    key.append((arg.name, arg.type))
+        return tuple(key)
+
+    @classmethod
+    def renaming(cls, query, variant):
+        """ Returns the dictionary from the variables of QUERY to those
+            of its variant VARIANT. """
+        renaming = {}
+        for atom, other in zip(cls.query_atoms(query),
+                               cls.query_atoms(variant)):
+            for arg, other_arg in zip(atom.arguments, other.arguments):
+                if arg.is_variable():
+                    renaming[arg] = other_arg
+        return renaming
+
+    def statistics(self):
+        """ Returns a dictionary describing the use of the cache. """
+        return {'entries': len(self.entries), 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions,
+                'invalidations': self.invalidations}
+
+
+class Transaction(object):
+    """ The inserts and deletes buffered by Runtime.transaction until
+        they are committed together.  Only the last update of each
+        formula is kept, since it alone decides whether the formula ends
+        up in its theory; so inserting and then deleting a formula
+        cancel out.  Updates are only buffered once it is entered by a
+        WITH statement.  Nested transactions are part of the outermost
+        one, which commits when it exits without an exception and
+        otherwise discards the updates.  CHANGES holds the changes
+        caused by the commit. """
+    def __init__(self, runtime):
+        self.runtime = runtime
+        # OrderedDict from (theory, formula) to the Event of the last
+        #   update of that formula in that theory, oldest first
+        self.updates = collections.OrderedDict()
+        # number of nested WITH statements using this transaction
+        self.depth = 0
+        self.changes = []
+
+    def __len__(self):
+        return len(self.updates)
+
+    def __enter__(self):
+        if self.depth == 0:
+            assert self.runtime.current_transaction is None, \
+                "Another transaction is already open"
+            self.runtime.current_transaction = self
+        self.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.depth -= 1
+        if self.depth == 0:
+            self.runtime.end_transaction(self, commit=(exc_type is None))
+        return False
+
+    def update(self, theory, formula, is_insert=True):
+        """ Records the insertion/deletion of FORMULA into THEORY. """
+        key = (theory, formula)
+        self.updates.pop(key, None)
+        self.updates[key] = Event(formula=formula, insert=is_insert)
+
+    def routes(self):
+        """ Returns an OrderedDict from each theory to the list of
+            Events updating it, deletions first. """
+        routes = collections.OrderedDict()
+        for (theory, formula), event in self.updates.iteritems():
+            if theory not in routes:
+                routes[theory] = []
+            routes[theory].append(event)
+        for theory, events in routes.iteritems():
+            events.sort(key=lambda event: event.is_insert())
+        return routes
+
+
+class RuleOptimizer(object):
+    """ Orders the literals of rule bodies so that those expected to
+    produce the fewest tuples are evaluated first.  CARDINALITY is a
+    function from a table name to the number of tuples in that table,
+    or None if unknown, in which case UNKNOWN is assumed.  Each bound
+    argument of a literal is assumed to keep SELECTIVITY of its tuples.
+    An ordering is stale once some table it was computed from grew or
+    shrank by more than a factor of DRIFT.  Cardinalities are only
+    rechecked after some theory's tuples or rules changed. """
+    class Statistics(object):
+        """ The statistics an ordering was computed from.  CARDINALITIES
+        is a dictionary from table name to the cardinality used, and
+        MODIFICATIONS is the value of TopDownTheory.modifications when
+        they were last found current. """
+        def __init__(self):
+            self.cardinalities = {}
+            self.modifications = TopDownTheory.modifications
+
+    def __init__(self, cardinality, unknown=100, selectivity=0.1, drift=4):
+        self.cardinality = cardinality
+        self.unknown = unknown
+        self.selectivity = selectivity
+        self.drift = drift
+        self.reorders = 0
+
+    def order(self, literals, bound=None):
+        """ Returns a reordering of LITERALS, given the set of variables
+            BOUND before they are evaluated, together with the
+            statistics it was computed from.  Negated literals come as
+            soon as their variables are bound, since they must be ground
+            when evaluated and only filter bindings.  Otherwise, the
+            cheapest literal comes next, breaking ties by the original
+            order. """
+        if bound is None:
+            bound = set()
+        bound = set(bound)
+        statistics = self.Statistics()
+        remaining = list(literals)
+        result = []
+        while len(remaining) > 0:
+            ready = [lit for lit in remaining
+                     if lit.is_negated() and lit.variables() <= bound]
+            if len(ready) > 0:
+                lit = ready[0]
+            else:
+                positive = [lit for lit in remaining if not lit.is_negated()]
+                if len(positive) == 0:
+                    # unsafe; leave for evaluation to complain about
+                    result.extend(remaining)
+                    break
+                lit = min(positive, key=lambda lit: self.cost(lit, bound,
+                    statistics.cardinalities))
+                bound |= lit.variables()
+            result.append(lit)
+            remaining = [other for other in remaining if other is not lit]
+        self.reorders += 1
+        return result, statistics
+
+    def cost(self, literal, bound, statistics):
+        """ Returns the estimated number of tuples LITERAL produces
+            when the variables BOUND are bound, recording the
+            cardinality used in STATISTICS. """
+        if literal.table not in statistics:
+            statistics[literal.table] = self.cardinality(literal.table)
+        size = statistics[literal.table]
+        if size is None:
+            size = self.unknown
+        nbound = len([arg for arg in literal.arguments
+                      if not arg.is_variable() or arg in bound])
+        if nbound == len(literal.arguments):
+            return min(size, 1)
+        return size * self.selectivity ** nbound
+
+    def stale(self, statistics):
+        """ Returns True if the cardinalities have drifted too far from
+            the STATISTICS an ordering was computed from. """
+        if statistics.modifications == TopDownTheory.modifications:
+            return False
+        for table, old in statistics.cardinalities.iteritems():
+            new = self.cardinality(table)
+            if old is None or new is None:
+                if old is not new:
+                    return True
+                continue
+            old = max(old, 1)
+            new = max(new, 1)
+            if new > old * self.drift or old > new * self.drift:
+                return True
+        statistics.modifications = TopDownTheory.modifications
+        return False
+
+
+class RuleCompiler(object):
+    """ Compiles a rule body into a Python function, generated as source
+    code and exec'ed, which enumerates the values of the rule's
+    variables without unifiers or Terms.  Each variable gets a local
+    slot, and the argument positions to check and to look up are fixed
+    at compile time, as is the order of the body literals.  Returns
+    None for bodies it cannot compile (e.g. a negated literal that is
+    not ground when reached), so callers can fall back to top-down
+    evaluation. """
+    def __init__(self, max_queries=1000):
+        self.compiled = 0
+        self.fallbacks = 0
+        # dictionary from (body, variables) of a query to the function
+        #   compiled for it, emptied when it reaches MAX_QUERIES entries
+        self.queries = {}
+        self.max_queries = max_queries
+
+    def compile_query(self, literals, variables):
+        """ Returns the compiled function for evaluating the query
+            LITERALS for VARIABLES, reusing the one compiled for
+            the same query before. """
+        key = (tuple(literals), tuple(variables))
+        if key not in self.queries:
+            if len(self.queries) >= self.max_queries:
+                self.queries.clear()
+            self.queries[key] = self.compile(None, literals, variables)
+        return self.queries[key]
+
+    def compile_delta(self, delta):
+        """ Returns the compiled function for the DeltaRule DELTA,
+            reusing the one compiled for its current body. """
+        if delta.compiled is None or delta.compiled[0] is not delta.body:
+            delta.compiled = (delta.body, self.compile(delta.trigger,
+                delta.body, list(delta.variables())))
+        return delta.compiled[1]
+
+    def compile(self, trigger, body, variables):
+        """ Returns a function FN(ARGS, LOOKUP, CONTAINS) computing the
+            list of tuples of values for VARIABLES that make the
+            literals BODY true, given that TRIGGER (if not None) has
+            the values ARGS as arguments.  LOOKUP(TABLE, COLUMNS, KEY,
+            ARITY) must return the tuples of values of TABLE whose
+            values in the column numbers COLUMNS may be KEY, and
+            CONTAINS(TABLE, TUPLE) whether TABLE includes TUPLE.  Returns
+            None if BODY cannot be compiled. """
+        # values of the constants used by the function
+        constants = {}
+        # dictionary from Variable to the name of its local slot
+        slots = {}
+        lines = ["def rule(args, lookup, contains):",
+                 "    results = []"]
+        # state of the code generation: [indentation, failure statement]
+        state = [1, "return results"]
+
+        def emit(line):
+            lines.append("    " * state[0] + line)
+
+        def constant(value):
+            name = "k{}".format(len(constants))
+            constants[name] = value
+            return name
+
+        def value_tuple(names):
+            if len(names) == 0:
+                return "()"
+            return "(" + ", ".join(names) + ",)"
+
+        def bind(arg, source):
+            """ Emits code that binds or checks ARG against SOURCE. """
+            if not arg.is_variable():
+                emit("if {} != {}: {}".format(
+                    source, constant(arg.name), state[1]))
+            elif arg in slots:
+                emit("if {} != {}: {}".format(source, slots[arg], state[1]))
+            else:
+                slots[arg] = "v{}".format(len(slots))
+                emit("{} = {}".format(slots[arg], source))
+
+        if trigger is not None:
+            emit("if len(args) != {}: return results".format(
+                len(trigger.arguments)))
+            for i in xrange(0, len(trigger.arguments)):
+                bind(trigger.arguments[i], "args[{}]".format(i))
+        for literal in body:
+            if literal.table in ['true', 'false']:
+                self.fallbacks += 1
+                return None
+            arguments = literal.arguments
+            table = constant(literal.table)
+            columns = [i for i in xrange(0, len(arguments))
+                       if not arguments[i].is_variable() or
+                          arguments[i] in slots]
+            key = []
+            for i in columns:
+                if arguments[i].is_variable():
+                    key.append(slots[arguments[i]])
+                else:
+                    key.append(constant(arguments[i].name))
+            if len(columns) == len(arguments):
+                if literal.is_negated():
+                    test = "if contains({}, {}): {}"
+                else:
+                    test = "if not contains({}, {}): {}"
+                emit(test.format(table, value_tuple(key), state[1]))
+                continue
+            if literal.is_negated():
+                self.fallbacks += 1
+                return None
+            row = "t{}".format(len(lines))
+            emit("for {} in lookup({}, {}, {}, {}):".format(row, table,
+                repr(tuple(columns)), value_tuple(key), len(arguments)))
+            state[0] += 1
+            state[1] = "continue"
+            emit("if len({}) != {}: continue".format(row, len(arguments)))
+            for i in xrange(0, len(arguments)):
+                bind(arguments[i], "{}[{}]".format(row, i))
+        if any(var not in slots for var in variables):
+            self.fallbacks += 1
+            return None
+        emit("results.append({})".format(
+            value_tuple([slots[var] for var in variables])))
+        lines.append("    return results")
+        exec "\n".join(lines) in constants
+        self.compiled += 1
+        return constants['rule']
+
+
 ##############################################################################
 ## Abstract Theories
 ##############################################################################
@@ -253,10 +853,14 @@ class TopDownTheory(Theory):
         BINDING is the initially empty BiUnifier.
         FIND_ALL controls whether just the first or all answers are found.
         ANSWERS is populated by top-down evaluation: it is the list of
-               VARIABLES instances that the search process proved true."""
+               VARIABLES instances that the search process proved true.
+        If EXISTS is True, only whether there is an answer matters,
+               so answers are not stored.
+        NEGATIONS caches the results of proving ground negated literals."""
 
         def __init__(self, variables, binding, theory,
-                    find_all=True, save=None):
+                    find_all=True, save=None, tables=None, exists=False,
+                    negations=None):
             # an iterable of variable objects
             self.variables = variables
             # a bi-unifier
@@ -273,6 +877,16 @@ class TopDownTheory(Theory):
             self.save = save
             # A variable used to store explanations as they are constructed
             self.support = []
+            # TopDownTables shared by all the callers for one query
+            #   or None if evaluation is not tabled
+            self.tables = tables
+            # a boolean
+            self.exists = exists
+            # dictionary from the pair of the id of a theory and a ground
+            #   atom to whether the atom is true in that theory, shared by
+            #   all the callers for one query, or None.  Not used when
+            #   tabled since answers from incomplete tables can change.
+            self.negations = negations
 
         def __str__(self):
             return ("TopDownCaller<variables={}, binding={}, find_all={}, "
@@ -280,12 +894,126 @@ class TopDownTheory(Theory):
                 iterstr(self.variables), str(self.binding), str(self.find_all),
                 iterstr(self.results), repr(self.save), iterstr(self.support)))
 
+    class TopDownTables(object):
+        """ The answer tables for the subgoals of a single tabled query.
+        A subgoal is an atom, and variants of it (atoms that are the same
+        up to the names of variables) share a table.  A table is
+        complete once it holds every answer for its subgoal.  A table
+        whose subgoal is being evaluated holds the answers found so far;
+        subgoals that call it (i.e. recursive ones) see only those
+        answers, and the evaluation is repeated until the answers stop
+        changing.  A table whose answers depended on the incomplete
+        table of a subgoal evaluated earlier is discarded and
+        recomputed as part of that subgoal's evaluation. """
+        def __init__(self):
+            # dictionary from variant key to OrderedDict of answer atoms
+            self.answers = {}
+            # set of the variant keys whose tables are complete
+            self.complete = set()
+            # dictionary from variant key of each incomplete table
+            #   being evaluated to its position in the stack of evaluations
+            self.active = {}
+            # lowest position of an incomplete table used by
+            #   the current evaluation
+            self.lowest = None
+
+        @classmethod
+        def variant_key(cls, atom):
+            """ Returns a key that is the same for ATOM and
+                its variants. """
+            key = [atom.table]
+            variables = {}
+            for arg in atom.arguments:
+                if arg.is_variable():
+                    if arg not in variables:
+                        variables[arg] = len(variables)
+                    key.append((variables[arg],))
+                else:
+                    key.append((arg.name, arg.type))
+            return tuple(key)
+
+    class TopDownTable(object):
+        """ The evaluation of the answer table in TABLES, a
+        TopDownTables, for the subgoal GOAL with variant key KEY.
+        The table is active until FINISH is called. """
+        def __init__(self, key, goal, tables, depth):
+            self.key = key
+            self.goal = goal
+            self.tables = tables
+            self.depth = depth
+            self.position = len(tables.active)
+            tables.active[key] = self.position
+            self.answers = collections.OrderedDict()
+            tables.answers[key] = self.answers
+            # lowest position of an incomplete table used by the caller
+            self.caller_lowest = tables.lowest
+            # lowest position of an incomplete table used by any evaluation
+            self.used = self.position
+
+        def finish(self):
+            """ Marks the table complete, unless it depends on an
+                earlier incomplete table, and returns its answers. """
+            tables = self.tables
+            del tables.active[self.key]
+            if self.used == self.position:
+                tables.complete.add(self.key)
+            else:
+                # recomputed when the earlier subgoal is reevaluated
+                del tables.answers[self.key]
+            caller_lowest = self.caller_lowest
+            if self.used < self.position and (
+                    caller_lowest is None or self.used < caller_lowest):
+                caller_lowest = self.used
+            tables.lowest = caller_lowest
+            return self.answers.keys()
+
+    class TopDownFrame(object):
+        """ The state of one search of TOP_DOWN_ITERATE: the search
+        for the answers of CALLER, starting with the context GOAL.
+        Nested searches, for a negated literal or for the answers of
+        TABLE (a TopDownTable), record the context PENDING of the
+        literal waiting for them.  UNTABLED is the context evaluated
+        without its answer table, e.g. to fill that table. """
+        def __init__(self, caller, goal, pending=None, table=None,
+                     untabled=None):
+            self.caller = caller
+            # the context to prove next
+            self.goal = goal
+            # the stack of choice points
+            self.choices = []
+            self.pending = pending
+            self.table = table
+            self.untabled = untabled
+
+    # context that TOP_DOWN_ITERATE proves to backtrack
+    TOP_DOWN_FAIL = TopDownContext([], 0, None, None, 0)
+
+    # number of changes to the tuples and rules stored by all theories,
+    #   so that statistics computed from them are only rechecked
+    #   after a change
+    modifications = 0
+
+    # theory answering queries in the worker processes of PARALLEL_SELECT
+    forked_theory = None
+
     #########################################
     ## External interface
 
     def __init__(self, name=None, abbr=None):
         super(TopDownTheory, self).__init__(name=name, abbr=abbr)
         self.includes = []
+        # if True, queries to this theory use answer tables for subgoals,
+        #   so they terminate with recursive rules
+        self.tabled = False
+        # if True, queries to this theory use TOP_DOWN_ITERATE instead
+        #   of the recursive TOP_DOWN_EVAL
+        self.iterative = False
+        # if not None, the RuleCompiler used to evaluate queries whose
+        #   tables are all stored in Databases
+        self.compiler = None
+        # if greater than 1, the number of processes answering the
+        #   queries of CONSEQUENCES in parallel
+        self.processes = None
 
     def select(self, query, find_all=True):
         """ Return list of instances of QUERY that are true.
@@ -308,6 +1036,32 @@ class TopDownTheory(Theory):
                                 for x in bindings]) + "]"))
         return [query.plug(x) for x in bindings]
 
+    def exists(self, query):
+        """ Returns True iff some instance of QUERY is true.  Stops
+            at the first proof without recording its bindings. """
+        assert (isinstance(query, compile.Atom) or
+                isinstance(query, compile.Rule)), "Query must be atom/rule"
+        if isinstance(query, compile.Atom):
+            literals = [query]
+        else:
+            literals = query.body
+        return self.top_down_exists(literals)
+
+    def demand_evaluation(self, formulas, query):
+        """ Returns the list of instances of the atom QUERY that follow
+            from FORMULAS and the data of the included theories.  The
+            formulas are rewritten with magic sets, so that only the
+            tuples relevant to QUERY are computed, and are evaluated
+            bottom-up in a scratch MaterializedViewTheory. """
+        assert isinstance(query, compile.Atom), "Query must be atom"
+        rules, answer = magic.rewrite(formulas, query)
+        theory = MaterializedViewTheory(abbr="Demand")
+        theory.includes.extend(self.includes)
+        theory.set_tracer(self.tracer)
+        theory.bulk_modify(rules)
+        return [compile.Atom(query.table, atom.arguments)
+                for atom in theory.select(answer)]
+
     def explain(self, query, tablenames, find_all=True):
         """ Same as select except stores instances of TABLENAMES
         that participated in each proof. If QUERY is an atom,
@@ -357,8 +1111,8 @@ class TopDownTheory(Theory):
             in this theory.  Default tablenames is DEFINED_TABLE_NAMES. """
         if table_names is None:
             table_names = self.defined_table_names()
-        results = set()
         # create queries: need table names and arities
+        queries = []
         for table in table_names:
             if filter is None or filter(table):
                 arity = self.arity(table)
@@ -366,8 +1120,54 @@ class TopDownTheory(Theory):
                 for i in xrange(0, arity):
                     vs.append("x" + str(i))
                 vs = [compile.Variable(var) for var in vs]
-                query = compile.Atom(table, vs)
-                results |= set(self.select(query))
+                queries.append(compile.Atom(table, vs))
+        if (self.processes is not None and self.processes > 1 and
+                len(queries) > 1):
+            answers = self.parallel_select(queries)
+        else:
+            answers = [self.select(query) for query in queries]
+        results = set()
+        for answer in answers:
+            results |= set(answer)
+        return results
+
+    def parallel_select(self, queries):
+        """ Returns the list of the results of selecting each of
+            QUERIES, which are spread over a pool of SELF.PROCESSES
+            worker processes.  The pool is forked for each call, so
+            that the workers see the current contents of the theory
+            and its included theories, and must not change them. """
+        TopDownTheory.forked_theory = self
+        pool = multiprocessing.Pool(min(self.processes, len(queries)))
+        try:
+            return pool.map(forked_select, queries)
+        finally:
+            pool.close()
+            pool.join()
+            TopDownTheory.forked_theory = None
+
+    def table_dependencies(self, tables):
+        """ Returns the set of TABLES together with all the tables they
+            are computed from by the rules of this theory and the
+            theories it includes. """
+        # compare theories by identity: Database defines equality
+        theories = {}
+        pending = [self]
+        while len(pending) > 0:
+            theory = pending.pop()
+            if id(theory) not in theories:
+                theories[id(theory)] = theory
+                pending.extend(theory.includes)
+        theories = theories.values()
+        results = set()
+        pending = list(tables)
+        while len(pending) > 0:
+            table = pending.pop()
+            if table in results:
+                continue
+            results.add(table)
+            for theory in theories:
+                pending.extend(theory.body_tables(table))
         return results
 
     def top_down_evaluation(self, variables, literals,
@@ -380,6 +1180,15 @@ class TopDownTheory(Theory):
         #               "binding={})".format(
         #         iterstr(variables), iterstr(literals),
         #         str(binding)))
+        if self.compiler is not None and binding is None:
+            variables = list(variables)
+            bindings = self.compiled_evaluation(
+                self.compiler.compile_query(literals, variables),
+                variables, ())
+            if bindings is not None:
+                if not find_all:
+                    return bindings[:1]
+                return bindings
         results = self.top_down_abduction(variables, literals,
             binding=binding, find_all=find_all, save=None)
         # logging.debug("EXIT: top_down_evaluation(vars={}, literals={}, "
@@ -398,24 +1207,88 @@ class TopDownTheory(Theory):
             would not make sense.  Returns a list of TopDownResults. """
         if binding is None:
             binding = self.new_bi_unifier()
+        # abduction saves literals instead of proving them, so it
+        #   cannot use answer tables
+        if self.tabled and save is None:
+            tables = self.TopDownTables()
+            negations = None
+        else:
+            tables = None
+            negations = {}
         caller = self.TopDownCaller(variables, binding, self,
-            find_all=find_all, save=save)
+            find_all=find_all, save=save, tables=tables, negations=negations)
         if len(literals) == 0:
             self.top_down_finish(None, caller)
         else:
             # Note: must use same unifier in CALLER and CONTEXT
             context = self.TopDownContext(literals, 0, binding, None, 0)
-            self.top_down_eval(context, caller)
+            if self.iterative:
+                self.top_down_iterate(context, caller)
+            else:
+                self.top_down_eval(context, caller)
         return list(set(caller.results))
 
+    def top_down_exists(self, literals, binding=None):
+        """ Returns True iff some binding makes LITERALS true according
+            to the theory (after applying the unifier BINDING).  Unlike
+            TOP_DOWN_EVALUATION, builds no TopDownResults. """
+        if len(literals) == 0:
+            return True
+        if binding is None:
+            binding = self.new_bi_unifier()
+        if self.tabled:
+            tables = self.TopDownTables()
+            negations = None
+        else:
+            tables = None
+            negations = {}
+        caller = self.TopDownCaller([], binding, self, find_all=False,
+            tables=tables, exists=True, negations=negations)
+        context = self.TopDownContext(literals, 0, binding, None, 0)
+        if self.iterative:
+            return bool(self.top_down_iterate(context, caller))
+        return bool(self.top_down_eval(context, caller))
+
     #########################################
     ## Internal implementation
 
+    def compiled_evaluation(self, function, variables, args):
+        """ Returns the list of dictionary bindings of VARIABLES computed
+            by FUNCTION, compiled by RuleCompiler, for the trigger
+            arguments ARGS, or None if FUNCTION is None or the data is
+            not all stored in Databases. """
+        if function is None:
+            return None
+        databases = []
+        for theory in self.included_theories():
+            if isinstance(theory, MaterializedViewTheory):
+                databases.append(theory.database)
+            elif isinstance(theory, Database):
+                databases.append(theory)
+            else:
+                return None
+
+        def lookup(table, columns, key, arity):
+            rows = []
+            for database in databases:
+                rows.extend(dbtuple.tuple for dbtuple in
+                            database.lookup(table, columns, key, arity))
+            return rows
+
+        def contains(table, raw_tuple):
+            return any(database.contains(table, raw_tuple)
+                       for database in databases)
+
+        create = compile.Term.create_from_python
+        return [dict(zip(variables, [create(value) for value in values]))
+                for values in set(function(args, lookup, contains))]
+
     def top_down_eval(self, context, caller):
         """ Compute all instances of LITERALS (from LITERAL_INDEX and above)
             that are true according to the theory (after applying the
             unifier BINDING to LITERALS).  Returns False or an answer. """
-        # no recursive rules, ever; this style of algorithm will not terminate
+        # no recursive rules unless tabled; this style of algorithm
+        #   will not terminate
         lit = context.literals[context.literal_index]
         # logging.debug("CALL: top_down_eval({}, {})".format(str(context),
         #     str(caller)))
@@ -439,18 +1312,33 @@ class TopDownTheory(Theory):
         if lit.is_negated():
             # logging.debug("{} is negated".format(str(lit)))
             # recurse on the negation of the literal
-            assert lit.plug(context.binding).is_ground(), \
+            atom = lit.plug(context.binding)
+            assert atom.is_ground(), \
                 "Negated literals must be ground when evaluated"
             self.print_call(lit, context.binding, context.depth)
-            new_context = self.TopDownContext([lit.complement()],
-                    0, context.binding, None, context.depth + 1)
-            new_caller = self.TopDownCaller(caller.variables, caller.binding,
-                caller.theory, find_all=False, save=None)
-            # Make sure new_caller has find_all=False, so we stop as soon
-            #    as we can.
-            # Ensure save=None so that abduction does not save anything.
-            #    Saving while performing NAF makes no sense.
-            if self.top_down_includes(new_context, new_caller):
+            key = (id(self), atom)
+            if caller.negations is not None and key in caller.negations:
+                negated = caller.negations[key]
+            else:
+                new_context = self.TopDownContext([lit.complement()],
+                        0, context.binding, None, context.depth + 1)
+                new_caller = self.TopDownCaller(caller.variables,
+                    caller.binding, caller.theory, find_all=False, save=None,
+                    tables=caller.tables, exists=True,
+                    negations=caller.negations)
+                # Make sure new_caller has find_all=False, so we stop as soon
+                #    as we can, and EXISTS=True, so it stores no answer.
+                # Ensure save=None so that abduction does not save anything.
+                #    Saving while performing NAF makes no sense.
+                # Answer tables are shared by the whole query, so tabled
+                #   evaluation must use the theory at which the call was made.
+                if caller.tables is not None:
+                    negated = self.top_down_truth(new_context, new_caller)
+                else:
+                    negated = self.top_down_includes(new_context, new_caller)
+                if caller.negations is not None:
+                    caller.negations[key] = negated
+            if negated:
                 self.print_fail(lit, context.binding, context.depth)
                 return False
             else:
@@ -468,8 +1356,65 @@ class TopDownTheory(Theory):
     def top_down_truth(self, context, caller):
         """ Do top-down evaluation over the root theory at which
             the call was made and all the included theories. """
+        if caller.tables is not None:
+            return caller.theory.top_down_tabled(context, caller)
         return caller.theory.top_down_includes(context, caller)
 
+    def top_down_tabled(self, context, caller):
+        """ Top-down evaluation of the current literal in CONTEXT
+            using the answer table for it in CALLER.TABLES. """
+        lit = context.literals[context.literal_index]
+        goal = lit.plug(context.binding, caller=caller)
+        self.print_call(lit, context.binding, context.depth)
+        answers = self.tabled_answers(goal, caller.tables, context.depth)
+        for answer in answers:
+            undo = unify.bi_unify_atoms(answer, self.new_bi_unifier(),
+                                        lit, context.binding)
+            if undo is None:
+                continue
+            if self.top_down_finish(context, caller):
+                unify.undo_all(undo)
+                if not caller.find_all:
+                    return True
+            else:
+                unify.undo_all(undo)
+        self.print_fail(lit, context.binding, context.depth)
+        return False
+
+    def tabled_answers(self, goal, tables, depth=0):
+        """ Returns the list of answers (instances of the atom GOAL)
+            from the table in TABLES for GOAL, computing
+            the table if necessary. """
+        key = tables.variant_key(goal)
+        if key in tables.complete:
+            return tables.answers[key].keys()
+        if key in tables.active:
+            # recursive call: use the answers found so far
+            if tables.lowest is None or tables.active[key] < tables.lowest:
+                tables.lowest = tables.active[key]
+            return tables.answers[key].keys()
+        table = self.TopDownTable(key, goal, tables, depth)
+        while True:
+            tables.lowest = None
+            binding = self.new_bi_unifier()
+            caller = self.TopDownCaller(goal.variables(), binding, self,
+                find_all=True, save=None, tables=tables)
+            context = self.TopDownContext([goal], 0, binding, None, depth + 1)
+            self.top_down_includes(context, caller)
+            changed = False
+            for result in caller.results:
+                answer = goal.plug(result.binding)
+                if answer not in table.answers:
+                    table.answers[answer] = True
+                    changed = True
+            if tables.lowest is None:
+                # did not use any incomplete table, including this one
+                break
+            table.used = min(table.used, tables.lowest)
+            if not changed:
+                break
+        return table.finish()
+
     def top_down_includes(self, context, caller):
         """ Top-down evaluation of all the theories included in this theory. """
         is_true = self.top_down_th(context, caller)
@@ -486,7 +1431,7 @@ class TopDownTheory(Theory):
         # logging.debug("top_down_th({})".format(str(context)))
         lit = context.literals[context.literal_index]
         self.print_call(lit, context.binding, context.depth)
-        for rule in self.head_index(lit.table):
+        for rule in self.head_index(lit.table, lit, context.binding):
             unifier = self.new_bi_unifier()
             # Prefer to bind vars in rule head
             undo = self.bi_unify(self.head(rule), unifier, lit, context.binding)
@@ -502,7 +1447,7 @@ class TopDownTheory(Theory):
                 else:
                     unify.undo_all(undo)
             else:
-                new_context = self.TopDownContext(rule.body, 0,
+                new_context = self.TopDownContext(self.body(rule), 0,
                     unifier, context, context.depth + 1)
                 if self.top_down_eval(new_context, caller):
                     unify.undo_all(undo)
@@ -523,7 +1468,7 @@ class TopDownTheory(Theory):
             Temporary, transparent modification of CONTEXT."""
         if context is None:
             # Found an answer; now store it
-            if caller is not None:
+            if caller is not None and not caller.exists:
                 # flatten bindings and store before we undo
                 # copy caller.support and store before we undo
                 binding = {}
@@ -550,6 +1495,246 @@ class TopDownTheory(Theory):
                     context.binding, context.depth)
             return finished
 
+    def top_down_iterate(self, context, caller):
+        """ Iterative version of TOP_DOWN_EVAL, with the same results
+            and search order.  The literals left to prove are the chain
+            of CONTEXTs, as in TOP_DOWN_EVAL, and the alternatives left
+            to try are kept on an explicit stack of choice points
+            instead of the Python stack, so long rule bodies and deep
+            proofs do not recurse.  The searches for negated literals
+            and for the answers of tabled subgoals are TopDownFrames
+            on the same explicit stack as the search for CALLER.
+            Returns True if the search is finished. """
+        theories = caller.theory.included_theories()
+        frames = [self.TopDownFrame(caller, context)]
+        while True:
+            frame = frames[-1]
+            finished = self.top_down_search(frame, frames, theories)
+            if finished is None:
+                # FRAME waits for the frame pushed on top of it
+                continue
+            frames.pop()
+            if len(frames) == 0:
+                return finished
+            parent = frames[-1]
+            pending = frame.pending
+            if frame.table is not None:
+                answers = self.tabled_iteration(frame, frames)
+                if answers is not None:
+                    parent.choices.append([self.top_down_answer_choices(
+                        pending, answers), None, False])
+                    parent.goal = self.TOP_DOWN_FAIL
+            else:
+                lit = pending.literals[pending.literal_index]
+                if frame.caller.negations is not None:
+                    frame.caller.negations[
+                        (id(self), lit.plug(pending.binding))] = finished
+                if finished:
+                    # proved the complement of the negated literal
+                    self.print_fail(lit, pending.binding, pending.depth)
+                    parent.goal = self.TOP_DOWN_FAIL
+                else:
+                    parent.goal = self.top_down_next(pending)
+
+    def top_down_search(self, frame, frames, theories):
+        """ Continues the search of FRAME, using the formulas of
+            THEORIES.  Returns True if the search is finished, False
+            if it failed and None if it pushed a new frame onto FRAMES
+            whose result it needs first. """
+        fail = self.TOP_DOWN_FAIL
+        caller = frame.caller
+        # stack of choice points: [alternatives, undo of the current
+        #   alternative, whether to pop CALLER.SUPPORT on backtracking]
+        choices = frame.choices
+        goal = frame.goal
+        while True:
+            if goal is fail:
+                # backtrack to the most recent choice point
+                if len(choices) == 0:
+                    return False
+                choice = choices[-1]
+                if choice[1] is not None:
+                    unify.undo_all(choice[1])
+                    choice[1] = None
+                if choice[2]:
+                    caller.support.pop()
+                    choice[2] = False
+                try:
+                    choice[1], goal = next(choice[0])
+                except StopIteration:
+                    choices.pop()
+                    goal = fail
+                continue
+            if goal is None:
+                # proved all the literals
+                self.top_down_finish(None, caller)
+                if not caller.find_all:
+                    return True
+                goal = fail
+                continue
+            lit = goal.literals[goal.literal_index]
+            binding = goal.binding
+            self.print_call(lit, binding, goal.depth)
+            # abduction
+            if caller.save is not None and caller.save(lit, binding):
+                caller.support.append((lit, binding))
+                self.print_save(lit, binding, goal.depth)
+                choices.append([iter([]), None, True])
+                goal = self.top_down_next(goal)
+            elif lit.is_negated():
+                atom = lit.plug(binding)
+                assert atom.is_ground(), \
+                    "Negated literals must be ground when evaluated"
+                key = (id(self), atom)
+                if caller.negations is not None and key in caller.negations:
+                    if caller.negations[key]:
+                        self.print_fail(lit, binding, goal.depth)
+                        goal = fail
+                    else:
+                        goal = self.top_down_next(goal)
+                    continue
+                new_context = self.TopDownContext([lit.complement()],
+                        0, binding, None, goal.depth + 1)
+                new_caller = self.TopDownCaller(caller.variables,
+                    caller.binding, caller.theory, find_all=False,
+                    save=None, tables=caller.tables, exists=True,
+                    negations=caller.negations)
+                frame.goal = fail
+                frames.append(self.TopDownFrame(new_caller, new_context,
+                    pending=goal))
+                return None
+            elif lit.tablename() == 'true':
+                goal = self.top_down_next(goal)
+            elif lit.tablename() == 'false':
+                self.print_fail(lit, binding, goal.depth)
+                goal = fail
+            else:
+                if caller.tables is not None and goal is not frame.untabled:
+                    tables = caller.tables
+                    atom = lit.plug(binding, caller=caller)
+                    key = tables.variant_key(atom)
+                    if key in tables.active:
+                        # recursive call: use the answers found so far
+                        if (tables.lowest is None or
+                                tables.active[key] < tables.lowest):
+                            tables.lowest = tables.active[key]
+                    elif key not in tables.complete:
+                        frame.goal = fail
+                        table = self.TopDownTable(key, atom, tables,
+                                                  goal.depth)
+                        frames.append(self.tabled_frame(caller, table, goal))
+                        return None
+                    alternatives = self.top_down_answer_choices(
+                        goal, tables.answers[key].keys())
+                else:
+                    alternatives = self.top_down_rule_choices(
+                        goal, theories)
+                choices.append([alternatives, None, False])
+                goal = fail
+
+    def tabled_frame(self, caller, table, pending):
+        """ Returns the TopDownFrame for the next evaluation of the
+            subgoal of TABLE, for the literal in the context PENDING. """
+        table.tables.lowest = None
+        binding = self.new_bi_unifier()
+        new_caller = self.TopDownCaller(table.goal.variables(), binding,
+            caller.theory, find_all=True, save=None, tables=table.tables)
+        context = self.TopDownContext([table.goal], 0, binding, None,
+                                      table.depth + 1)
+        return self.TopDownFrame(new_caller, context, pending=pending,
+                                 table=table, untabled=context)
+
+    def tabled_iteration(self, frame, frames):
+        """ Adds the answers found by the finished FRAME to its table,
+            as an iteration of TABLED_ANSWERS.  Pushes the frame for
+            the next iteration onto FRAMES and returns None, or returns
+            the list of answers for the subgoal. """
+        table = frame.table
+        tables = table.tables
+        changed = False
+        for result in frame.caller.results:
+            answer = table.goal.plug(result.binding)
+            if answer not in table.answers:
+                table.answers[answer] = True
+                changed = True
+        if tables.lowest is not None:
+            table.used = min(table.used, tables.lowest)
+            if changed:
+                frames.append(self.tabled_frame(frame.caller, table,
+                                                frame.pending))
+                return None
+        return table.finish()
+
+    def top_down_next(self, context):
+        """ Returns the context for the literal to prove after the
+            current literal of CONTEXT, or None if there is none. """
+        while context is not None:
+            if context.literal_index < len(context.literals) - 1:
+                return self.TopDownContext(context.literals,
+                    context.literal_index + 1, context.binding,
+                    context.previous, context.depth)
+            context = context.previous
+        return None
+
+    def top_down_rule_choices(self, context, theories):
+        """ Generates a pair of an undo list and the next context for
+            each formula of THEORIES that proves the current literal of
+            CONTEXT.  The undo list must be undone before the next
+            pair is generated. """
+        lit = context.literals[context.literal_index]
+        for theory in theories:
+            for undo, unifier, body in theory.top_down_choices(
+                    lit, context.binding):
+                if len(body) == 0:
+                    yield undo, self.top_down_next(context)
+                else:
+                    yield undo, self.TopDownContext(body, 0, unifier,
+                        context, context.depth + 1)
+
+    def top_down_answer_choices(self, context, answers):
+        """ Same as TOP_DOWN_RULE_CHOICES but for the atoms ANSWERS
+            from the answer table for the current literal. """
+        lit = context.literals[context.literal_index]
+        for answer in answers:
+            undo = unify.bi_unify_atoms(answer, self.new_bi_unifier(),
+                                        lit, context.binding)
+            if undo is not None:
+                yield undo, self.top_down_next(context)
+
+    def top_down_choices(self, lit, binding):
+        """ Generates the undo list, the unifier and the body of each
+            formula in this theory whose head unifies with LIT under
+            BINDING.  Used by TOP_DOWN_ITERATE in place of TOP_DOWN_TH. """
+        for formula in self.head_index(lit.table, lit, binding):
+            unifier = self.new_bi_unifier()
+            undo = self.bi_unify(self.head(formula), unifier, lit, binding)
+            if undo is not None:
+                yield undo, unifier, self.body(formula)
+
+    def cardinality(self, table):
+        """ Returns the number of tuples stored for TABLE in this
+            theory, or None if unknown, e.g. because rules compute it. """
+        return None
+
+    def table_cardinality(self, table):
+        """ Returns the number of tuples for TABLE in this theory and
+            those it includes, or None if any of them does not know. """
+        total = 0
+        for theory in self.included_theories():
+            size = theory.cardinality(table)
+            if size is None:
+                return None
+            total += size
+        return total
+
+    def included_theories(self):
+        """ Returns the list of this theory and those it includes, in
+            the order TOP_DOWN_INCLUDES visits them. """
+        theories = [self]
+        for theory in self.includes:
+            theories.extend(theory.included_theories())
+        return theories
+
     def print_call(self, literal, binding, depth):
         self.log(literal.table, "{}Call: {}".format("| "*depth,
             literal.plug(binding)))
@@ -599,10 +1784,21 @@ class TopDownTheory(Theory):
         defined/written to in this theory. """
         return self.contents.keys()
 
-    def head_index(self, table):
+    def body_tables(self, table):
+        """ Returns the set of tables occurring in the bodies of the
+            formulas defining TABLE. """
+        tables = set()
+        for formula in self.head_index(table):
+            for lit in self.body(formula):
+                tables.add(lit.table)
+        return tables
+
+    def head_index(self, table, match_literal=None, match_unifier=None):
         """ This routine must return all the formulas pertinent for
         top-down evaluation when a literal with TABLE is at the top
-        of the stack. """
+        of the stack.  If given, MATCH_LITERAL (under the unifier
+        MATCH_UNIFIER) is that literal; implementations may use it to
+        return fewer formulas, but are not required to. """
         if table not in self.contents:
             return []
         return self.contents[table]
@@ -634,11 +1830,29 @@ class Database(TopDownTheory):
         def __init__(self, binding, rule):
             self.binding = binding
             self.rule = rule
+            # proofs are immutable, so compute the hash once from
+            #   a canonical, frozen version of the binding
+            if isinstance(binding, dict):
+                frozen = frozenset(binding.iteritems())
+            else:
+                frozen = frozenset((var, binding.apply(var))
+                                   for var in binding.contents)
+            self.hash = hash((frozen, rule))
 
         def __str__(self):
             return "apply({}, {})".format(str(self.binding), str(self.rule))
 
+        def __hash__(self):
+            return self.hash
+
+        def __ne__(self, other):
+            return not self == other
+
         def __eq__(self, other):
+            if self is other:
+                return True
+            if self.hash != other.hash:
+                return False
             result = (self.binding == other.binding and
                       self.rule == other.rule)
             # logging.debug("Pf: Comparing {} and {}: {}".format(
@@ -651,7 +1865,7 @@ class Database(TopDownTheory):
 
     class ProofCollection(object):
         def __init__(self, proofs):
-            self.contents = list(proofs)
+            self.contents = set(proofs)
 
         def __str__(self):
             return '{' + ",".join(str(x) for x in self.contents) + '}'
@@ -660,30 +1874,36 @@ class Database(TopDownTheory):
             if other is None:
                 return
             # logging.debug("PC: Subtracting {} and {}".format(str(self), str(other)))
-            remaining = []
-            for proof in self.contents:
-                if proof not in other.contents:
-                    remaining.append(proof)
-            self.contents = remaining
+            self.contents -= other.contents
             return self
 
         def __ior__(self, other):
             if other is None:
                 return
             # logging.debug("PC: Unioning {} and {}".format(str(self), str(other)))
-            for proof in other.contents:
-                # logging.debug("PC: Considering {}".format(str(proof)))
-                if proof not in self.contents:
-                    self.contents.append(proof)
+            self.contents |= other.contents
             return self
 
         def __getitem__(self, key):
-            return self.contents[key]
+            # Proofs are unordered; only used to grab some proof
+            if key == 0:
+                for proof in self.contents:
+                    return proof
+                raise IndexError(key)
+            return list(self.contents)[key]
+
+        def __iter__(self):
+            return iter(self.contents)
 
         def __len__(self):
             return len(self.contents)
 
+        def __contains__(self, proof):
+            return proof in self.contents
+
         def __ge__(self, iterable):
+            if isinstance(iterable, Database.ProofCollection):
+                return self.contents >= iterable.contents
             for proof in iterable:
                 if proof not in self.contents:
                     # logging.debug("Proof {} makes {} not >= {}".format(
@@ -692,16 +1912,16 @@ class Database(TopDownTheory):
             return True
 
         def __le__(self, iterable):
-            for proof in self.contents:
-                if proof not in iterable:
-                    # logging.debug("Proof {} makes {} not <= {}".format(
-                    #     str(proof), str(self), iterstr(iterable)))
-                    return False
-            return True
+            if isinstance(iterable, Database.ProofCollection):
+                return self.contents <= iterable.contents
+            return self.contents <= set(iterable)
 
         def __eq__(self, other):
             return self <= other and other <= self
 
+        def __ne__(self, other):
+            return not self == other
+
     class DBTuple(object):
         def __init__(self, iterable, proofs=None):
             self.tuple = tuple(iterable)
@@ -745,9 +1965,245 @@ class Database(TopDownTheory):
                         return None
             return changes
 
-    def __init__(self, name=None, abbr=None):
+    class CountedDBTuple(DBTuple):
+        """ A DBTuple that records only the number of distinct proofs
+            of its tuple instead of the proofs themselves.  A COUNT of
+            0 means the tuple was inserted without proofs. """
+        proofs = None
+
+        def __init__(self, iterable, count=0):
+            self.tuple = tuple(iterable)
+            self.count = count
+
+        def __str__(self):
+            return str(self.tuple) + "#" + str(self.count)
+
+    class ColumnarTable(object):
+        """ Compact storage for a table whose tuples all have ARITY
+            arguments and no proofs, e.g. a base table fed from an
+            external service.  Each column is an array of the integer
+            codes SYMBOLS, a SymbolTable, assigns to the values.
+            Supports the parts of the OrderedDict interface (from raw
+            tuple to DBTuple) that Database uses for its other tables;
+            the DBTuples it returns are created on demand.
+            Deleted rows are marked dead and reclaimed once they
+            make up half of the rows. """
+        def __init__(self, arity, symbols):
+            self.arity = arity
+            self.symbols = symbols
+            # one array of codes per column; row N is the Nth entry of each
+            self.columns = [array.array('i') for i in xrange(0, arity)]
+            # LIVE[N] is 1 unless row N was deleted
+            self.live = bytearray()
+            self.dead = 0
+            self.size = 0
+            # dictionary from the hash of a row's tuple of codes to the
+            #   row number, or to a list of row numbers if several live
+            #   rows have the same hash.  Avoids storing the tuples.
+            self.rows = {}
+            # dictionary from tuple of column numbers to dictionary from
+            #   tuple of codes in those columns to array of row numbers.
+            #   May include dead rows.
+            self.indexes = {}
+
+        def __len__(self):
+            return self.size
+
+        def __contains__(self, raw_tuple):
+            return self.row(raw_tuple) is not None
+
+        def __eq__(self, other):
+            return (len(self) == len(other) and
+                    all(x in other for x in self.iterkeys()))
+
+        def __ne__(self, other):
+            return not self == other
+
+        def row(self, raw_tuple):
+            """ Returns the row number for RAW_TUPLE or None. """
+            if len(raw_tuple) != self.arity:
+                return None
+            codes = self.symbols.encode_tuple(raw_tuple)
+            if codes is None:
+                return None
+            return self.find_row(codes)
+
+        def row_codes(self, row):
+            return tuple([column[row] for column in self.columns])
+
+        def find_row(self, codes):
+            """ Returns the number of the live row with CODES or None. """
+            entry = self.rows.get(hash(codes))
+            if entry is None:
+                return None
+            if not isinstance(entry, list):
+                entry = [entry]
+            for row in entry:
+                if self.row_codes(row) == codes:
+                    return row
+            return None
+
+        def add_row(self, codes, row):
+            h = hash(codes)
+            entry = self.rows.get(h)
+            if entry is None:
+                self.rows[h] = row
+            elif isinstance(entry, list):
+                entry.append(row)
+            else:
+                self.rows[h] = [entry, row]
+            self.size += 1
+
+        def remove_row(self, codes, row):
+            h = hash(codes)
+            entry = self.rows[h]
+            if not isinstance(entry, list):
+                del self.rows[h]
+            else:
+                entry.remove(row)
+                if len(entry) == 1:
+                    self.rows[h] = entry[0]
+            self.size -= 1
+
+        def row_tuple(self, row):
+            """ Returns the raw tuple stored at ROW. """
+            values = self.symbols.values
+            return tuple([values[column[row]] for column in self.columns])
+
+        def get(self, raw_tuple, default=None):
+            row = self.row(raw_tuple)
+            if row is None:
+                return default
+            return Database.DBTuple(self.row_tuple(row))
+
+        def __setitem__(self, raw_tuple, dbtuple):
+            assert len(raw_tuple) == self.arity, \
+                "Columnar tables have fixed arity"
+            codes = tuple([self.symbols.encode(value) for value in raw_tuple])
+            if self.find_row(codes) is not None:
+                return
+            row = len(self.live)
+            for i in xrange(0, self.arity):
+                self.columns[i].append(codes[i])
+            self.live.append(1)
+            self.add_row(codes, row)
+            for columns, index in self.indexes.iteritems():
+                self.index_row(index, columns, codes, row)
+
+        def __delitem__(self, raw_tuple):
+            row = self.row(raw_tuple)
+            if row is None:
+                raise KeyError(raw_tuple)
+            self.remove_row(self.row_codes(row), row)
+            self.live[row] = 0
+            self.dead += 1
+            if self.dead > len(self.live) / 2:
+                self.compact()
+
+        def iterrows(self):
+            for row in xrange(0, len(self.live)):
+                if self.live[row]:
+                    yield row
+
+        def iterkeys(self):
+            for row in self.iterrows():
+                yield self.row_tuple(row)
+
+        def itervalues(self):
+            for row in self.iterrows():
+                yield Database.DBTuple(self.row_tuple(row))
+
+        def values(self):
+            return list(self.itervalues())
+
+        def select(self, columns, key):
+            """ Returns a list of DBTuples for the rows whose values in the
+                column numbers COLUMNS are KEY.  Compares codes,
+                using an index if there is one. """
+            codes = self.symbols.encode_tuple(key)
+            if codes is None:
+                return []
+            if columns in self.indexes:
+                rows = self.indexes[columns].get(codes, [])
+                return [Database.DBTuple(self.row_tuple(row))
+                        for row in rows if self.live[row]]
+            results = []
+            scanned = [self.columns[i] for i in columns]
+            live = self.live
+            if len(columns) == 1:
+                code = codes[0]
+                for row, value in enumerate(scanned[0]):
+                    if value == code and live[row]:
+                        results.append(row)
+            else:
+                width = len(columns)
+                for row in xrange(0, len(live)):
+                    if live[row] and all(scanned[i][row] == codes[i]
+                                         for i in xrange(0, width)):
+                        results.append(row)
+            return [Database.DBTuple(self.row_tuple(row)) for row in results]
+
+        def index_row(self, index, columns, codes, row):
+            key = tuple([codes[i] for i in columns])
+            if key not in index:
+                index[key] = array.array('i')
+            index[key].append(row)
+
+        def build_index(self, columns):
+            """ Builds and returns an index on the column numbers COLUMNS. """
+            index = {}
+            for row in self.iterrows():
+                self.index_row(index, columns, self.row_codes(row), row)
+            self.indexes[columns] = index
+            return index
+
+        def drop_index(self, columns):
+            if columns in self.indexes:
+                del self.indexes[columns]
+
+        def compact(self):
+            """ Reclaims the space used by dead rows. """
+            columns = [array.array('i') for i in xrange(0, self.arity)]
+            for row in self.iterrows():
+                for i in xrange(0, self.arity):
+                    columns[i].append(self.columns[i][row])
+            self.columns = columns
+            self.live = bytearray([1]) * self.size
+            self.dead = 0
+            self.rows = {}
+            self.size = 0
+            for row in xrange(0, len(self.live)):
+                self.add_row(self.row_codes(row), row)
+            for columns in self.indexes.keys():
+                self.build_index(columns)
+
+    def __init__(self, name=None, abbr=None, counting=False, columnar=False,
+                 symbols=None):
         super(Database, self).__init__(name=name, abbr=abbr)
+        # SymbolTable for the values stored in tuples.  Shared with
+        #   the other Databases of a Runtime.
+        if symbols is None:
+            symbols = SymbolTable()
+        self.symbols = symbols
+        # if True, store CountedDBTuples instead of DBTuples
+        self.counting = counting
+        # if True, store tables whose tuples have no proofs
+        #   in ColumnarTables
+        assert not (counting and columnar), \
+            "Columnar tables store no proof counts"
+        self.columnar = columnar
+        # dictionary from table name to an OrderedDict from raw tuple
+        #   to the DBTuple storing it (or a ColumnarTable).  Ordered so
+        #   that iteration (e.g. in HEAD_INDEX) is deterministic.
         self.data = {}
+        # dictionary from table name to dictionary from a tuple of column
+        #   numbers to a dictionary from the values in those columns
+        #   to an OrderedDict of the DBTuples (keyed by raw tuple)
+        #   having those values.  Built on demand by HEAD_INDEX
+        #   as recommended by SELF.ADVISOR.  ColumnarTables keep
+        #   their own indexes.
+        self.indexes = {}
+        self.advisor = IndexAdvisor()
 
     def __str__(self):
         def hash2str (h):
@@ -761,7 +2217,7 @@ class Database(TopDownTheory):
             for key in h:
                 s = "{} : ".format(key)
                 s += '['
-                s += ', '.join([str(val) for val in h[key]])
+                s += ', '.join([str(val) for val in h[key].itervalues()])
                 s += ']'
                 strings.append(s)
             return '{' + ", ".join(strings) + '}'
@@ -780,34 +2236,34 @@ class Database(TopDownTheory):
         results = []
         for table in self.data:
             if table not in other.data:
-                for dbtuple in self.data[table]:
+                for dbtuple in self.data[table].itervalues():
                     add_tuple(table, dbtuple)
             else:
-                for dbtuple in self.data[table]:
-                    if dbtuple not in other.data[table]:
+                for dbtuple in self.data[table].itervalues():
+                    if dbtuple.tuple not in other.data[table]:
                         add_tuple(table, dbtuple)
         return results
 
     def __or__(self, other):
         def add_db(db):
             for table in db.data:
-                for dbtuple in db.data[table]:
+                for dbtuple in db.data[table].itervalues():
                     result.insert(compile.Atom.create_from_table_tuple(
                             table, dbtuple.tuple), proofs=dbtuple.proofs)
-        result = Database()
+        result = Database(symbols=self.symbols)
         add_db(self)
         add_db(other)
         return result
 
     def __getitem__(self, key):
         # KEY must be a tablename
-        return self.data[key]
+        return self.data[key].values()
 
     def contents(self):
         """ Return a sequence of Atoms representing all the table data. """
         results = []
         for table in self.data:
-            for dbtuple in self.data[table]:
+            for dbtuple in self.data[table].itervalues():
                 results.append(compile.Atom.create_from_table_tuple(
                     table, dbtuple.tuple))
         return results
@@ -822,21 +2278,45 @@ class Database(TopDownTheory):
             noop = False
         if event.formula.table not in self.data:
             return not noop
-        event_data = self.data[event.formula.table]
         raw_tuple = tuple(event.formula.argument_names())
-        for dbtuple in event_data:
-            if dbtuple.tuple == raw_tuple:
-                if event.proofs <= dbtuple.proofs:
-                    return noop
+        dbtuple = self.data[event.formula.table].get(raw_tuple)
+        if self.counting:
+            # only changes to whether the tuple is true are not noops
+            if dbtuple is None:
+                return not noop
+            if event.is_insert():
+                return True
+            return dbtuple.count - self.count_proofs(event.proofs) > 0
+        if dbtuple is not None and event.proofs <= dbtuple.proofs:
+            return noop
         return not noop
 
+    def count_proofs(self, proofs):
+        """ Returns the number of distinct proofs in PROOFS, which is
+            either an iterable of proofs or already their number. """
+        if proofs is None:
+            return 0
+        if isinstance(proofs, int):
+            return proofs
+        return len(set(proofs))
+
+    def derivation_count(self, atom):
+        """ Returns the number of proofs recorded for the ground ATOM
+            or None if ATOM is not in the database.  Requires SELF.COUNTING. """
+        if atom.table not in self.data:
+            return None
+        dbtuple = self.data[atom.table].get(tuple(atom.argument_names()))
+        if dbtuple is None:
+            return None
+        return dbtuple.count
+
     def explain(self, atom):
         if atom.table not in self.data or not atom.is_ground():
             return self.ProofCollection([])
         args = tuple([x.name for x in atom.arguments])
-        for dbtuple in self.data[atom.table]:
-            if dbtuple.tuple == args:
-                return dbtuple.proofs
+        dbtuple = self.data[atom.table].get(args)
+        if dbtuple is not None:
+            return dbtuple.proofs
 
     def table_names(self):
         """ Return all table names defined in this theory and all included
@@ -852,10 +2332,193 @@ class Database(TopDownTheory):
     def defined_table_names(self):
         return self.data.keys()
 
-    def head_index(self, table):
+    def body_tables(self, table):
+        return set()
+
+    def head_index(self, table, match_literal=None, match_unifier=None):
+        if table not in self.data:
+            return []
+        if match_literal is None:
+            return self.data[table].values()
+        columns, key = self.bound_columns(match_literal, match_unifier)
+        return self.lookup(table, columns, key, len(match_literal.arguments))
+
+    def lookup(self, table, columns, key, arity):
+        """ Returns the DBTuples of TABLE whose values in the column
+            numbers COLUMNS may be the tuple KEY, using and building
+            indexes like HEAD_INDEX.  The results may include tuples
+            with other values or another arity than ARITY. """
         if table not in self.data:
             return []
-        return self.data[table]
+        self.advisor.record_lookup(table, columns)
+        if len(columns) == arity:
+            # ground lookup: use the tuple storage itself
+            dbtuple = self.data[table].get(key)
+            if dbtuple is None:
+                return []
+            return [dbtuple]
+        index = None
+        if len(columns) > 0:
+            index = self.get_index(table, columns)
+        if index is None:
+            self.advisor.record_scan(table)
+            if len(columns) > 0 and self.is_columnar(table):
+                return self.data[table].select(columns, key)
+            return self.data[table].values()
+        if self.is_columnar(table):
+            return self.data[table].select(columns, key)
+        if key not in index:
+            return []
+        return index[key].values()
+
+    def is_columnar(self, table):
+        """ Returns True iff TABLE is stored in a ColumnarTable. """
+        return isinstance(self.data.get(table), self.ColumnarTable)
+
+    def make_row_table(self, table):
+        """ Converts the ColumnarTable storing TABLE into an OrderedDict
+            of DBTuples, e.g. so it can store tuples with proofs. """
+        self.log(table, "Converting {} to row storage".format(table))
+        rows = collections.OrderedDict()
+        for dbtuple in self.data[table].itervalues():
+            rows[dbtuple.tuple] = dbtuple
+        self.data[table] = rows
+
+    def bound_columns(self, literal, unifier):
+        """ Returns the tuple of positions of LITERAL's arguments that
+            are bound to object constants under UNIFIER together with
+            the tuple of raw values at those positions. """
+        columns = []
+        key = []
+        for i in xrange(0, len(literal.arguments)):
+            if unifier is None:
+                val = literal.arguments[i]
+            else:
+                val = unifier.apply(literal.arguments[i])
+            if not val.is_variable():
+                columns.append(i)
+                key.append(val.name)
+        return tuple(columns), tuple(key)
+
+    def get_index(self, table, columns):
+        """ Returns the index for TABLE on the tuple of column numbers
+            COLUMNS, building it first if SELF.ADVISOR recommends it.
+            Returns None if there is no such index. """
+        if self.is_columnar(table):
+            if columns in self.data[table].indexes:
+                return self.data[table].indexes[columns]
+        elif table in self.indexes and columns in self.indexes[table]:
+            return self.indexes[table][columns]
+        drops = self.advisor.choose_drops(table, columns,
+            len(self.data[table]), self.index_sizes())
+        if drops is None:
+            return None
+        for (droptable, dropcolumns) in drops:
+            self.drop_index(droptable, dropcolumns)
+        return self.build_index(table, columns)
+
+    def build_index(self, table, columns):
+        """ Builds and returns the index for TABLE on the tuple of column
+            numbers COLUMNS. """
+        self.log(table, "Building index on columns {}".format(str(columns)))
+        if self.is_columnar(table):
+            return self.data[table].build_index(columns)
+        index = {}
+        for dbtuple in self.data[table].itervalues():
+            self.index_insert_tuple(index, columns, dbtuple)
+        if table not in self.indexes:
+            self.indexes[table] = {}
+        self.indexes[table][columns] = index
+        return index
+
+    def drop_index(self, table, columns):
+        """ Discards the index for TABLE on the column numbers COLUMNS. """
+        if self.is_columnar(table):
+            self.data[table].drop_index(columns)
+            return
+        if table not in self.indexes or columns not in self.indexes[table]:
+            return
+        self.log(table, "Dropping index on columns {}".format(str(columns)))
+        del self.indexes[table][columns]
+        if len(self.indexes[table]) == 0:
+            del self.indexes[table]
+
+    def index_sizes(self):
+        """ Returns a list of (table, columns, size) triples, one for
+            each index, where SIZE is the number of tuples indexed. """
+        return [(table, columns, len(self.data[table]))
+                for table in self.data
+                for columns in self.table_indexes(table)]
+
+    def table_indexes(self, table):
+        """ Returns the list of column number tuples indexed for TABLE. """
+        if self.is_columnar(table):
+            return self.data[table].indexes.keys()
+        return self.indexes.get(table, {}).keys()
+
+    def set_index_budget(self, max_entries):
+        """ Bound the number of tuples held by all indexes to
+            MAX_ENTRIES (None for no bound), dropping the least
+            used indexes if necessary. """
+        self.advisor.max_entries = max_entries
+        self.enforce_index_budget()
+
+    def enforce_index_budget(self):
+        """ Drop the indexes SELF.ADVISOR chooses so that the indexes
+            fit within its budget. """
+        for (table, columns) in self.advisor.choose_evictions(
+                self.index_sizes()):
+            self.drop_index(table, columns)
+
+    def index_statistics(self):
+        """ Returns a dictionary from table name to a dictionary
+            describing the tuple count, lookups, full scans, and
+            indexes of that table. """
+        stats = {}
+        for table in self.data:
+            stats[table] = self.advisor.statistics(table)
+            stats[table]['tuples'] = len(self.data[table])
+            stats[table]['indexes'] = sorted(self.table_indexes(table))
+            stats[table]['columnar'] = self.is_columnar(table)
+        return stats
+
+    def index_insert_tuple(self, index, columns, dbtuple):
+        if len(dbtuple.tuple) <= columns[-1]:
+            return
+        key = tuple([dbtuple.tuple[i] for i in columns])
+        if key not in index:
+            index[key] = collections.OrderedDict()
+        index[key][dbtuple.tuple] = dbtuple
+
+    def index_delete_tuple(self, index, columns, dbtuple):
+        if len(dbtuple.tuple) <= columns[-1]:
+            return
+        key = tuple([dbtuple.tuple[i] for i in columns])
+        if key not in index:
+            return
+        bucket = index[key]
+        if dbtuple.tuple in bucket:
+            del bucket[dbtuple.tuple]
+            if len(bucket) == 0:
+                del index[key]
+
+    def index_insert(self, table, dbtuple):
+        """ Adds DBTUPLE to all the indexes on TABLE. """
+        # ColumnarTables maintain their own indexes
+        if table in self.indexes:
+            for columns, index in self.indexes[table].iteritems():
+                self.index_insert_tuple(index, columns, dbtuple)
+        elif not self.is_columnar(table) or len(self.data[table].indexes) == 0:
+            return
+        if self.advisor.max_entries is not None:
+            self.enforce_index_budget()
+
+    def index_delete(self, table, dbtuple):
+        """ Removes DBTUPLE from all the indexes on TABLE. """
+        if table not in self.indexes:
+            return
+        for columns, index in self.indexes[table].iteritems():
+            self.index_delete_tuple(index, columns, dbtuple)
 
     def head(self, thing):
         return thing
@@ -863,21 +2526,62 @@ class Database(TopDownTheory):
     def body(self, thing):
         return []
 
+    def cardinality(self, table):
+        if table not in self.data:
+            return 0
+        return len(self.data[table])
+
+    def contains(self, table, raw_tuple):
+        """ Returns True iff TABLE includes the tuple of values RAW_TUPLE. """
+        return table in self.data and raw_tuple in self.data[table]
+
+    def remove_table(self, table):
+        """ Removes TABLE together with its indexes.  Returns the
+            dictionary from raw tuple to DBTuple that stored TABLE,
+            or None if TABLE had no tuples. """
+        rows = self.data.pop(table, None)
+        self.indexes.pop(table, None)
+        if rows is not None:
+            TopDownTheory.modifications += 1
+        return rows
+
     def bi_unify(self, dbtuple, unifier1, atom, unifier2):
         """ THING1 is always a ground DBTuple and THING2 is always an ATOM. """
         return dbtuple.match(atom, unifier2)
 
     def atom_to_internal(self, atom, proofs=None):
+        if self.counting:
+            return atom.table, self.CountedDBTuple(atom.argument_names(),
+                self.count_proofs(proofs))
         return atom.table, self.DBTuple(atom.argument_names(), proofs)
 
     def modify(self, atom, is_insert=True, proofs=None):
         """ Inserts/deletes ATOM and returns a list of changes that
         were caused. That list contains either 0 or 1 Event."""
         assert isinstance(atom, compile.Atom), "Modify requires compile.Atom"
+        if (not is_insert and not self.counting and proofs is not None and
+                len(proofs) > 0):
+            # Only the stored proofs can be deleted; a batch of deletes
+            #   can carry proofs that an earlier event already deleted.
+            stored = self.explain(atom)
+            if stored is None:
+                stored = self.ProofCollection([])
+            proofs = [proof for proof in proofs if proof in stored]
+            if len(proofs) == 0:
+                self.log(atom.table, "Delete of {} is a noop".format(
+                    str(atom)))
+                return []
         event = Event(formula=atom, insert=is_insert, proofs=proofs)
         self.log(atom.table, "Modify: {}".format(str(atom)))
         if self.is_noop(event):
             self.log(atom.table, "Event {} is a noop".format(str(event)))
+            if not self.counting:
+                return []
+            # noop for the tuple but not for the number of its proofs
+            if is_insert:
+                self.insert(atom, proofs=proofs)
+            else:
+                self.delete(atom, proofs=proofs)
             return []
         if is_insert:
             self.insert(atom, proofs=proofs)
@@ -885,29 +2589,67 @@ class Database(TopDownTheory):
             self.delete(atom, proofs=proofs)
         return [event]
 
+    def bulk_modify(self, atoms, is_insert=True):
+        """ Inserts/deletes each of ATOMS and returns the list of
+            changes that were caused. """
+        changes = []
+        for atom in atoms:
+            changes.extend(self.modify(atom, is_insert=is_insert))
+        return changes
+
+    def update(self, events):
+        """ Inserts/deletes the atom of each of EVENTS and returns the
+            list of changes that were caused. """
+        changes = []
+        for event in events:
+            changes.extend(self.modify(event.formula,
+                                       is_insert=event.is_insert()))
+        return changes
+
+    def intern(self, dbtuple):
+        """ Replaces the values of DBTUPLE, about to be stored, with
+            their canonical copies from SELF.SYMBOLS. """
+        dbtuple.tuple = self.symbols.intern_tuple(dbtuple.tuple)
+
     def insert(self, atom, proofs=None):
         assert isinstance(atom, compile.Atom), "Insert requires compile.Atom"
         table, dbtuple = self.atom_to_internal(atom, proofs)
         self.log(table, "Insert: {}".format(str(atom)))
         if table not in self.data:
-            self.data[table] = [dbtuple]
+            if self.columnar and len(dbtuple.proofs) == 0:
+                self.data[table] = self.ColumnarTable(len(dbtuple.tuple),
+                                                      self.symbols)
+            else:
+                self.data[table] = collections.OrderedDict()
+                self.intern(dbtuple)
+            self.data[table][dbtuple.tuple] = dbtuple
+            self.index_insert(table, dbtuple)
+            TopDownTheory.modifications += 1
             self.log(atom.table, "First tuple in table {}".format(table))
             return
         else:
             self.log(table, "Not first tuple in table {}".format(table))
-            for existingtuple in self.data[table]:
+            if (self.is_columnar(table) and
+                    (len(dbtuple.proofs) > 0 or
+                     len(dbtuple.tuple) != self.data[table].arity)):
+                self.make_row_table(table)
+            existingtuple = self.data[table].get(dbtuple.tuple)
+            if existingtuple is not None and self.counting:
+                existingtuple.count += dbtuple.count
+                return
+            if existingtuple is not None:
+                # self.log(table, "Found existing tuple: {}".format(
+                #     str(existingtuple)))
+                assert(existingtuple.proofs is not None)
+                existingtuple.proofs |= dbtuple.proofs
+                # self.log(table, "Updated tuple: {}".format(str(existingtuple)))
                 assert(existingtuple.proofs is not None)
-                if existingtuple.tuple == dbtuple.tuple:
-                    # self.log(table, "Found existing tuple: {}".format(
-                    #     str(existingtuple)))
-                    assert(existingtuple.proofs is not None)
-                    existingtuple.proofs |= dbtuple.proofs
-                    # self.log(table, "Updated tuple: {}".format(str(existingtuple)))
-                    assert(existingtuple.proofs is not None)
-                    return
-            self.data[table].append(dbtuple)
-            self.log(table, "current contents of {}: {}".format(table,
-                iterstr(self.data[table])))
+                return
+            if not self.is_columnar(table):
+                self.intern(dbtuple)
+            self.data[table][dbtuple.tuple] = dbtuple
+            self.index_insert(table, dbtuple)
+            TopDownTheory.modifications += 1
 
 
     def delete(self, atom, proofs=None):
@@ -916,14 +2658,20 @@ class Database(TopDownTheory):
         table, dbtuple = self.atom_to_internal(atom, proofs)
         if table not in self.data:
             return
-        for i in xrange(0, len(self.data[table])):
-            existingtuple = self.data[table][i]
-            #self.log(table, "Checking tuple {}".format(str(existingtuple)))
-            if existingtuple.tuple == dbtuple.tuple:
-                existingtuple.proofs -= dbtuple.proofs
-                if len(existingtuple.proofs) == 0:
-                    del self.data[table][i]
-                return
+        existingtuple = self.data[table].get(dbtuple.tuple)
+        if existingtuple is None:
+            return
+        #self.log(table, "Found tuple {}".format(str(existingtuple)))
+        if self.counting:
+            existingtuple.count -= dbtuple.count
+            remaining = existingtuple.count
+        else:
+            existingtuple.proofs -= dbtuple.proofs
+            remaining = len(existingtuple.proofs)
+        if remaining <= 0:
+            del self.data[table][dbtuple.tuple]
+            self.index_delete(table, existingtuple)
+            TopDownTheory.modifications += 1
 
 ##############################################################################
 ## Concrete Theories: other
@@ -932,10 +2680,24 @@ class Database(TopDownTheory):
 class NonrecursiveRuleTheory(TopDownTheory):
     """ A non-recursive collection of Rules. """
 
-    def __init__(self, rules=None, name=None, abbr=None):
+    def __init__(self, rules=None, name=None, abbr=None, tabled=False,
+                 optimize=False, iterative=False, processes=None):
         super(NonrecursiveRuleTheory, self).__init__(name=name, abbr=abbr)
+        # with tabling, the rules may be recursive after all
+        self.tabled = tabled
+        self.iterative = iterative
+        self.processes = processes
         # dictionary from table name to list of rules with that table in head
         self.contents = {}
+        # dependencies between the tables of the rules
+        self.graph = graph.DependencyGraph()
+        # if OPTIMIZE, the order of each rule body is chosen by SELF.OPTIMIZER
+        self.optimizer = None
+        if optimize:
+            self.optimizer = RuleOptimizer(self.table_cardinality)
+        # dictionary from rule to pair of its reordered body and the
+        #   statistics used to choose that order
+        self.optimized = {}
         if rules is not None:
             for rule in rules:
                 self.insert(rule)
@@ -952,13 +2714,15 @@ class NonrecursiveRuleTheory(TopDownTheory):
             "Insert: {}".format(str(rule)))
         table = rule.head.table
         if table in self.contents:
-            if rule not in self.contents[table]:  # eliminate dups
-                self.contents[table].append(rule)
-                return [rule]
-            return []
+            if rule in self.contents[table]:  # eliminate dups
+                return []
+            self.contents[table].append(rule)
         else:
             self.contents[table] = [rule]
-            return [rule]
+        self.graph.formula_insert(rule)
+        TopDownTheory.modifications += 1
+        self.optimize(rule)
+        return [rule]
 
     def delete(self, rule):
         """ Delete RULE and return list of changes (either 0 or 1
@@ -970,11 +2734,51 @@ class NonrecursiveRuleTheory(TopDownTheory):
         if table in self.contents:
             try:
                 self.contents[table].remove(rule)
+                self.optimized.pop(rule, None)
+                self.graph.formula_delete(rule)
+                TopDownTheory.modifications += 1
                 return [rule]
             except ValueError:
                 return []
         return []
 
+    def optimize(self, rule):
+        """ Chooses the order in which to evaluate the body of RULE. """
+        if self.optimizer is None or len(rule.body) < 2:
+            return
+        body, statistics = self.optimizer.order(rule.body)
+        self.optimized[rule] = (body, statistics)
+        self.log(rule.head.table, "Optimized: {} :- {}".format(
+            str(rule.head), ", ".join([str(lit) for lit in body])))
+
+    def body(self, formula):
+        if formula not in self.optimized:
+            return formula.body
+        body, statistics = self.optimized[formula]
+        if self.optimizer.stale(statistics):
+            self.optimize(formula)
+            body = self.optimized[formula][0]
+        return body
+
+    def body_tables(self, table):
+        return self.graph.body_tables(table)
+
+    def select_on_demand(self, query):
+        """ Returns the list of instances of the atom QUERY that are
+            true, computed bottom-up from just the rules and facts
+            relevant to QUERY.  Unlike SELECT, terminates for recursive
+            rules without tabling. """
+        return self.demand_evaluation(self.content(), query)
+
+    def cardinality(self, table):
+        # count the facts of TABLE, unless rules also define it
+        if table not in self.contents:
+            return 0
+        for rule in self.contents[table]:
+            if len(rule.body) > 0:
+                return None
+        return len(self.contents[table])
+
     def define(self, rules):
         """ Empties and then inserts RULES. """
         self.empty()
@@ -984,6 +2788,9 @@ class NonrecursiveRuleTheory(TopDownTheory):
     def empty(self):
         """ Deletes contents of theory. """
         self.contents = {}
+        self.optimized = {}
+        self.graph.empty()
+        TopDownTheory.modifications += 1
 
     def content(self):
         results = []
@@ -997,12 +2804,26 @@ class DeltaRuleTheory (Theory):
         super(DeltaRuleTheory, self).__init__(name=name, abbr=abbr)
         # dictionary from table name to list of rules with that table as trigger
         self.contents = {}
+        # dictionary from table name to dictionary from the tuple of
+        #   positions of the constant arguments of a trigger to
+        #   dictionary from the tuple of those constants to the list of
+        #   rules with such a trigger
+        self.trigger_index = {}
         # dictionary from delta_rule to the rule from which it was derived
         self.originals = set()
         # dictionary from table name to number of rules with that table in head
         self.views = {}
         # all tables
         self.all_tables = {}
+        # dependencies between the tables of the original rules
+        self.graph = graph.DependencyGraph()
+        # if not None, the RuleOptimizer choosing the order of the
+        #   bodies of delta rules
+        self.optimizer = None
+        # dictionary from (original rule, trigger) to the pair of the
+        #   delta rule with reordered body and the statistics used to
+        #   choose that order
+        self.optimized = {}
 
     def modify(self, rule, is_insert):
         """ Insert/delete the compile.Rule RULE into the theory.
@@ -1028,10 +2849,15 @@ class DeltaRuleTheory (Theory):
         for delta in self.compute_delta_rules([rule]):
             self.insert_delta(delta)
         self.originals.add(rule)
+        self.graph.formula_insert(rule)
         return True
 
     def insert_delta(self, delta):
         """ Insert a delta rule. """
+        if self.optimizer is not None and len(delta.body) > 1:
+            delta = DeltaRule(delta.trigger, delta.head, delta.body,
+                              delta.original)
+            self.optimize(delta)
         # views (tables occurring in head)
         if delta.head.table in self.views:
             self.views[delta.head.table] += 1
@@ -1050,6 +2876,10 @@ class DeltaRuleTheory (Theory):
             self.contents[delta.trigger.table] = [delta]
         else:
             self.contents[delta.trigger.table].append(delta)
+        positions, constants = self.trigger_key(delta.trigger)
+        patterns = self.trigger_index.setdefault(delta.trigger.table, {})
+        patterns.setdefault(positions, {}).setdefault(
+            constants, []).append(delta)
 
     def delete(self, rule):
         """ Delete a compile.Rule from theory.
@@ -1061,6 +2891,7 @@ class DeltaRuleTheory (Theory):
         for delta in self.compute_delta_rules([rule]):
             self.delete_delta(delta)
         self.originals.remove(rule)
+        self.graph.formula_delete(rule)
         return True
 
     def delete_delta(self, delta):
@@ -1080,16 +2911,72 @@ class DeltaRuleTheory (Theory):
         # contents
         if delta.trigger.table not in self.contents:
             return
+        key = (delta.original, delta.trigger)
+        if key in self.optimized:
+            delta = self.optimized.pop(key)[0]
         self.contents[delta.trigger.table].remove(delta)
+        positions, constants = self.trigger_key(delta.trigger)
+        patterns = self.trigger_index[delta.trigger.table]
+        patterns[positions][constants].remove(delta)
+        if len(patterns[positions][constants]) == 0:
+            del patterns[positions][constants]
+            if len(patterns[positions]) == 0:
+                del patterns[positions]
+
+    @classmethod
+    def trigger_key(cls, trigger):
+        """ Returns the pair of the tuple of the positions of the
+            constant arguments of the atom TRIGGER and the tuple of
+            the values of those constants. """
+        positions = tuple(i for i, arg in enumerate(trigger.arguments)
+                          if arg.is_object())
+        return (positions,
+                tuple(trigger.arguments[i].name for i in positions))
+
+    def optimize(self, delta):
+        """ Reorders the body of DELTA, whose trigger's variables
+            are bound when the body is evaluated. """
+        delta.body, statistics = self.optimizer.order(delta.body,
+            delta.trigger.variables())
+        self.optimized[(delta.original, delta.trigger)] = (delta, statistics)
+        self.log(delta.trigger.table, "Optimized: {}".format(str(delta)))
 
     def __str__(self):
         return str(self.contents)
 
-    def rules_with_trigger(self, table):
+    def rules_with_trigger(self, table, atom=None):
+        """ Returns the list of delta rules triggered by changes to
+            TABLE.  If the ground ATOM is given, returns only those
+            whose trigger has the same constants as ATOM in the same
+            positions, found in SELF.TRIGGER_INDEX without unifying
+            the other triggers with ATOM. """
         if table not in self.contents:
             return []
+        if atom is None:
+            rules = self.contents[table]
         else:
-            return self.contents[table]
+            rules = []
+            values = atom.argument_names()
+            for positions, rules_by_constants in \
+                    self.trigger_index[table].iteritems():
+                if len(positions) > 0 and positions[-1] >= len(values):
+                    continue
+                rules.extend(rules_by_constants.get(
+                    tuple(values[i] for i in positions), []))
+        if self.optimizer is not None:
+            for delta in rules:
+                key = (delta.original, delta.trigger)
+                if (key in self.optimized and
+                        self.optimizer.stale(self.optimized[key][1])):
+                    self.optimize(delta)
+        return rules
+
+    def body_tables(self, table):
+        """ Returns the set of tables other than TABLE occurring in
+            the bodies of the rules with TABLE in the head. """
+        tables = self.graph.body_tables(table)
+        tables.discard(table)
+        return tables
 
     def is_view(self, x):
         return x in self.views
@@ -1104,69 +2991,14 @@ class DeltaRuleTheory (Theory):
                 base.append(table)
         return base
 
-    @classmethod
-    def eliminate_self_joins(cls, formulas):
-        """ Return new list of formulas that is equivalent to
-            the list of formulas FORMULAS except that there
-            are no self-joins. """
-        def new_table_name(name, arity, index):
-            return "___{}_{}_{}".format(name, arity, index)
-        def n_variables(n):
-            vars = []
-            for i in xrange(0, n):
-                vars.append("x" + str(i))
-            return vars
-        # dict from (table name, arity) tuple to
-        #      max num of occurrences of self-joins in any rule
-        global_self_joins = {}
-        # dict from (table name, arity) to # of args for
-        arities = {}
-        # remove self-joins from rules
-        results = []
-        for rule in formulas:
-            if rule.is_atom():
-                results.append(rule)
-                continue
-            logging.debug("eliminating self joins from {}".format(rule))
-            occurrences = {}  # for just this rule
-            for atom in rule.body:
-                table = atom.table
-                arity = len(atom.arguments)
-                tablearity = (table, arity)
-                if tablearity not in occurrences:
-                    occurrences[tablearity] = 1
-                else:
-                    # change name of atom
-                    atom.table = new_table_name(table, arity,
-                        occurrences[tablearity])
-                    # update our counters
-                    occurrences[tablearity] += 1
-                    if tablearity not in global_self_joins:
-                        global_self_joins[tablearity] = 1
-                    else:
-                        global_self_joins[tablearity] = \
-                            max(occurrences[tablearity] - 1,
-                                global_self_joins[tablearity])
-            results.append(rule)
-            logging.debug("final rule: {}".format(str(rule)))
-        # add definitions for new tables
-        for tablearity in global_self_joins:
-            table = tablearity[0]
-            arity = tablearity[1]
-            for i in xrange(1, global_self_joins[tablearity] + 1):
-                newtable = new_table_name(table, arity, i)
-                args = [compile.Variable(var) for var in n_variables(arity)]
-                head = compile.Atom(newtable, args)
-                body = [compile.Atom(table, args)]
-                results.append(compile.Rule(head, body))
-                logging.debug("Adding rule {}".format(results[-1]))
-        return results
-
     @classmethod
     def compute_delta_rules(cls, formulas):
-        """ Assuming FORMULAS has no self-joins, return a list of DeltaRules
-        derived from those FORMULAS. """
-        formulas = cls.eliminate_self_joins(formulas)
+        """ Return a list of DeltaRules derived from FORMULAS, one for
+        each literal of each rule.  When a table occurs more than once
+        in a body, the delta rule for each occurrence evaluates the
+        occurrences before it without the changed tuples and those
+        after it with them (see MaterializedViewTheory.propagate_rule_batch),
+        so each new or lost binding is found exactly once. """
         delta_rules = []
         for rule in formulas:
             if rule.is_atom():
@@ -1182,10 +3014,34 @@ class MaterializedViewTheory(TopDownTheory):
     """ A theory that stores the table contents of views explicitly.
         Relies on included theories to define the contents of those
         tables not defined by the rules of the theory.
-        Recursive rules are allowed. """
-
-    def __init__(self, name=None, abbr=None):
+        Recursive rules are allowed.
+        SUPPORT controls what is stored for each derived tuple so that
+        deletions are handled correctly.  PROOF_SUPPORT (the default)
+        stores every proof.  COUNTING_SUPPORT stores only the number
+        of proofs and rebuilds proofs when explaining; it rejects
+        recursive rules.  DRED_SUPPORT stores no proofs at all:
+        deletions over-delete every tuple with a proof that used a
+        deleted tuple and then rederive those still provable with a
+        top-down check (delete and rederive).
+        If BATCH is True, consecutive queued events that insert (or
+        delete) tuples into the same table are propagated together,
+        evaluating each delta rule once for all of them. """
+    PROOF_SUPPORT = 'PROOF_SUPPORT'
+    COUNTING_SUPPORT = 'COUNTING_SUPPORT'
+    DRED_SUPPORT = 'DRED_SUPPORT'
+
+    def __init__(self, name=None, abbr=None, support=None, symbols=None,
+                 batch=False, optimize=False, compiled=False):
         super(MaterializedViewTheory, self).__init__(name=name, abbr=abbr)
+        if support is None:
+            support = self.PROOF_SUPPORT
+        assert support in [self.PROOF_SUPPORT, self.COUNTING_SUPPORT,
+                           self.DRED_SUPPORT], \
+            "Unknown support {}".format(support)
+        self.support = support
+        self.batch = batch
+        if compiled:
+            self.compiler = RuleCompiler()
         # queue of events left to process
         self.queue = EventQueue()
         # data storage
@@ -1199,9 +3055,12 @@ class MaterializedViewTheory(TopDownTheory):
         if abbr is not None:
             db_abbr = abbr + "DB"
             delta_abbr = abbr + "Dlta"
-        self.database = Database(name=db_name, abbr=db_abbr)
+        self.database = Database(name=db_name, abbr=db_abbr,
+            counting=(support == self.COUNTING_SUPPORT), symbols=symbols)
         # rules that dictate how database changes in response to events
         self.delta_rules = DeltaRuleTheory(name=delta_name, abbr=delta_abbr)
+        if optimize:
+            self.delta_rules.optimizer = RuleOptimizer(self.table_cardinality)
 
     def set_tracer(self, tracer):
         self.tracer = tracer
@@ -1254,7 +3113,7 @@ class MaterializedViewTheory(TopDownTheory):
         if query.is_negated():
             return Proof(query, [])
         # grab first local proof, since they're all equally good
-        localproofs = self.database.explain(query)
+        localproofs = self.local_proofs(query, find_all=False)
         if localproofs is None:
             return None
         if len(localproofs) == 0:   # base fact
@@ -1269,6 +3128,74 @@ class MaterializedViewTheory(TopDownTheory):
             subproofs.append(subproof)
         return Proof(query, subproofs)
 
+    def local_proofs(self, atom, find_all=True):
+        """ Returns a ProofCollection of the proofs of the ground ATOM
+            using the rules of this theory, or None if ATOM is not in
+            the database.  The collection is empty if ATOM was inserted
+            without proofs.  If FIND_ALL is False, and the proofs
+            must be rebuilt, at most 1 proof is rebuilt. """
+        if self.support == self.PROOF_SUPPORT:
+            return self.database.explain(atom)
+        if not atom.is_ground():
+            return Database.ProofCollection([])
+        if self.support == self.COUNTING_SUPPORT:
+            count = self.database.derivation_count(atom)
+            if count is None:
+                return None
+            if count == 0:
+                return Database.ProofCollection([])
+        else:
+            if not self.database.contains(atom.table,
+                                          tuple(atom.argument_names())):
+                return None
+            if not self.is_view(atom.table):
+                return Database.ProofCollection([])
+        return Database.ProofCollection(
+            self.rederive_proofs(atom, find_all=find_all))
+
+    def rederive_proofs(self, atom, find_all=True):
+        """ Returns a list of the Database.Proofs of the ground ATOM
+            using the rules of this theory, computed from scratch.
+            If FIND_ALL is False, returns at most 1 proof. """
+        proofs = []
+        for rule in self.delta_rules.originals:
+            if rule.head.table != atom.table:
+                continue
+            unifier = self.new_bi_unifier()
+            undo = self.bi_unify(rule.head, unifier,
+                atom, self.new_bi_unifier())
+            if undo is None:
+                continue
+            bindings = self.top_down_evaluation(rule.variables(), rule.body,
+                binding=unifier, find_all=find_all)
+            proofs.extend(Database.Proof(binding, rule) for binding in bindings)
+            unify.undo_all(undo)
+            if len(proofs) > 0 and not find_all:
+                break
+        return proofs
+
+    def is_derivable(self, atom):
+        """ Returns True iff some rule of this theory proves the ground
+            ATOM from the current contents of the database.  The bodies
+            are evaluated against SELF.DATABASE alone, which holds the
+            views of this theory as well as the tuples of the tables
+            they are computed from, so that negated views are checked
+            against their materialized contents. """
+        for rule in self.delta_rules.originals:
+            if rule.head.table != atom.table:
+                continue
+            unifier = self.new_bi_unifier()
+            undo = self.bi_unify(rule.head, unifier,
+                atom, self.new_bi_unifier())
+            if undo is None:
+                continue
+            found = self.database.top_down_exists(rule.body,
+                                                  binding=unifier)
+            unify.undo_all(undo)
+            if found:
+                return True
+        return False
+
     def modify(self, formula, is_insert=True):
         """ Modifies contents of theory to insert/delete FORMULA.
             Returns True iff the theory changed. """
@@ -1279,6 +3206,233 @@ class MaterializedViewTheory(TopDownTheory):
             "modify returns {}".format(iterstr(changes)))
         return changes
 
+    def bulk_modify(self, formulas, is_insert=True):
+        """ Modifies contents of theory to insert/delete each of FORMULAS,
+            e.g. when loading the initial policy and data.  Insertions
+            are handled by BULK_INSERT.  Otherwise the atoms
+            are pushed to the included theories all at once and
+            propagated with a single pass over the queue; then the
+            rules are processed one at a time, which requires only
+            one top-down evaluation per rule over all the data.
+            Returns the list of changes. """
+        self.log(None, "Materialized.bulk_modify")
+        atoms = [formula for formula in formulas if formula.is_atom()]
+        rules = [formula for formula in formulas if not formula.is_atom()]
+        if is_insert and self.support != self.COUNTING_SUPPORT:
+            return self.bulk_insert(atoms, rules)
+        if self.support == self.COUNTING_SUPPORT:
+            # Propagating an event sees all the atoms, so a batch counts
+            #   a proof once for each of its atoms in the batch.
+            changes = []
+            for atom in atoms:
+                changes.extend(self.modify(atom, is_insert=is_insert))
+        else:
+            for atom in atoms:
+                assert not self.is_view(atom.table), \
+                    "Cannot directly modify tables computed from other tables"
+            for theory in self.includes:
+                for change in theory.bulk_modify(atoms, is_insert=is_insert):
+                    self.enqueue(change)
+            changes = self.process_queue()
+        for rule in rules:
+            changes.extend(self.modify(rule, is_insert=is_insert))
+        return changes
+
+    def update(self, events):
+        """ Inserts/deletes the formula of each of EVENTS, e.g. the
+            updates of a transaction, the atoms before the rules.  Each
+            is propagated as MODIFY does, against the state left by the
+            ones before it, and the changes that undo one another are
+            then cancelled out, so that the list of changes returned
+            only describes the final state. """
+        self.log(None, "Materialized.update")
+        changes = []
+        for event in ([event for event in events if event.formula.is_atom()] +
+                      [event for event in events
+                       if not event.formula.is_atom()]):
+            changes.extend(self.modify(event.formula,
+                                       is_insert=event.is_insert()))
+        return self.net_changes(changes)
+
+    def bulk_insert(self, atoms, rules):
+        """ Inserts ATOMS and RULES and then computes the views from
+            scratch with RECOMPUTE_VIEWS, instead of pushing each new
+            tuple through the delta rules.  Falls back to
+            propagating the changes if the rules are recursive
+            through negation.  Returns the list of changes. """
+        for atom in atoms:
+            assert not self.is_view(atom.table), \
+                "Cannot directly modify tables computed from other tables"
+        dependencies = graph.DependencyGraph(
+            list(self.delta_rules.originals) + rules)
+        if not dependencies.is_stratified():
+            for theory in self.includes:
+                for change in theory.bulk_modify(atoms, is_insert=True):
+                    self.enqueue(change)
+            changes = self.process_queue()
+            for rule in rules:
+                changes.extend(self.modify(rule, is_insert=True))
+            return changes
+        changes = []
+        for theory in self.includes:
+            for change in theory.bulk_modify(atoms, is_insert=True):
+                changes.extend(self.database.modify(change.formula,
+                    is_insert=change.is_insert(), proofs=change.proofs))
+        for rule in rules:
+            changes.extend(self.delta_rules.modify(rule, is_insert=True))
+        changes.extend(self.recompute_views())
+        return changes
+
+    def recompute_views(self):
+        """ Computes the contents of all the views bottom-up, from
+            scratch.  The strongly connected components of the rules
+            are evaluated in dependency order, and recursive components
+            are iterated to a fixpoint semi-naively: each iteration
+            only finds the bindings that use a tuple derived by the
+            previous one.  Returns the list of Events that turn the
+            old contents of the views into the new ones. """
+        rules = self.delta_rules.originals
+        old = {}
+        for table in set(rule.head.table for rule in rules):
+            old[table] = self.database.remove_table(table)
+        for component in self.delta_rules.graph.components():
+            self.evaluate_component(component,
+                [rule for rule in rules if rule.head.table in component])
+        changes = []
+        for table, rows in old.iteritems():
+            changes.extend(self.view_changes(table, rows))
+        return changes
+
+    def evaluate_component(self, tables, rules):
+        """ Inserts into the database all the tuples of TABLES, a
+            strongly connected component, derived by RULES, assuming
+            the tables those rules depend on outside of TABLES are
+            complete. """
+        self.log(None, "Evaluating component {}".format(iterstr(tables)))
+        recursive = any(literal.table in tables
+                        for rule in rules for literal in rule.body)
+        # answers of the literals over tables outside the component,
+        #   which do not change while evaluating it
+        answers = {}
+        delta = self.evaluate_iteration(tables, rules, None, answers)
+        while recursive and len(delta) > 0:
+            delta = self.evaluate_iteration(tables, rules, delta, answers)
+
+    def evaluate_iteration(self, tables, rules, delta, answers):
+        """ Evaluates RULES once, inserting the tuples they derive.
+            If DELTA, a dictionary from table name to the atoms
+            first derived for that table by the previous iteration,
+            is not None, only finds the bindings for which some
+            positive literal over TABLES matches an atom of DELTA.
+            ANSWERS caches the answers of literals over tables
+            outside of TABLES.  Returns the dictionary of atoms that
+            were new. """
+        new_atoms = {}
+        for rule in rules:
+            variables = rule.variables()
+            for binding in self.evaluate_rule(rule, tables, delta, answers):
+                binding = dict((var, binding.get(var, var))
+                               for var in variables)
+                atom = rule.head.plug(binding)
+                if atom not in new_atoms:
+                    new_atoms[atom] = []
+                new_atoms[atom].append(Database.Proof(binding, rule))
+        delta = {}
+        for atom, proofs in new_atoms.iteritems():
+            if not self.database.contains(atom.table,
+                                          tuple(atom.argument_names())):
+                if atom.table not in delta:
+                    delta[atom.table] = []
+                delta[atom.table].append(atom)
+            if self.support == self.DRED_SUPPORT:
+                proofs = None
+            self.database.insert(atom, proofs=proofs)
+        return delta
+
+    def evaluate_rule(self, rule, tables, delta, answers):
+        """ Returns the list of dictionary bindings that make the body
+            of RULE true, restricted by DELTA as in EVALUATE_ITERATION. """
+        if delta is None:
+            return self.join_body([{}], set(), rule.body, tables, answers)
+        bindings = []
+        for literal in rule.body:
+            if literal.is_negated() or literal.table not in delta:
+                continue
+            start = []
+            for atom in delta[literal.table]:
+                binding = self.new_bi_unifier()
+                undo = self.bi_unify(literal, binding, atom,
+                                     self.new_bi_unifier())
+                if undo is None:
+                    continue
+                start.append(dict((var, binding.apply(var))
+                                  for var in literal.variables()))
+            rest = [lit for lit in rule.body if lit is not literal]
+            bindings.extend(self.join_body(start, literal.variables(), rest,
+                                           tables, answers))
+        return bindings
+
+    def join_body(self, bindings, bound, literals, tables, answers):
+        """ Returns the result of joining the dictionary BINDINGS,
+            each binding the set of variables BOUND, with LITERALS.
+            Negated literals are joined after all the others, so
+            that their variables are bound. """
+        bound = set(bound)
+        literals = ([lit for lit in literals if not lit.is_negated()] +
+                    [lit for lit in literals if lit.is_negated()])
+        for literal in literals:
+            if len(bindings) == 0:
+                break
+            if literal.is_negated():
+                positive = literal.complement()
+            else:
+                positive = literal
+            if positive.table in tables:
+                results = None
+            else:
+                if positive not in answers:
+                    answers[positive] = self.top_down_evaluation(
+                        positive.variables(), [positive])
+                results = answers[positive]
+            bindings = self.join_literal(bindings, bound, literal,
+                                         answers=results)
+            if not literal.is_negated():
+                bound |= literal.variables()
+        return bindings
+
+    def view_changes(self, table, old_rows):
+        """ Returns the list of Events that turn OLD_ROWS, the old
+            rows of the view TABLE (or None), into its current rows. """
+        if old_rows is None:
+            old_rows = {}
+        new_rows = self.database.data.get(table, {})
+        if self.support == self.DRED_SUPPORT:
+            # without proofs, only whether each tuple is true can change
+            return ([Event(formula=compile.Atom.create_from_table_tuple(
+                        table, raw_tuple), insert=True)
+                     for raw_tuple in new_rows
+                     if raw_tuple not in old_rows] +
+                    [Event(formula=compile.Atom.create_from_table_tuple(
+                        table, raw_tuple), insert=False)
+                     for raw_tuple in old_rows
+                     if raw_tuple not in new_rows])
+        changes = []
+        for raw_tuple, dbtuple in new_rows.iteritems():
+            proofs = dbtuple.proofs.contents
+            if raw_tuple in old_rows:
+                proofs = proofs - old_rows[raw_tuple].proofs.contents
+            if len(proofs) > 0:
+                changes.append(Event(formula=compile.Atom.create_from_table_tuple(
+                    table, raw_tuple), insert=True, proofs=list(proofs)))
+        for raw_tuple, dbtuple in old_rows.iteritems():
+            proofs = dbtuple.proofs.contents
+            if raw_tuple in new_rows:
+                proofs = proofs - new_rows[raw_tuple].proofs.contents
+            if len(proofs) > 0:
+                changes.append(Event(formula=compile.Atom.create_from_table_tuple(
+                    table, raw_tuple), insert=False, proofs=list(proofs)))
+        return changes
+
     def enqueue_with_included(self, formula, is_insert=True):
         """ Insertion/deletion of FORMULA can require communication
             with included theories.  Also, rules are a bit different
@@ -1306,30 +3460,39 @@ class MaterializedViewTheory(TopDownTheory):
                     self.enqueue(change)
             return []
         else:
+            assert not (self.support == self.COUNTING_SUPPORT and is_insert
+                        and self.is_recursive(formula)), \
+                "Counting support requires non-recursive rules"
             # rules do not need to talk to included theories because they
             #   only generate events for views
-            # need to eliminate self-joins here so that we fill all
-            #   the tables introduced by self-join elimination.
-            for rule in DeltaRuleTheory.eliminate_self_joins([formula]):
-                bindings = self.top_down_evaluation(
-                    rule.variables(), rule.body)
-                self.log(rule.tablename(),
-                    "new bindings after top-down: " + iterstr(bindings))
-                event = Event(formula=rule, insert=is_insert)
-                if is_insert:
-                    # insert rule and then process data so that
-                    #   we know that data is for a view
-                    self.enqueue(event)
-                    self.process_new_bindings(bindings, rule.head,
-                        is_insert, rule)
-                else:
-                    # process data and then delete the rule so
-                    #   that we know that data is for a view
-                    self.process_new_bindings(bindings, rule.head,
-                        is_insert, rule)
-                    self.enqueue(event)
+            bindings = self.top_down_evaluation(
+                formula.variables(), formula.body)
+            self.log(formula.tablename(),
+                "new bindings after top-down: " + iterstr(bindings))
+            event = Event(formula=formula, insert=is_insert)
+            if is_insert:
+                # insert rule and then process data so that
+                #   we know that data is for a view
+                self.enqueue(event)
+                self.process_new_bindings(bindings, formula.head,
+                    is_insert, formula)
+            else:
+                # process data and then delete the rule so
+                #   that we know that data is for a view
+                self.process_new_bindings(bindings, formula.head,
+                    is_insert, formula)
+                self.enqueue(event)
             return []
 
+    def is_recursive(self, rule):
+        """ Returns True iff the head table of RULE would be computed
+            from itself by RULE and the rules of this theory. """
+        for literal in rule.body:
+            if (literal.table == rule.head.table or rule.head.table in
+                    self.delta_rules.graph.dependencies(literal.table)):
+                return True
+        return False
+
     def enqueue(self, event):
         if event.is_insert():
             text = "Adding Insert to queue"
@@ -1343,30 +3506,294 @@ class MaterializedViewTheory(TopDownTheory):
             Returns list of events that were not noops """
         self.log(None, "Processing queue")
         history = []
-        while len(self.queue) > 0:
-            event = self.queue.dequeue()
-            self.log(event.tablename(), "Dequeued " + str(event))
+        # views deleted since the last rederivation (DRED_SUPPORT)
+        overdeleted = []
+        while len(self.queue) > 0 or len(overdeleted) > 0:
+            if len(self.queue) == 0:
+                self.rederive(overdeleted)
+                overdeleted = []
+                continue
+            # Propagating a batch of events for one table is the same as
+            #   propagating them one at a time since delta rules
+            #   triggered by a table with that table in their body
+            #   evaluate it with and without the whole batch.
+            if self.batch:
+                events = self.queue.dequeue_batch()
+            else:
+                events = [self.queue.dequeue()]
+            event = events[0]
+            self.log(event.tablename(), "Dequeued " + iterstr(events))
             if isinstance(event.formula, compile.Rule):
                 history.extend(self.delta_rules.modify(event.formula,
                     is_insert=event.is_insert()))
+            elif self.support == self.COUNTING_SUPPORT:
+                # Only propagate changes to whether a tuple is true.
+                #   Tables that are not views here are base tables
+                #   for this theory, regardless of their proofs.
+                is_view = self.is_view(event.formula.table)
+                changes = []
+                for event in events:
+                    if is_view:
+                        proofs = event.proofs
+                    else:
+                        proofs = None
+                    changes.extend(self.database.modify(event.formula,
+                        is_insert=event.is_insert(), proofs=proofs))
+                self.propagate_batch(changes)
+                history.extend(changes)
+            elif self.support == self.DRED_SUPPORT:
+                # Only propagate changes to whether a tuple is true,
+                #   so a deletion over-deletes the tuples it was used
+                #   to prove, whether or not they have other proofs.
+                changes = []
+                for event in events:
+                    changes.extend(self.database.modify(event.formula,
+                        is_insert=event.is_insert()))
+                self.propagate_batch(changes)
+                if self.is_view(event.formula.table):
+                    overdeleted.extend(change.formula for change in changes
+                                       if not change.is_insert())
+                history.extend(changes)
             else:
-                self.propagate(event)
+                self.propagate_batch(events)
                 # if self.is_view(event.formula.table):
-                history.extend(self.database.modify(event.formula,
-                    is_insert=event.is_insert(), proofs=event.proofs))
+                for event in events:
+                    history.extend(self.database.modify(event.formula,
+                        is_insert=event.is_insert(), proofs=event.proofs))
             self.log(event.tablename(), "History: " + iterstr(history))
+        if self.support == self.DRED_SUPPORT:
+            history = self.net_changes(history)
         return history
 
+    def rederive(self, atoms):
+        """ Enqueues the insertion of each of ATOMS, over-deleted view
+            tuples, that is still proven by the current contents of
+            the database.  Tuples only proven by other over-deleted
+            tuples are rederived by propagating those insertions. """
+        self.log(None, "Rederiving " + iterstr(atoms))
+        for atom in atoms:
+            if (not self.database.contains(atom.table,
+                                           tuple(atom.argument_names()))
+                    and self.is_derivable(atom)):
+                self.enqueue(Event(formula=atom, insert=True))
+
+    def net_changes(self, history):
+        """ Returns HISTORY, a list of changes (and of the rules
+            inserted and deleted), without the changes that undo one
+            another, e.g. tuples over-deleted and then rederived, or
+            inserted and then deleted by a transaction.  Each tuple
+            keeps at most a deletion of the proofs it lost and an
+            insertion of those it gained, in place of its last change.
+            Without PROOF_SUPPORT, and for tuples without proofs, the
+            changes are to whether the tuple is true. """
+        # dictionaries from atom to the sets of proofs it gained and
+        #   lost, where None stands for the tuple itself, and to the
+        #   index in HISTORY of its last change
+        gained = {}
+        lost = {}
+        last = {}
+        for index, event in enumerate(history):
+            if not isinstance(event, Event):
+                continue
+            atom = event.formula
+            if self.support == self.PROOF_SUPPORT and len(event.proofs) > 0:
+                proofs = set(event.proofs)
+            else:
+                proofs = [None]
+            if atom not in last:
+                gained[atom] = set()
+                lost[atom] = set()
+            if event.is_insert():
+                undone, done = lost[atom], gained[atom]
+            else:
+                undone, done = gained[atom], lost[atom]
+            for proof in proofs:
+                if proof in undone:
+                    undone.discard(proof)
+                else:
+                    done.add(proof)
+            last[atom] = index
+        results = []
+        for index, event in enumerate(history):
+            if not isinstance(event, Event):
+                results.append(event)
+                continue
+            atom = event.formula
+            if last[atom] != index:
+                continue
+            if self.support != self.PROOF_SUPPORT:
+                # changes to whether a tuple is true alternate
+                if len(gained[atom]) > 0 or len(lost[atom]) > 0:
+                    results.append(event)
+                continue
+            for is_insert, proofs in [(False, lost[atom]),
+                                      (True, gained[atom])]:
+                if len(proofs) > 0:
+                    results.append(Event(formula=atom, insert=is_insert,
+                        proofs=[proof for proof in proofs
+                                if proof is not None]))
+        return results
+
     def propagate(self, event):
         """ Computes events generated by EVENT and the DELTA_RULES,
             and enqueues them. """
         self.log(event.formula.table, "Processing event: {}".format(str(event)))
-        applicable_rules = self.delta_rules.rules_with_trigger(event.formula.table)
+        applicable_rules = self.delta_rules.rules_with_trigger(
+            event.formula.table, event.formula)
         if len(applicable_rules) == 0:
             self.log(event.formula.table, "No applicable delta rule")
         for delta_rule in applicable_rules:
             self.propagate_rule(event, delta_rule)
 
+    def propagate_batch(self, events):
+        """ Computes and enqueues the events generated by EVENTS, which
+            all insert (or all delete) tuples into the same table,
+            and the DELTA_RULES. """
+        if len(events) == 0:
+            return
+        if len(events) == 1:
+            self.propagate(events[0])
+            return
+        table = events[0].formula.table
+        self.log(table, "Processing batch of {} events".format(len(events)))
+        # dictionary from the id of each delta rule to the pair of that
+        #   rule and the events it is triggered by
+        matches = collections.OrderedDict()
+        for event in events:
+            for delta_rule in self.delta_rules.rules_with_trigger(
+                    table, event.formula):
+                if id(delta_rule) not in matches:
+                    matches[id(delta_rule)] = (delta_rule, [])
+                matches[id(delta_rule)][1].append(event)
+        for delta_rule, matching in matches.itervalues():
+            self.propagate_rule_batch(matching, delta_rule, changed=events)
+
+    def propagate_rule_batch(self, events, delta_rule, changed=None):
+        """ Compute and enqueue new events generated by EVENTS and
+            DELTA_RULE, evaluating the body of DELTA_RULE once for all
+            of EVENTS.  Generates the same events as PROPAGATE_RULE
+            applied to each of EVENTS.  CHANGED is the list of all the
+            events propagated together for the trigger's table (by
+            default EVENTS); the literals of the body over that table
+            are evaluated as in SELF_JOIN_ANSWERS.  EVENTS must all
+            insert or all delete tuples. """
+        assert all(event.is_insert() == events[0].is_insert()
+                   for event in events), \
+            "Batched events must all be inserts or all be deletes"
+        if changed is None:
+            changed = events
+        # bindings of the trigger's variables, one per matching event
+        bindings = []
+        for event in events:
+            binding = self.new_bi_unifier()
+            undo = self.bi_unify(delta_rule.trigger, binding,
+                                 event.formula, self.new_bi_unifier())
+            if undo is None:
+                continue
+            bindings.append(dict((var, binding.apply(var))
+                for var in delta_rule.trigger.variables()))
+        self.log(delta_rule.trigger.table,
+            "{} bindings for batch and delta-rule trigger {}".format(
+                len(bindings), str(delta_rule.trigger)))
+        bound = delta_rule.trigger.variables()
+        for literal in delta_rule.body:
+            if len(bindings) == 0:
+                break
+            if literal.table == delta_rule.trigger.table:
+                answers = self.self_join_answers(literal, delta_rule,
+                    changed, bindings, bound)
+            else:
+                answers = None
+            bindings = self.join_literal(bindings, bound, literal,
+                                         answers=answers)
+            if not literal.is_negated():
+                bound |= literal.variables()
+        # give each binding the variables bindings from top-down have
+        variables = delta_rule.variables()
+        bindings = [dict((var, binding.get(var, var)) for var in variables)
+                    for binding in bindings]
+        if delta_rule.trigger.is_negated():
+            insert_delete = not events[0].insert
+        else:
+            insert_delete = events[0].insert
+        self.process_new_bindings(bindings, delta_rule.head,
+            insert_delete, delta_rule.original)
+
+    def self_join_answers(self, literal, delta_rule, events, bindings,
+                          bound):
+        """ Returns the bindings of the variables of LITERAL, a body
+            literal of DELTA_RULE over the table changed by EVENTS, for
+            the tuples of that table without the tuples of EVENTS if
+            LITERAL comes before the trigger in the original rule, and
+            with them otherwise.  Then a binding of the original rule
+            that uses tuples of EVENTS in several literals is found
+            only by the delta rule for the first of them, whether or
+            not the database already reflects EVENTS.  If there is
+            only one of the dictionary BINDINGS of the variables BOUND
+            to join LITERAL with, only the tuples matching it are
+            looked up. """
+        if literal.is_negated():
+            positive = literal.complement()
+        else:
+            positive = literal
+        known = {}
+        if len(bindings) == 1:
+            known = dict((var, bindings[0][var])
+                         for var in positive.variables() if var in bound)
+        query = positive.plug(known)
+        atoms = set(event.formula for event in events)
+        answers = []
+        for answer in self.top_down_evaluation(query.variables(), [query]):
+            answer.update(known)
+            if positive.plug(answer) not in atoms:
+                answers.append(answer)
+        if delta_rule.is_earlier(literal):
+            return answers
+        for atom in atoms:
+            binding = self.new_bi_unifier()
+            undo = self.bi_unify(positive, binding, atom,
+                                 self.new_bi_unifier())
+            if undo is None:
+                continue
+            answers.append(dict((var, binding.apply(var))
+                                for var in positive.variables()))
+        return answers
+
+    def join_literal(self, bindings, bound, literal, answers=None):
+        """ Returns the result of joining the list of dictionary
+            BINDINGS, each binding the set of variables BOUND,
+            with the tuples of LITERAL (or, if LITERAL is negated,
+            those of BINDINGS with no matching tuple).  Computes the
+            tuples of LITERAL once, unless given as the bindings
+            ANSWERS of its variables, and hashes them on the variables
+            they share with BINDINGS. """
+        if literal.is_negated():
+            positive = literal.complement()
+        else:
+            positive = literal
+        shared = [var for var in positive.variables() if var in bound]
+        if answers is None:
+            answers = self.top_down_evaluation(positive.variables(),
+                                               [positive])
+        table = {}
+        for answer in answers:
+            key = tuple([answer[var] for var in shared])
+            if key not in table:
+                table[key] = []
+            table[key].append(answer)
+        results = []
+        for binding in bindings:
+            key = tuple([binding[var] for var in shared])
+            if literal.is_negated():
+                if key not in table:
+                    results.append(binding)
+                continue
+            for answer in table.get(key, []):
+                result = dict(binding)
+                result.update(answer)
+                results.append(result)
+        return results
+
     def propagate_rule(self, event, delta_rule):
         """ Compute and enqueue new events generated by EVENT and DELTA_RULE. """
         self.log(event.formula.table, "Processing event {} with rule {}".format(
@@ -1377,6 +3804,20 @@ class MaterializedViewTheory(TopDownTheory):
         #     str(event), str(event.tuple), str(event.tuple.raw_tuple()))
         # binding_list is dictionary
 
+        if delta_rule.is_self_join():
+            self.propagate_rule_batch([event], delta_rule)
+            return
+
+        if self.compiler is not None:
+            bindings = self.compiled_evaluation(
+                self.compiler.compile_delta(delta_rule),
+                list(delta_rule.variables()), event.formula.argument_names())
+            if bindings is not None:
+                self.process_new_bindings(bindings, delta_rule.head,
+                    event.insert != delta_rule.trigger.is_negated(),
+                    delta_rule.original)
+                return
+
         # Save binding for delta_rule.trigger; throw away binding for event
         #   since event is ground.
         binding = self.new_bi_unifier()
@@ -1407,6 +3848,19 @@ class MaterializedViewTheory(TopDownTheory):
         # for each binding, compute generated tuple and group bindings
         #    by the tuple they generated
         new_atoms = {}
+        if self.support == self.COUNTING_SUPPORT:
+            # only the number of distinct bindings for each tuple matters
+            distinct = set(frozenset(binding.iteritems())
+                           for binding in bindings)
+            for binding in distinct:
+                new_atom = atom.plug(dict(binding))
+                new_atoms[new_atom] = new_atoms.get(new_atom, 0) + 1
+            bindings = []
+        elif self.support == self.DRED_SUPPORT:
+            # only the tuples matter
+            for binding in bindings:
+                new_atoms[atom.plug(binding)] = None
+            bindings = []
         for binding in bindings:
             new_atom = atom.plug(binding)
             if new_atom not in new_atoms:
@@ -1425,18 +3879,33 @@ class MaterializedViewTheory(TopDownTheory):
                                 proofs=new_atoms[new_atom],
                                 insert=insert))
 
+    def select_on_demand(self, query):
+        """ Returns the list of instances of the atom QUERY that are
+            true, recomputed from the rules relevant to QUERY instead of
+            read from the materialized views. """
+        return self.demand_evaluation(self.delta_rules.originals, query)
+
     def is_view(self, x):
         return self.delta_rules.is_view(x)
 
     def is_known(self, x):
         return self.delta_rules.is_known(x)
 
+    def body_tables(self, table):
+        return self.delta_rules.body_tables(table)
+
     def base_tables(self):
         return self.delta_rules.base_tables()
 
     def top_down_th(self, context, caller):
         return self.database.top_down_th(context, caller)
 
+    def top_down_choices(self, lit, binding):
+        return self.database.top_down_choices(lit, binding)
+
+    def cardinality(self, table):
+        return self.database.cardinality(table)
+
     def content(self):
         return self.database.content()
 
@@ -1500,25 +3969,45 @@ class Runtime (object):
     ENFORCEMENT_THEORY = "enforcement"
     DATABASE = "database"
 
-    def __init__(self):
-
+    def __init__(self, support=None, columnar=False, batch=False,
+                 optimize=False, compiled=False, processes=None):
+        """ SUPPORT is the MaterializedViewTheory support mode used
+            for the classification and enforcement theories, and
+            BATCH says whether they propagate events in batches.
+            If COLUMNAR is True, external data is stored in
+            Database.ColumnarTables.  If OPTIMIZE is True, rule bodies
+            are reordered using the cardinalities of the tables, and
+            if COMPILED is True, they are compiled into Python functions
+            for propagating changes.  If PROCESSES is greater than 1,
+            the consequences of actions are computed by that many
+            processes in parallel when projecting or simulating. """
         # tracer object
         self.tracer = Tracer()
         # record execution
         self.logger = ExecutionLogger()
+        # values of constants, shared by all the theories' data
+        self.symbols = SymbolTable()
+        # results of select, disabled until given a size
+        self.select_cache = SelectCache()
+        # the Transaction buffering updates, or None
+        self.current_transaction = None
         # collection of theories
         self.theory = {}
         # Representation of external data
-        self.theory[self.DATABASE] = Database(abbr="DB")
+        self.theory[self.DATABASE] = Database(abbr="DB", columnar=columnar,
+                                              symbols=self.symbols)
         # CLASSIFY_THEORY: the policy
         #  Allow negation for sure.  Currently supports recursion.
-        self.theory[self.CLASSIFY_THEORY] = MaterializedViewTheory(abbr='Clas')
+        self.theory[self.CLASSIFY_THEORY] = MaterializedViewTheory(
+            abbr='Clas', support=support, symbols=self.symbols, batch=batch,
+            optimize=optimize, compiled=compiled)
         self.theory[self.CLASSIFY_THEORY].includes.append(
             self.theory[self.DATABASE])
         # ENFORCEMENT_THEORY: describes what actions to take and when.
         #  An extension of the classification theory.
         self.theory[self.ENFORCEMENT_THEORY] = MaterializedViewTheory(
-            abbr='Enfor')
+            abbr='Enfor', support=support, symbols=self.symbols, batch=batch,
+            optimize=optimize, compiled=compiled)
         self.theory[self.ENFORCEMENT_THEORY].includes.append(
             self.theory[self.CLASSIFY_THEORY])
 
@@ -1535,7 +4024,9 @@ class Runtime (object):
         #    of rules or any other tables defined in ACTION_THEORY.
         #    Should throw warning if referencing table not appearing
         #    in either and provide special table False.
-        self.theory[self.ACTION_THEORY] = NonrecursiveRuleTheory(abbr='Act')
+        #  Queries are tabled so that recursive rules do terminate.
+        self.theory[self.ACTION_THEORY] = NonrecursiveRuleTheory(abbr='Act',
+            tabled=True, optimize=optimize, processes=processes)
         self.theory[self.ACTION_THEORY].includes.append(
             self.theory[self.CLASSIFY_THEORY])
         # SERVICE_THEORY: describes bindings for tables to real-world
@@ -1573,12 +4064,117 @@ class Runtime (object):
         tracer = Tracer()
         self.set_tracer(tracer)
 
+    def get_database(self, name):
+        """ Return the Database storing the tables of the theory NAME
+            or None if that theory does not store tables. """
+        theory = self.theory[name]
+        if isinstance(theory, Database):
+            return theory
+        if isinstance(theory, MaterializedViewTheory):
+            return theory.database
+        return None
+
+    def index_statistics(self, target=None):
+        """ Return a dictionary from theory name to the statistics about
+            table lookups and indexes for that theory's Database.
+            If TARGET is given, only includes that theory. """
+        if target is None:
+            names = self.theory.keys()
+        else:
+            names = [target]
+        stats = {}
+        for name in names:
+            database = self.get_database(name)
+            if database is not None:
+                stats[name] = database.index_statistics()
+        return stats
+
+    def set_index_budget(self, max_entries, target=None):
+        """ Bound the number of tuples held by the indexes of each
+            theory's Database to MAX_ENTRIES (None for no bound).
+            If TARGET is given, only changes that theory. """
+        if target is None:
+            names = self.theory.keys()
+        else:
+            names = [target]
+        for name in names:
+            database = self.get_database(name)
+            if database is not None:
+                database.set_index_budget(max_entries)
+
+    def set_select_cache_size(self, max_entries):
+        """ Cache the results of up to MAX_ENTRIES select queries (None
+            for no bound and 0 to disable the cache).  Only changes made
+            through the runtime invalidate cached results. """
+        self.select_cache.max_entries = max_entries
+        if not self.select_cache.enabled():
+            self.select_cache.clear()
+        while (max_entries is not None and
+               len(self.select_cache) > max_entries):
+            self.select_cache.remove(next(iter(self.select_cache.entries)))
+            self.select_cache.evictions += 1
+
+    def select_cache_statistics(self):
+        """ Return a dictionary describing the use of the select cache. """
+        return self.select_cache.statistics()
+
     ############### External interface ###############
     def load_file(self, filename, target=None):
         """ Compile the given FILENAME and insert each of the statements
             into the runtime. """
-        for formula in compile.parse_file(filename):
-            self.insert(formula, target=target)
+        self.bulk_insert(compile.parse_file(filename), target=target)
+
+    def bulk_insert(self, formulas, target=None):
+        """ Event handler for inserting many rules and facts at once,
+            e.g. the initial policy and data.  FORMULAS is an iterable
+            of strings, tuples, and formulas.  The facts are
+            inserted in one pass and the rules after them, and the
+            resulting changes are acted upon once.
+            Returns the list of changes. """
+        theory = self.get_target(target)
+        policy = []
+        for formula in formulas:
+            if isinstance(formula, basestring):
+                policy.extend(compile.parse(formula))
+            elif isinstance(formula, tuple):
+                policy.append(compile.Atom.create_from_iter(formula))
+            else:
+                policy.append(formula)
+        return self.bulk_insert_obj(policy, theory)
+
+    def replace_table(self, table, rows):
+        """ Event handler for a full snapshot of the external data of
+            TABLE.  ROWS is an iterable of tuples of values.  Only the
+            rows missing from the snapshot are deleted and the rows new
+            to it inserted, all in one transaction; rows already
+            stored cause no propagation.  Within a transaction, the
+            rows are those the table will hold once the updates already
+            buffered are committed.  Returns the list of changes (empty
+            if called within a transaction). """
+        database = self.theory[self.DATABASE]
+        rows = set(tuple(row) for row in rows)
+        transaction = self.transaction()
+        with transaction:
+            current = set(database.data.get(table, {}).iterkeys())
+            # data updates are buffered for the theory they are routed to
+            route = self.theory[self.ENFORCEMENT_THEORY]
+            for (theory, formula), event in transaction.updates.items():
+                if (theory is route and formula.is_atom() and
+                        formula.table == table):
+                    row = tuple([x.name for x in formula.arguments])
+                    if event.is_insert():
+                        current.add(row)
+                    else:
+                        current.discard(row)
+            for row in current:
+                if row not in rows:
+                    self.delete_obj(compile.Atom.create_from_table_tuple(
+                        table, row), database)
+            for row in rows:
+                if row not in current:
+                    self.insert_obj(compile.Atom.create_from_table_tuple(
+                        table, row), database)
+        return transaction.changes
 
     def select(self, query, target=None):
         """ Event handler for arbitrary queries. Returns the set of
@@ -1590,6 +4186,28 @@ class Runtime (object):
         else:
             return self.select_obj(query, self.get_target(target))
 
+    def exists(self, query, target=None):
+        """ Event handler for boolean queries.  Returns True iff some
+            instance of QUERY is true. """
+        if isinstance(query, basestring):
+            query = compile.parse1(query)
+        elif isinstance(query, tuple):
+            query = compile.Atom.create_from_iter(query)
+        return self.get_target(target).exists(query)
+
+    def select_on_demand(self, query, target=None):
+        """ Returns the instances of the atom QUERY computed bottom-up
+            from the rules of the target theory restricted to those
+            relevant to QUERY, e.g. to find the tables reachable from
+            one node without computing the reachability of all nodes. """
+        theory = self.get_target(target)
+        if isinstance(query, basestring):
+            return compile.formulas_to_string(
+                theory.select_on_demand(compile.parse1(query)))
+        elif isinstance(query, tuple):
+            query = compile.Atom.create_from_iter(query)
+        return theory.select_on_demand(query)
+
     def explain(self, query, tablenames=None, find_all=False, target=None):
         """ Event handler for explanations.  Given a ground query and
             a collection of tablenames that we want the explanation in
@@ -1623,6 +4241,18 @@ class Runtime (object):
         else:
             return self.delete_obj(formula, self.get_target(target))
 
+    def transaction(self):
+        """ Returns a Transaction to use in a WITH statement (the open
+            one, if any).  Inserts and deletes made within it are
+            buffered and take effect together when it ends: each theory
+            propagates them and cancels out the changes that undo one
+            another, and the runtime reacts to the resulting changes
+            once, so actions only see the final state.  Queries made
+            within it do not see its updates. """
+        if self.current_transaction is not None:
+            return self.current_transaction
+        return Transaction(self)
+
     def remediate(self, formula):
         """ Event handler for remediation. """
         if isinstance(formula, basestring):
@@ -1667,8 +4297,6 @@ class Runtime (object):
     # insert
     def insert_string(self, policy_string, theory):
         policy = compile.parse(policy_string)
-        # TODO: send entire parsed theory so that e.g. self-join elim
-        #    is more efficient.
         for formula in policy:
             #logging.debug("Parsed {}".format(str(formula)))
             self.insert_obj(formula, theory)
@@ -1676,12 +4304,40 @@ class Runtime (object):
     def insert_tuple(self, tuple, theory):
         self.insert_obj(compile.Atom.create_from_iter(tuple), theory)
 
+    def bulk_insert_obj(self, formulas, theory):
+        if self.current_transaction is not None:
+            for formula in formulas:
+                self.insert_obj(formula, theory)
+            return []
+        # group formulas by the theory they are routed to,
+        #   keeping the order of the theories
+        routes = collections.OrderedDict()
+        for formula in formulas:
+            route = self.compute_route(formula, theory, "insert")
+            if route not in routes:
+                routes[route] = []
+            routes[route].append(formula)
+        changes = []
+        for route, group in routes.iteritems():
+            if isinstance(route, (MaterializedViewTheory, Database)):
+                changes.extend(route.bulk_modify(group, is_insert=True))
+            else:
+                for formula in group:
+                    changes.extend(route.insert(formula))
+        self.invalidate_select_cache(changes)
+        self.react_to_changes(changes)
+        return changes
+
     def insert_obj(self, formula, theory):
         # reroute a data insert into classify theory as
         #   a data insert into enforcement theory.
         # Enforcement theory passes that insert into classify_theory.
         theory = self.compute_route(formula, theory, "insert")
+        if self.current_transaction is not None:
+            self.current_transaction.update(theory, formula, is_insert=True)
+            return []
         changes = theory.insert(formula)
+        self.invalidate_select_cache(changes)
         self.react_to_changes(changes)
         return changes
 
@@ -1696,7 +4352,32 @@ class Runtime (object):
 
     def delete_obj(self, formula, theory):
         theory = self.compute_route(formula, theory, "delete")
+        if self.current_transaction is not None:
+            self.current_transaction.update(theory, formula, is_insert=False)
+            return []
         changes = theory.delete(formula)
+        self.invalidate_select_cache(changes)
+        self.react_to_changes(changes)
+        return changes
+
+    def end_transaction(self, transaction, commit=True):
+        """ Stops buffering updates in TRANSACTION and, if COMMIT,
+            applies its updates.  Returns the list of changes. """
+        self.current_transaction = None
+        if not commit:
+            return []
+        changes = []
+        for theory, events in transaction.routes().iteritems():
+            if isinstance(theory, (MaterializedViewTheory, Database)):
+                changes.extend(theory.update(events))
+            else:
+                for event in events:
+                    if event.is_insert():
+                        changes.extend(theory.insert(event.formula))
+                    else:
+                        changes.extend(theory.delete(event.formula))
+        transaction.changes = changes
+        self.invalidate_select_cache(changes)
         self.react_to_changes(changes)
         return changes
 
@@ -1737,7 +4418,24 @@ class Runtime (object):
         return self.select_obj(compile.Atom.create_from_iter(tuple), theory)
 
     def select_obj(self, query, theory):
-        return theory.select(query)
+        if not self.select_cache.enabled():
+            return theory.select(query)
+        key = (theory.name, SelectCache.query_key(query))
+        entry = self.select_cache.get(key)
+        if entry is None:
+            results = theory.select(query)
+            if isinstance(query, compile.Rule):
+                tables = [lit.table for lit in query.body]
+            else:
+                tables = [query.table]
+            self.select_cache.put(key, (query, results),
+                theory.table_dependencies(tables))
+            renaming = {}
+        else:
+            cached_query, results = entry
+            renaming = SelectCache.renaming(cached_query, query)
+        # plugging copies the results, so callers cannot change the cache
+        return [result.plug(renaming) for result in results]
 
     # explain
     def explain_string(self, query_string, tablenames, find_all, theory):
@@ -1848,6 +4546,14 @@ class Runtime (object):
         # logging.debug("going to execute: " + iterstr(formulas))
         self.execute(formulas)
 
+    def invalidate_select_cache(self, changes):
+        """ Removes the cached results computed from the tables changed
+            by CHANGES, a list of Events and formulas. """
+        if len(self.select_cache) == 0:
+            return
+        self.select_cache.invalidate(
+            set(change.tablename() for change in changes))
+
     def compute_route(self, formula, theory, operation):
         """ When a formula is inserted/deleted (in OPERATION) into a THEORY,
             it may need to be rerouted to another theory.  This function
@@ -1961,6 +4667,7 @@ class Runtime (object):
             changed = clsth.insert(newdelta)
         else:
             changed = clsth.delete(newdelta)
+        self.invalidate_select_cache(changed)
         if changed:
             return delta.invert_update()
         else:
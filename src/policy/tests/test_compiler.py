@@ -13,9 +13,12 @@
 #    under the License.
 #
 
+import copy
+import pickle
 import unittest
 
 from policy import CongressParser
+from policy import compile
 
 
 class TestCompiler(unittest.TestCase):
@@ -26,6 +29,39 @@ class TestCompiler(unittest.TestCase):
     def test_foo(self):
         self.assertTrue("a" in "abc", "'a' is a substring of 'abc'")
 
+    def test_term_interning(self):
+        """ Test that terms are interned and hash consistently. """
+        self.assertTrue(compile.Variable('x') is compile.Variable('x'))
+        self.assertTrue(compile.Term.create_from_python("a") is
+                        compile.ObjectConstant("a", compile.ObjectConstant.STRING))
+        self.assertFalse(compile.Term.create_from_python(1) is
+                         compile.Term.create_from_python(1.0))
+        located = compile.Variable('x', location=compile.Location(line=1))
+        self.assertTrue(located is compile.Variable('x'))
+        atom1 = compile.parse1('p(x, "u", 1.5)')
+        atom2 = compile.parse1('q(x, "u", 1.5)')
+        for i in xrange(0, 3):
+            self.assertTrue(atom1.arguments[i] is atom2.arguments[i],
+                            "Parsed terms are interned")
+        const = compile.Term.create_from_python(17)
+        self.assertTrue(copy.deepcopy(const) is const)
+        self.assertTrue(pickle.loads(pickle.dumps(const)) is const)
+        self.assertRaises(AttributeError, setattr, const, 'foo', 1)
+
+    def test_formula_hashing(self):
+        """ Test that equal formulas parsed separately hash the same. """
+        rule1 = compile.parse1('p(x, "a") :- q(x, 1), not r(x)')
+        rule2 = compile.parse1('p(x, "a") :- q(x, 1), not r(x)')
+        self.assertEqual(rule1, rule2)
+        self.assertEqual(hash(rule1), hash(rule2))
+        self.assertEqual(len(set([rule1, rule2])), 1)
+        lit = rule1.body[1]
+        self.assertNotEqual(lit, lit.complement())
+        self.assertTrue(lit.complement().table == lit.table)
+        atom = rule1.head.plug({compile.Variable('x'): 3})
+        self.assertEqual(str(atom), 'p(3, "a")')
+        self.assertEqual(str(rule1.head), 'p(x, "a")')
+
 
 if __name__ == '__main__':
     unittest.main()
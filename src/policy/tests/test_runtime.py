@@ -15,6 +15,8 @@
 
 import unittest
 from policy import compile
+from policy import graph
+from policy import magic
 from policy import runtime
 from policy import unify
 from policy.runtime import Database
@@ -174,6 +176,197 @@ class TestRuntime(unittest.TestCase):
         self.delete(run, ['r', 1])
         self.check_db(run, "", "Delete from empty table")
 
+    def test_database_tuple_storage(self):
+        """ Test Database keyed tuple storage. """
+        db = Database()
+        for i in xrange(0, 100):
+            db.insert(compile.parse1('p({}, "a")'.format(i)))
+        self.assertEqual([x.tuple for x in db.head_index('p')],
+            [(i, "a") for i in xrange(0, 100)],
+            "Tuples iterate in insertion order")
+        db.insert(compile.parse1('p(17, "a")'))
+        self.assertEqual(len(db['p']), 100, "Duplicate insert")
+        db.delete(compile.parse1('p(17, "a")'))
+        db.delete(compile.parse1('p(17, "a")'))
+        self.assertEqual(len(db['p']), 99, "Delete")
+        self.assertTrue(db.explain(compile.parse1('p(17, "a")')) is None,
+            "Explain deleted tuple")
+        self.assertEqual(len(db.explain(compile.parse1('p(18, "a")'))), 0,
+            "Explain base tuple")
+        db.insert(compile.parse1('p(17, "a")'))
+        self.assertEqual(db.head_index('p')[-1].tuple, (17, "a"),
+            "Reinserted tuple iterates last")
+
+    def test_database_indexes(self):
+        """ Test Database column indexes used for top-down lookups. """
+        db = runtime.string_to_database(
+            'p(1, 2) p(1, 3) p(2, 3) p(3, 4) q(2) q(3)')
+        def check(query, correct, msg):
+            actual = compile.formulas_to_string(
+                db.select(compile.parse1(query)))
+            self.check_equal(actual, correct, msg)
+        check('p(1, x)', 'p(1, 2) p(1, 3)', "First column bound")
+        self.assertFalse('p' in db.indexes, "Index not built on first lookup")
+        check('p(1, x)', 'p(1, 2) p(1, 3)', "First column bound again")
+        self.assertTrue((0,) in db.indexes['p'], "Index built on demand")
+        check('p(x, 3)', 'p(1, 3) p(2, 3)', "Second column bound")
+        check('p(1, 3)', 'p(1, 3)', "Ground lookup")
+        check('p(1, 4)', '', "Ground lookup failure")
+        check('p(5, x)', '', "Index lookup failure")
+        check('r(x) :- q(x), p(x, y)',
+            'r(2) :- q(2), p(2, 3)  r(3) :- q(3), p(3, 4)', "Join")
+        db.insert(compile.parse1('p(1, 5)'))
+        db.delete(compile.parse1('p(1, 2)'))
+        check('p(1, x)', 'p(1, 3) p(1, 5)', "Index after insert/delete")
+        check('p(x, y)', 'p(1, 3) p(2, 3) p(3, 4) p(1, 5)', "No columns bound")
+
+    def test_database_columnar(self):
+        """ Test columnar storage of tables without proofs. """
+        run = runtime.Runtime(columnar=True)
+        run.debug_mode()
+        run.insert('q(x) :- p(x, y), not r(y)')
+        run.insert('p(1, "a") p(2, "b") p(3, "a") r("b")')
+        db = run.theory[run.DATABASE]
+        self.assertTrue(db.is_columnar('p'), "p is columnar")
+        self.check_class(run, 'p(1, "a") p(2, "b") p(3, "a") r("b") q(1) q(3)',
+            "Columnar: propagation")
+        self.check_equal(run.select('p(x, "a")'), 'p(1, "a") p(3, "a")',
+            "Columnar: scan with bound column")
+        self.check_equal(run.select('p(x, "c")'), '',
+            "Columnar: scan with unknown value")
+        for i in xrange(0, 2):
+            run.select('p(x, "a")')
+        self.assertEqual(db.table_indexes('p'), [(1,)], "Columnar: index")
+        run.delete('p(1, "a")')
+        run.insert('p(4, "a")')
+        self.check_equal(run.select('p(x, "a")'), 'p(3, "a") p(4, "a")',
+            "Columnar: index after insert/delete")
+        run.delete('r("b")')
+        self.check_class(run, 'p(2, "b") p(3, "a") p(4, "a") q(2) q(3) q(4)',
+            "Columnar: delete")
+        # deleting most rows compacts the table
+        run.delete('p(2, "b")')
+        run.delete('p(3, "a")')
+        self.assertEqual(len(db.data['p'].live), 1, "Columnar: compaction")
+        self.assertEqual([x.tuple for x in db.head_index('p')], [(4, "a")],
+            "Columnar: contents after compaction")
+        self.check_equal(run.select('p(x, "a")'), 'p(4, "a")',
+            "Columnar: index after compaction")
+        # tuples with proofs need row storage
+        db.insert(compile.parse1('p(5, "a")'),
+                  proofs=[Database.Proof({}, compile.parse1('p(5, "a")'))])
+        self.assertFalse(db.is_columnar('p'), "Columnar: converted to rows")
+        self.check_equal(run.select('p(x, "a")'), 'p(4, "a") p(5, "a")',
+            "Columnar: contents after conversion")
+
+    def test_symbol_table(self):
+        """ Test that the theories of a Runtime share one SymbolTable. """
+        run = runtime.Runtime(columnar=True)
+        run.insert('q(x) :- p(x, y)')
+        run.insert('p("vm1", "net1") r("net1", "vm1")')
+        db = run.theory[run.DATABASE]
+        classify_db = run.theory[run.CLASSIFY_THEORY].database
+        self.assertTrue(db.symbols is run.symbols)
+        self.assertTrue(classify_db.symbols is run.symbols)
+        self.assertEqual(db.data['p'].symbols.encode_tuple(("vm1", "net1")),
+                         db.data['r'].symbols.encode_tuple(("vm1", "net1")))
+        # row storage keeps the canonical copy of each value
+        value = ''.join(["vm", "1"])
+        classify_db.insert(compile.Atom('s', [compile.ObjectConstant(
+            value, compile.ObjectConstant.STRING)]))
+        stored = classify_db.head_index('s')[0].tuple[0]
+        self.assertFalse(stored is value)
+        self.assertTrue(stored is run.symbols.decode(
+            run.symbols.lookup("vm1")))
+        self.check_class(run, 'p("vm1", "net1") r("net1", "vm1") q("vm1") '
+            's("vm1")', "Symbols: decoded at the boundary")
+        # equal values of different types keep their types
+        for columnar in [False, True]:
+            run = runtime.Runtime(columnar=columnar)
+            run.insert('p(1)')
+            run.insert('q(1.0)')
+            self.check_equal(run.select('q(x)'), 'q(1.0)',
+                             "Symbols: type preserved")
+            self.check_equal(run.select('p(x)'), 'p(1)',
+                             "Symbols: type preserved")
+
+    def test_index_advisor(self):
+        """ Test index statistics and budget through Runtime. """
+        run = self.prep_runtime('')
+        run.insert('p(1, 2) p(1, 3) p(2, 3) q(1, 2) q(2, 3) q(3, 4)')
+        db = run.theory[run.DATABASE]
+        run.set_index_budget(3)
+        for i in xrange(0, 2):
+            run.select('p(1, x)')
+        self.assertEqual(db.indexes['p'].keys(), [(0,)], "Index on p")
+        # q is used more than p, and both do not fit the budget
+        for i in xrange(0, 3):
+            run.select('q(x, 3)')
+        self.assertEqual(db.indexes.keys(), ['q'], "Index on p dropped")
+        run.select('q(x, y)')
+        stats = run.index_statistics()[run.DATABASE]
+        self.assertEqual(stats['q']['lookups'], {(1,): 3, (): 1},
+            "Lookup statistics")
+        self.assertEqual(stats['q']['scans'], 3, "Scan statistics")
+        self.assertEqual(stats['q']['indexes'], [(1,)], "Index statistics")
+        self.assertEqual(stats['p']['indexes'], [], "Dropped index statistics")
+        self.assertEqual(stats['q']['tuples'], 3, "Tuple statistics")
+        # growing past the budget drops the index
+        run.insert('q(5, 6)')
+        self.assertEqual(db.indexes, {}, "Index dropped when over budget")
+        self.check_equal(run.select('q(x, 3)'), 'q(2, 3)', "Select after drop")
+
+    def test_select_cache(self):
+        """ Test caching of select results. """
+        run = self.prep_runtime('p(x) :- q(x), not r(x)  s(x) :- t(x)')
+        run.insert('q(1) q(2) r(2) t(5)')
+        run.set_select_cache_size(2)
+        self.check_equal(run.select('p(x)'), 'p(1)', "Cache: miss")
+        self.check_equal(run.select('p(x)'), 'p(1)', "Cache: hit")
+        stats = run.select_cache_statistics()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.check_equal(run.select('p(y)'), 'p(1)', "Cache: variant")
+        self.assertEqual(run.select_cache_statistics()['hits'], 2)
+        theory = run.theory[run.CLASSIFY_THEORY]
+        results = run.select_obj(compile.parse1('p(x)'), theory)
+        results[0].arguments[0] = compile.Term.create_from_python(7)
+        self.check_equal(run.select('p(x)'), 'p(1)', "Cache: copies")
+        self.check_equal(pol2str(run.select_obj(
+            compile.parse1('v(z, w) :- q(z)'), theory)),
+            'v(1, w) :- q(1)  v(2, w) :- q(2)', "Cache: rule")
+        self.check_equal(pol2str(run.select_obj(
+            compile.parse1('v(y, u) :- q(y)'), theory)),
+            'v(1, u) :- q(1)  v(2, u) :- q(2)', "Cache: renamed rule")
+        self.assertEqual(run.select_cache_statistics()['hits'], 5)
+        run.select('p(x)')
+        run.insert('t(6)')
+        self.check_equal(run.select('p(x)'), 'p(1)',
+            "Cache: hit after unrelated change")
+        self.assertEqual(run.select_cache_statistics()['hits'], 7)
+        run.insert('r(1)')
+        self.check_equal(run.select('p(x)'), '',
+            "Cache: invalidated by negated table")
+        run.delete('r(2)')
+        self.check_equal(run.select('p(x)'), 'p(2)',
+            "Cache: invalidated by delete")
+        self.check_equal(run.select('s(x)'), 's(5) s(6)', "Cache: view")
+        self.check_equal(run.select('t(x)'), 't(5) t(6)', "Cache: base")
+        stats = run.select_cache_statistics()
+        self.assertEqual((stats['entries'], stats['evictions']), (2, 2))
+        # rules in the action theory depend on the classification theory
+        th = run.ACTION_THEORY
+        run.insert('a(x) :- p(x), t(y)', target=th)
+        self.check_equal(run.select('a(x)', target=th), 'a(2)',
+            "Cache: included theory")
+        run.insert('q(3)')
+        self.check_equal(run.select('a(x)', target=th), 'a(2) a(3)',
+            "Cache: invalidated through included theory")
+        run.insert('a(x) :- s(x)', target=th)
+        self.check_equal(run.select('a(x)', target=th),
+            'a(2) a(3) a(5) a(6)', "Cache: invalidated by rule")
+        run.set_select_cache_size(0)
+        self.assertEqual(run.select_cache_statistics()['entries'], 0)
+
     def test_materialized_theory(self):
         """ Materialized Theory: test rule propagation """
         code = ("q(x) :- p(x), r(x)")
@@ -462,6 +655,14 @@ class TestRuntime(unittest.TestCase):
         self.check_class(run, 'q(1,2) r(2,3) r(2,4) u(3,5) u(4,6) s(1,3) s(1,4)',
             'Insert into non-unary with different propagation')
 
+        # Negated view whose support changes while events are queued
+        run = self.prep_runtime('p(x) :- q(x, y), not r(y) '
+            'w(x) :- q(x, y), r(y), not p(y)', "Negated view")
+        run.insert('q(1, 2) q(1, 1) r(1)')
+        run.delete('r(1)')
+        self.check_class(run, 'q(1, 2) q(1, 1) p(1)',
+            'Delete from table joined with negated view')
+
     def test_materialized_select(self):
         """ Materialized Theory: test the SELECT event handler. """
         code = ("p(x, y) :- q(x), r(y)")
@@ -518,6 +719,28 @@ class TestRuntime(unittest.TestCase):
                         'q(2,3) q(3,4) q(2,4) q(4,5) q(3,5) q(2,5)',
             'Delete from recursive rules')
 
+    def test_proof_collection(self):
+        """ Test set operations on proof collections. """
+        rule = compile.parse1('q(x) :- p(x, y)')
+        def proof(x, y):
+            return Database.Proof(
+                {compile.Variable('x'): compile.Term.create_from_python(x),
+                 compile.Variable('y'): compile.Term.create_from_python(y)},
+                rule)
+        self.assertEqual(proof(1, 2), proof(1, 2), "Equal proofs")
+        self.assertEqual(hash(proof(1, 2)), hash(proof(1, 2)), "Equal hashes")
+        self.assertNotEqual(proof(1, 2), proof(1, 3), "Unequal proofs")
+        pc = Database.ProofCollection([proof(1, 2), proof(1, 3)])
+        pc |= Database.ProofCollection([proof(1, 2), proof(1, 4)])
+        self.assertEqual(len(pc), 3, "Union")
+        self.assertTrue(pc >= [proof(1, 3), proof(1, 4)], "Superset")
+        self.assertTrue([proof(1, 3)] <= pc, "Subset of list")
+        self.assertFalse([proof(1, 5)] <= pc, "Not subset of list")
+        pc -= Database.ProofCollection([proof(1, 3), proof(1, 5)])
+        self.assertEqual(pc, Database.ProofCollection([proof(1, 4), proof(1, 2)]),
+            "Difference")
+        self.assertTrue(proof(1, 2) in pc, "Membership")
+
     def open(self, msg):
         logging.debug("** Checking: {} **".format(msg))
 
@@ -863,6 +1086,365 @@ class TestRuntime(unittest.TestCase):
             "False embedded negation with existentials")
 
 
+    def test_exists(self):
+        """ Test boolean queries and the checks of negated literals. """
+        run = runtime.Runtime()
+        run.insert('p(x) :- q(x, y), not r(y)  q(1, 2) q(1, 3) r(2)')
+        run.insert('s(x) :- p(x)', target=run.ACTION_THEORY)
+        self.assertTrue(run.exists('p(1)'))
+        self.assertTrue(run.exists('p(x)'))
+        self.assertFalse(run.exists('p(2)'))
+        self.assertTrue(run.exists(('q', 1, 2)))
+        self.assertTrue(run.exists('t(x) :- q(x, y), r(y), not q(y, x)'))
+        self.assertFalse(run.exists('t(x) :- q(x, y), r(x)'))
+        self.assertTrue(run.exists('s(1)', target=run.ACTION_THEORY))
+        self.assertFalse(run.exists('s(2)', target=run.ACTION_THEORY))
+
+        # count the answers and negation checks allocated
+        counts = {'results': 0, 'negations': 0}
+        original_result = runtime.TopDownTheory.TopDownResult
+        original_caller = runtime.TopDownTheory.TopDownCaller
+        class CountedResult(original_result):
+            def __init__(self, *args, **kwargs):
+                counts['results'] += 1
+                original_result.__init__(self, *args, **kwargs)
+        class CountedCaller(original_caller):
+            def __init__(self, *args, **kwargs):
+                # only the callers for negated literals pass SAVE
+                if kwargs.get('exists') and 'save' in kwargs:
+                    counts['negations'] += 1
+                original_caller.__init__(self, *args, **kwargs)
+        runtime.TopDownTheory.TopDownResult = CountedResult
+        runtime.TopDownTheory.TopDownCaller = CountedCaller
+        try:
+            for iterative in [False, True]:
+                th = runtime.NonrecursiveRuleTheory(iterative=iterative)
+                th.define(compile.parse(
+                    'p(x) :- q(x, y), not r(y)  q(1, 2) q(2, 2) q(3, 2) '
+                    'q(4, 3) r(3)'))
+                counts['results'] = 0
+                self.assertTrue(th.exists(compile.parse1('p(x)')))
+                self.assertEqual(counts['results'], 0,
+                                 "Exists allocates no results")
+                counts['negations'] = 0
+                self.check_equal(compile.formulas_to_string(
+                    th.select(compile.parse1('p(x)'))),
+                    'p(1) p(2) p(3)', "Select with negation")
+                # r(2) and r(3) are each checked once
+                self.assertEqual(counts['negations'], 2,
+                                 "Negation checks are cached")
+                self.assertEqual(counts['results'], 3,
+                                 "Negation allocates no results")
+        finally:
+            runtime.TopDownTheory.TopDownResult = original_result
+            runtime.TopDownTheory.TopDownCaller = original_caller
+
+    def test_tabled_select(self):
+        """ Test tabled top-down evaluation of recursive rules. """
+        th = runtime.Runtime.ACTION_THEORY
+        run = self.prep_runtime('path(x, y) :- edge(x, y) '
+                                'path(x, z) :- path(x, y), edge(y, z) '
+                                'edge(1, 2) edge(2, 3) edge(3, 1) edge(3, 4)',
+                                target=th)
+        self.check_equal(run.select('path(1, x)', target=th),
+            'path(1, 1) path(1, 2) path(1, 3) path(1, 4)',
+            "Left recursion with a cycle")
+        self.check_equal(run.select('path(4, x)', target=th), '',
+            "Left recursion with no answers")
+        self.check_equal(run.select('path(x, x)', target=th),
+            'path(1, 1) path(2, 2) path(3, 3)', "Repeated variable")
+
+        run = self.prep_runtime('r(x, y) :- s(x, y) s(x, y) :- r(y, x) '
+                                's(1, 2) '
+                                'q(x) :- node(x), not reach(x) '
+                                'reach(x) :- r(1, x) '
+                                'reach(y) :- reach(x), r(x, y) '
+                                'node(1) node(2) node(3)', target=th)
+        self.check_equal(run.select('r(x, y)', target=th),
+            'r(1, 2) r(2, 1)', "Mutual recursion")
+        self.check_equal(run.select('q(x)', target=th), 'q(3)',
+            "Negation over recursive table")
+        self.check_equal(run.select('q(x) :- node(x), reach(x)', target=th),
+            'q(1) :- node(1), reach(1) q(2) :- node(2), reach(2)',
+            "Rule query")
+
+    def test_iterative_select(self):
+        """ Test the iterative top-down engine against the recursive one. """
+        code = ('p(x) :- q(x), not r(x) '
+                'q(x) :- s(x, y), t(y) '
+                'r(2) s(1, 1) s(2, 1) s(3, 2) t(1) t(2)')
+        for tabled in [False, True]:
+            theories = []
+            for iterative in [False, True]:
+                th = runtime.NonrecursiveRuleTheory(tabled=tabled,
+                                                    iterative=iterative)
+                for formula in compile.parse(code):
+                    th.insert(formula)
+                theories.append(th)
+            for query in ['p(x)', 'q(x)', 'p(3)', 'p(x) :- q(x), s(x, 1)']:
+                query = str2form(query)
+                self.check_same(pol2str(theories[1].select(query)),
+                    pol2str(theories[0].select(query)),
+                    "Iterative select of {}".format(str(query)))
+            self.assertEqual(
+                len(theories[1].select(str2form('q(x)'), find_all=False)),
+                1, "Iterative select with find_all=False")
+            for iterative_th in theories:
+                self.check_same(compile.formulas_to_string(
+                    iterative_th.abduce(str2form('p(x)'), ['t', 'r'])),
+                    'p(1) :- t(1), not r(1) p(2) :- t(1), not r(2) '
+                    'p(3) :- t(2), not r(3)',
+                    "Abduction")
+
+        # recursive rules
+        code = ('path(x, y) :- edge(x, y) '
+                'path(x, z) :- path(x, y), edge(y, z) '
+                'edge(1, 2) edge(2, 3) edge(3, 1) edge(3, 4) node(5) '
+                'lone(x) :- node(x), not path(x, 4)')
+        th = runtime.NonrecursiveRuleTheory(tabled=True, iterative=True)
+        for formula in compile.parse(code):
+            th.insert(formula)
+        self.check_equal(pol2str(th.select(str2form('path(1, x)'))),
+            'path(1, 1) path(1, 2) path(1, 3) path(1, 4)',
+            "Iterative tabled recursion")
+        self.check_equal(pol2str(th.select(str2form('lone(x)'))), 'lone(5)',
+            "Iterative negation over recursive table")
+
+        # proofs deeper than the Python stack allows
+        depth = 2000
+        code = ['p{}(1) q(1)'.format(depth)]
+        for i in xrange(depth):
+            code.append('p{}(x) :- p{}(x), q(x)'.format(i, i + 1))
+            code.append('n{}(x) :- q(x), not n{}(x)'.format(i, i + 1))
+        formulas = compile.parse(" ".join(code))
+        for tabled in [False, True]:
+            th = runtime.NonrecursiveRuleTheory(formulas, tabled=tabled,
+                                                iterative=True)
+            self.check_equal(pol2str(th.select(str2form('p0(x)'))), 'p0(1)',
+                "Deep proof")
+            self.check_equal(pol2str(th.select(str2form('n0(x)'))), '',
+                "Deep negation")
+            self.check_equal(pol2str(th.select(str2form('n1(x)'))), 'n1(1)',
+                "Deep negation")
+
+    def test_rule_optimizer(self):
+        """ Test reordering rule bodies by table cardinality. """
+        def body_of(th, rule):
+            return " ".join(str(lit) for lit in th.body(str2form(rule)))
+
+        db = runtime.Database()
+        th = runtime.NonrecursiveRuleTheory(optimize=True)
+        th.includes.append(db)
+        for i in xrange(20):
+            db.insert(str2form('vm({})'.format(i)))
+            db.insert(str2form('net({}, {})'.format(i, i % 3)))
+        db.insert(str2form('public(0)'))
+        db.insert(str2form('bad(4)'))
+        rule = 'error(x) :- vm(x), net(x, y), not public(y), bad(x)'
+        th.insert(str2form(rule))
+        self.assertEqual(body_of(th, rule),
+            'bad(x) vm(x) net(x, y) not public(y)', "Small table first")
+        self.check_equal(pol2str(th.select(str2form('error(x)'))),
+            'error(4)', "Reordered select")
+        rule = 'error(x) :- vm(x), net(x, y), not public(y), view(x)'
+        th.insert(str2form(rule))
+        th.insert(str2form('view(x) :- bad(x)'))
+        self.assertEqual(body_of(th, rule),
+            'vm(x) view(x) net(x, y) not public(y)', "Unknown view size")
+
+        # statistics drift
+        for i in xrange(10):
+            db.insert(str2form('q({})'.format(i)))
+        db.insert(str2form('r(1)'))
+        rule = 'p(x) :- q(x), r(x)'
+        th.insert(str2form(rule))
+        self.assertEqual(body_of(th, rule), 'r(x) q(x)', "Before drift")
+        db.insert(str2form('r(20)'))
+        db.insert(str2form('r(21)'))
+        self.assertEqual(body_of(th, rule), 'r(x) q(x)', "No drift")
+        for i in xrange(20):
+            db.insert(str2form('r({})'.format(i + 30)))
+        self.assertEqual(body_of(th, rule), 'q(x) r(x)', "Drift")
+        self.check_equal(pol2str(th.select(str2form('p(x)'))), 'p(1)',
+            "Select after drift")
+        th.delete(str2form(rule))
+        self.assertEqual(th.select(str2form('p(x)')), [], "Delete")
+
+        # cardinalities are only rechecked after a change
+        calls = []
+        def cardinality(table):
+            calls.append(table)
+            return db.cardinality(table)
+        optimizer = runtime.RuleOptimizer(cardinality)
+        body, statistics = optimizer.order(str2form(rule).body)
+        del calls[:]
+        self.assertFalse(optimizer.stale(statistics), "Fresh ordering")
+        self.assertEqual(calls, [], "No change, no check")
+        db.insert(str2form('q(100)'))
+        self.assertFalse(optimizer.stale(statistics), "Small change")
+        self.assertEqual(len(calls), 2, "Checked after a change")
+        self.assertFalse(optimizer.stale(statistics), "Checked again")
+        self.assertEqual(len(calls), 2, "Change checked once")
+
+        # materialized views
+        code = ('p(x) :- q(x, y), not r(y), s(x) '
+                'q(1, 2) q(2, 3) q(3, 4) q(4, 5) r(3) s(1) s(2)')
+        for support in [None, runtime.MaterializedViewTheory.COUNTING_SUPPORT]:
+            run = runtime.Runtime(support=support, optimize=True)
+            run.insert(code)
+            data = 'q(1, 2) q(2, 3) q(3, 4) q(4, 5) s(1) s(2) '
+            self.check_class(run, data + 'r(3) p(1)', "Optimized delta rules")
+            run.insert('s(4)')
+            run.delete('r(3)')
+            self.check_class(run, data + 's(4) p(1) p(2) p(4)',
+                "Optimized delta rules after changes")
+            run.delete('p(x) :- q(x, y), not r(y), s(x)')
+            self.check_class(run, data + 's(4)',
+                "Optimized delta rules deleted")
+
+    def test_trigger_index(self):
+        """ Test that delta rules are found by the constants of their
+            triggers. """
+        def heads(theory, atom):
+            return sorted(delta.head.table for delta in
+                theory.rules_with_trigger('q', compile.parse1(atom)))
+        theory = runtime.DeltaRuleTheory()
+        rules = compile.parse('p(x) :- q(x, "a")  r(x) :- q(x, "b") '
+                              's(x) :- q(1, x)  t(x, y) :- q(x, y) '
+                              'u(x) :- q(1, "a"), v(x)')
+        for rule in rules:
+            theory.insert(rule)
+        self.assertEqual(heads(theory, 'q(1, "a")'), ['p', 's', 't', 'u'])
+        self.assertEqual(heads(theory, 'q(2, "b")'), ['r', 't'])
+        self.assertEqual(heads(theory, 'q(2, 1)'), ['t'])
+        self.assertEqual(len(theory.rules_with_trigger('q')), 5)
+        theory.delete(rules[0])
+        theory.delete(rules[4])
+        self.assertEqual(heads(theory, 'q(1, "a")'), ['s', 't'])
+        self.assertEqual(set(theory.trigger_index['q']),
+            set([(0,), (1,), ()]), "Trigger index: empty patterns removed")
+
+        # propagation, one at a time and in batches
+        policy = ' '.join('opt{0}(x) :- value(x, "opt{0}", y)'.format(i)
+                          for i in xrange(10))
+        for batch in [False, True]:
+            run = runtime.Runtime(batch=batch)
+            run.insert(policy)
+            run.insert('value(1, "opt3", 7) value(2, "opt3", 8) '
+                       'value(3, "opt5", 9) value(4, "other", 0)')
+            self.check_equal(run.select('opt3(x)'), 'opt3(1) opt3(2)')
+            self.check_equal(run.select('opt5(x)'), 'opt5(3)')
+            run.delete('value(1, "opt3", 7)')
+            self.check_equal(run.select('opt3(x)'), 'opt3(2)')
+
+    def test_self_join_delta_rules(self):
+        """ Test that self-joins are propagated without copies of the
+            self-joined tables. """
+        def support_of(run):
+            db = run.theory[run.CLASSIFY_THEORY].database
+            if db.counting:
+                return dict((table, dict((x.tuple, x.count)
+                                         for x in db[table]))
+                            for table in db.data)
+            return dict((table, dict((x.tuple, x.proofs) for x in db[table]))
+                        for table in db.data)
+        policy = ('same(x, y) :- member(x, g), member(y, g) '
+                  'other(x, y) :- member(x, g), member(y, h), '
+                  'not member(y, g)')
+        data = ('member(1, "a") member(2, "a") member(2, "b") '
+                'member(3, "b") member(1, "a")')
+        final = 'member(1, "a") member(2, "b") member(3, "a")'
+        expected = runtime.Runtime()
+        expected.bulk_insert([policy, final])
+        proofs = support_of(expected)
+        supports = runtime.MaterializedViewTheory
+        for support in [None, supports.COUNTING_SUPPORT,
+                        supports.DRED_SUPPORT]:
+            for batch in [False, True]:
+                run = runtime.Runtime(support=support, batch=batch)
+                run.insert(policy)
+                run.insert(data)
+                classify = run.theory[run.CLASSIFY_THEORY]
+                classify.bulk_modify(compile.parse(
+                    'member(2, "a") member(3, "b")'), is_insert=False)
+                run.insert('member(3, "a")')
+                self.check_class(run, 'same(1, 1) same(1, 3) same(3, 1) '
+                    'same(3, 3) same(2, 2) other(1, 2) other(3, 2) '
+                    'other(2, 1) other(2, 3) ' + final, "Self-joins")
+                self.assertFalse(any(table.startswith('___')
+                                     for table in classify.database.data),
+                                 "Self-joins: no copies of tables")
+                if support is None:
+                    self.assertEqual(support_of(run), proofs,
+                                     "Self-joins: proofs")
+                elif support == supports.COUNTING_SUPPORT:
+                    self.assertEqual(support_of(run),
+                        dict((table, dict((row, len(rows[row]))
+                                          for row in rows))
+                             for table, rows in proofs.iteritems()),
+                        "Self-joins: counts")
+
+        # a batch deleting several proofs of a tuple, some of them
+        #   already deleted, deletes the others
+        runs = []
+        for batch in [False, True]:
+            run = runtime.Runtime(batch=batch)
+            run.insert('q(x, z) :- p(x, y), p(y, z)  r(x) :- q(x, x) '
+                       's(x) :- p(x, y), not q(y, x)')
+            run.insert('p(4, 4) p(4, 2) p(2, 4)')
+            self.check_class(run, 'p(4, 4) p(4, 2) p(2, 4) q(4, 4) q(4, 2) '
+                'q(2, 2) q(2, 4) r(2) r(4)', "Self-joins: batch")
+            runs.append(run)
+        self.assertEqual(support_of(runs[0]), support_of(runs[1]),
+                         "Self-joins: same proofs in batches")
+
+    def test_rule_compiler(self):
+        """ Test that propagating changes with compiled rules matches
+            propagating them with top-down evaluation. """
+        def support_of(run):
+            db = run.theory[run.CLASSIFY_THEORY].database
+            if db.counting:
+                return dict((table, dict((x.tuple, x.count) for x in db[table]))
+                            for table in db.data)
+            return dict((table, dict((x.tuple, x.proofs) for x in db[table]))
+                        for table in db.data)
+        policy = ('p(x) :- q(x, y), not r(y)  s(x, y) :- q(x, y) '
+                  's(x, z) :- s(x, y), q(y, z)  t(x, z) :- q(x, y), q(y, z) '
+                  'u(x) :- r(x), not t(x, x)  v(x) :- q(x, "a"), r(1.5) '
+                  'w(x) :- m(x, x)')
+        data = [('q', 1, 2), ('q', 2, 3), ('q', 3, 4), ('q', 1, 4),
+                ('q', 1, 3), ('q', 6, "a"), ('m', 7, 7), ('m', 7, 8), ('r', 2),
+                ('r', 4), ('r', 1.5)]
+        for support in [None, runtime.MaterializedViewTheory.COUNTING_SUPPORT]:
+            if support is not None:
+                # counting support does not handle recursion
+                policy = policy.replace('s(x, z) :- s(x, y), q(y, z)', '')
+            runs = []
+            for compiled in [False, True]:
+                run = runtime.Runtime(support=support, compiled=compiled)
+                run.insert(policy)
+                run.bulk_insert(data)
+                runs.append(run)
+            self.assertEqual(support_of(runs[0]), support_of(runs[1]),
+                             "Compiled: same proofs")
+            self.check_equal(runs[1].select('v(x)'), 'v(6)',
+                             "Compiled: constants")
+            self.check_equal(runs[1].select('w(x)'), 'w(7)',
+                             "Compiled: repeated variable")
+            for run in runs:
+                run.insert('r(3) r(1) q(4, 5)')
+                run.delete('q(1, 2)')
+                run.delete('r(1.5)')
+                run.insert('z(x) :- q(x, y), r(y)')
+            self.assertEqual(support_of(runs[0]), support_of(runs[1]),
+                             "Compiled: same proofs after changes")
+            compiler = runs[1].theory[runs[1].CLASSIFY_THEORY].compiler
+            self.assertTrue(compiler.compiled > 0, "Compiled: rules compiled")
+            self.check_equal(runs[0].select('z(x)'), runs[1].select('z(x)'),
+                             "Compiled: same select")
+            self.assertTrue(len(compiler.queries) > 0,
+                            "Compiled: queries compiled")
+
     def test_theory_inclusion(self):
         """ Test evaluation routines when one theory includes another. """
         # spread out across inclusions
@@ -892,6 +1474,114 @@ class TestRuntime(unittest.TestCase):
         self.check_equal(run.select('p(x)', target=actth),
             "p(1) p(2)", "Real deal")
 
+    def test_dependency_graph(self):
+        """ Test the dependency graph of the tables of a set of rules. """
+        def components(g):
+            return [sorted(component) for component in g.components()]
+        rules = compile.parse(
+            'p(x) :- q(x), not r(x)  q(x) :- s(x), t(x)  '
+            's(x) :- q(x), u(x)  r(x) :- v(x)  w(x) :- p(x)  v(1)')
+        g = graph.DependencyGraph(rules)
+        self.assertEqual(g.body_tables('p'), set(['q', 'r']))
+        self.assertEqual(g.head_tables('q'), set(['p', 's']))
+        self.assertEqual(g.dependencies('p'),
+                         set(['q', 'r', 's', 't', 'u', 'v']))
+        self.assertEqual(g.dependents('u'), set(['s', 'q', 'p', 'w']))
+        self.assertEqual(g.dependents('w'), set())
+        self.assertTrue(g.is_recursive('q'))
+        self.assertFalse(g.is_recursive('p'))
+        self.assertEqual(g.component('s'), set(['q', 's']))
+        # every component comes after those it depends on
+        order = components(g)
+        for table, needs in [('p', 'q'), ('p', 'r'), ('w', 'p'), ('r', 'v')]:
+            self.assertTrue(order.index(sorted(g.component(table))) >
+                            order.index(sorted(g.component(needs))))
+        self.assertTrue(g.is_stratified())
+        self.assertEqual(g.stratum('t'), 0)
+        self.assertEqual(g.stratum('q'), 0)
+        self.assertEqual(g.stratum('p'), 1)
+        self.assertEqual(g.stratum('w'), 1)
+
+        # incremental changes
+        g.formula_insert(compile.parse1('r(x) :- w(x)'))
+        self.assertFalse(g.is_stratified())
+        self.assertEqual(g.component('r'), set(['p', 'r', 'w']))
+        self.assertTrue('w' in g.dependencies('p'))
+        g.formula_delete(compile.parse1('r(x) :- w(x)'))
+        self.assertTrue(g.is_stratified())
+        self.assertEqual(g.dependencies('w'),
+                         set(['p', 'q', 'r', 's', 't', 'u', 'v']))
+        g.formula_delete(compile.parse1('s(x) :- q(x), u(x)'))
+        self.assertFalse(g.is_recursive('q'))
+        self.assertEqual(g.dependents('u'), set())
+        self.assertFalse(g.is_head('s'))
+        # deleting the fact leaves the rule for v
+        g.formula_delete(compile.parse1('v(1)'))
+        self.assertTrue(g.is_head('r'))
+        self.assertFalse(g.is_head('v'))
+
+        # theories maintain their graphs
+        th = runtime.NonrecursiveRuleTheory()
+        th.define(rules)
+        self.assertEqual(th.body_tables('q'), set(['s', 't']))
+        th.delete(compile.parse1('q(x) :- s(x), t(x)'))
+        self.assertEqual(th.body_tables('q'), set())
+        self.assertEqual(th.graph.dependencies('p'), set(['q', 'r', 'v']))
+        th.empty()
+        self.assertEqual(len(th.graph), 0)
+        run = runtime.Runtime()
+        run.insert('p(x) :- q(x, y), not r(y)  s(x, y) :- q(x, y) '
+                   's(x, z) :- s(x, y), q(y, z)')
+        deltas = run.theory[run.CLASSIFY_THEORY].delta_rules
+        self.assertTrue(deltas.graph.is_recursive('s'))
+        self.assertEqual(deltas.graph.stratum('p'), 1)
+        run.delete('s(x, z) :- s(x, y), q(y, z)')
+        self.assertFalse(deltas.graph.is_recursive('s'))
+
+    def test_magic_sets(self):
+        """ Test selecting with magic-sets rewriting. """
+        policy = ('connected(x, y) :- link(x, y) '
+                  'connected(x, y) :- link(x, z), connected(z, y) '
+                  'path(x, z) :- connected(x, y), connected(y, z) '
+                  'far(x, y) :- connected(x, y), not link(x, y) '
+                  'lonely(x) :- node(x), not connected(x, 1)')
+        data = ('link(1, 2) link(2, 3) link(3, 4) link(5, 6) link(6, 5) '
+                'node(1) node(5)')
+        rules, answer = magic.rewrite(compile.parse(policy),
+                                      compile.parse1('connected(1, y)'))
+        self.assertEqual(set(str(rule) for rule in rules), set([
+            '___magic_connected_bf(1) :- ',
+            '___magic_connected_bf(z) :- ___magic_connected_bf(x), link(x, z)',
+            '___connected_bf(x, y) :- ___magic_connected_bf(x), link(x, y)',
+            '___connected_bf(x, y) :- ___magic_connected_bf(x), link(x, z), '
+            '___connected_bf(z, y)']), "Magic: rewritten rules")
+        self.assertEqual(str(answer), '___connected_bf(1, y)')
+        # only the tuples relevant to the query are computed
+        th = runtime.MaterializedViewTheory()
+        th.includes.append(runtime.string_to_database(data))
+        th.bulk_modify(rules)
+        self.assertEqual(th.cardinality('___magic_connected_bf'), 4)
+        self.assertEqual(th.cardinality('___connected_bf'), 6)
+
+        run = runtime.Runtime()
+        run.bulk_insert([policy, data])
+        originals = set(str(rule) for rule in
+                        run.theory[run.CLASSIFY_THEORY].delta_rules.originals)
+        for query in ['connected(1, y)', 'connected(x, 4)', 'connected(5, y)',
+                      'path(2, y)', 'far(x, y)', 'lonely(x)', 'link(1, y)',
+                      'connected(1, 4)', 'connected(4, 1)']:
+            self.check_equal(run.select_on_demand(query), run.select(query),
+                             "Magic: " + query)
+        # rewriting leaves the original rules alone
+        self.assertEqual(set(str(rule) for rule in
+            run.theory[run.CLASSIFY_THEORY].delta_rules.originals), originals)
+
+        # recursive rules without tabling
+        th = runtime.NonrecursiveRuleTheory(compile.parse(policy + data))
+        self.check_equal(compile.formulas_to_string(
+            th.select_on_demand(compile.parse1('connected(x, 5)'))),
+            'connected(5, 5) connected(6, 5)', "Magic: nonrecursive theory")
+
     # TODO(tim): add tests for explanations
     def test_materialized_explain(self):
         """ Test the explanation event handler. """
@@ -906,6 +1596,394 @@ class TestRuntime(unittest.TestCase):
         logging.debug(run.explain("p(1)"))
         # self.fail()
 
+    def test_materialized_counting(self):
+        """ Test Materialized Theory with counting support """
+        run = runtime.Runtime(
+            support=runtime.MaterializedViewTheory.COUNTING_SUPPORT)
+        run.debug_mode()
+        run.insert('p(x) :- q(x, y), not r(y)  s(x) :- p(x)')
+        run.insert('q(1, 2) q(1, 3) q(2, 3)')
+        self.check_class(run, 'q(1, 2) q(1, 3) q(2, 3) p(1) p(2) s(1) s(2)',
+            "Counting: insert")
+        self.assertRaises(AssertionError, run.insert, 'p(x) :- s(x)')
+        self.assertRaises(AssertionError, run.insert, 'q(x, y) :- q(y, x)')
+        self.check_class(run, 'q(1, 2) q(1, 3) q(2, 3) p(1) p(2) s(1) s(2)',
+            "Counting: recursive rules rejected")
+        classify = run.theory[run.CLASSIFY_THEORY]
+        self.assertEqual(classify.database.derivation_count(
+            compile.parse1('p(1)')), 2, "Counting: two proofs")
+        self.assertEqual(classify.database.derivation_count(
+            compile.parse1('s(1)')), 1, "Counting: one proof")
+        self.assertEqual(len(classify.local_proofs(compile.parse1('p(1)'))),
+            2, "Counting: rebuilt proofs")
+        self.assertTrue(run.explain('s(1)') is not None, "Counting: explain")
+        run.insert('r(3)')
+        self.check_class(run, 'q(1, 2) q(1, 3) q(2, 3) r(3) p(1) s(1)',
+            "Counting: insert into negated table")
+        self.assertEqual(classify.database.derivation_count(
+            compile.parse1('p(1)')), 1, "Counting: one proof left")
+        run.delete('q(1, 2)')
+        self.check_class(run, 'q(1, 3) q(2, 3) r(3)',
+            "Counting: delete last proof")
+        run.delete('r(3)')
+        self.check_class(run, 'q(1, 3) q(2, 3) p(1) p(2) s(1) s(2)',
+            "Counting: delete from negated table")
+        run.delete('p(x) :- q(x, y), not r(y)')
+        self.check_class(run, 'q(1, 3) q(2, 3)', "Counting: delete rule")
+
+    def test_materialized_dred(self):
+        """ Test Materialized Theory with delete and rederive support """
+        dred = runtime.MaterializedViewTheory.DRED_SUPPORT
+        policy = ('connected(x, y) :- link(x, y) '
+                  'connected(x, y) :- link(x, z), connected(z, y)')
+        links = 'link(1, 2) link(2, 3) link(3, 1) link(3, 4) link(1, 3) '
+        run = runtime.Runtime(support=dred)
+        run.debug_mode()
+        run.insert(policy)
+        for link in links.split(') ')[:-1]:
+            run.insert(link + ')')
+        everything = ' '.join('connected({}, {})'.format(x, y)
+                              for x in [1, 2, 3] for y in [1, 2, 3, 4])
+        self.check_class(run, links + everything, "DRed: cyclic insert")
+        loaded = runtime.Runtime(support=dred)
+        loaded.bulk_insert([policy, links])
+        self.check_class(loaded, links + everything, "DRed: bulk insert")
+        classify = run.theory[run.CLASSIFY_THEORY]
+        self.assertTrue(all(len(dbtuple.proofs) == 0
+                            for table in classify.database.data
+                            for dbtuple in classify.database[table]),
+                        "DRed: no proofs stored")
+
+        # all of connected is over-deleted and most of it rederived
+        changes = classify.delete(compile.parse1('link(1, 2)'))
+        unreachable = ['connected({}, 2)'.format(x) for x in [1, 2, 3]]
+        self.check_class(run, links.replace('link(1, 2) ', '') +
+            reduce(lambda x, y: x.replace(y, ''), unreachable, everything),
+            "DRed: rederive")
+        self.assertEqual(set(str(change.formula) for change in changes
+                             if not change.is_insert()),
+                         set(['link(1, 2)'] + unreachable),
+                         "DRed: rederived tuples are not changes")
+        self.assertTrue(all(not change.is_insert() for change in changes),
+                        "DRed: no insertions")
+        self.assertEqual(len(classify.local_proofs(
+            compile.parse1('connected(1, 4)'))), 1, "DRed: rebuilt proofs")
+        run.delete('link(3, 1)')
+        self.check_class(run, 'link(2, 3) link(3, 4) link(1, 3) '
+            'connected(2, 3) connected(2, 4) connected(3, 4) '
+            'connected(1, 3) connected(1, 4)', "DRed: delete cycle")
+        self.assertTrue(run.explain('connected(2, 4)') is not None,
+                        "DRed: explain")
+        run.delete('connected(x, y) :- link(x, z), connected(z, y)')
+        self.check_class(run, 'link(2, 3) link(3, 4) link(1, 3) '
+            'connected(2, 3) connected(3, 4) connected(1, 3)',
+            "DRed: delete rule")
+
+        # negation
+        run = runtime.Runtime(support=dred)
+        run.insert('p(x) :- q(x, y), not r(y)  s(x) :- p(x)')
+        run.insert('q(1, 2) q(1, 3) q(2, 3)')
+        run.insert('r(3)')
+        self.check_class(run, 'q(1, 2) q(1, 3) q(2, 3) r(3) p(1) s(1)',
+            "DRed: insert into negated table")
+        run.delete('r(3)')
+        self.check_class(run, 'q(1, 2) q(1, 3) q(2, 3) p(1) p(2) s(1) s(2)',
+            "DRed: delete from negated table")
+
+        # rederiving checks negated views against their contents
+        run = runtime.Runtime(support=dred)
+        run.insert('q(x) :- p(x, y), not r(y)  r(y) :- p(y, y)')
+        run.insert('p(2, 3)')
+        self.check_class(run, 'p(2, 3) q(2)', "DRed: negated view")
+        run.insert('p(3, 3)')
+        self.check_class(run, 'p(2, 3) p(3, 3) r(3)',
+            "DRed: insert into negated view")
+        run.delete('p(3, 3)')
+        self.check_class(run, 'p(2, 3) q(2)',
+            "DRed: delete from negated view")
+
+    def test_bulk_insert(self):
+        """ Test that bulk insertion matches inserting one at a time. """
+        policy = ('p(x) :- q(x, y), not r(y)  s(x, y) :- q(x, y) '
+                  's(x, z) :- s(x, y), q(y, z)')
+        data = 'q(1, 2) q(2, 3) q(3, 4) q(1, 4) r(2) r(5)'
+        correct = ('q(1, 2) q(2, 3) q(3, 4) q(1, 4) r(2) r(5) p(1) p(2) '
+                   'p(3) s(1, 2) s(2, 3) s(3, 4) s(1, 4)')
+        for support in [None, runtime.MaterializedViewTheory.COUNTING_SUPPORT]:
+            if support is None:
+                correct = correct + ' s(1, 3) s(2, 4)'
+            else:
+                # counting support rejects recursive rules
+                policy = policy.replace('s(x, z) :- s(x, y), q(y, z)', '')
+                correct = correct.replace(' s(1, 3) s(2, 4)', '')
+            run = runtime.Runtime(support=support)
+            run.debug_mode()
+            run.bulk_insert([data, ('r', 6), policy])
+            self.check_class(run, correct + ' r(6)', "Bulk: data then rules")
+            run = runtime.Runtime(support=support)
+            run.debug_mode()
+            run.bulk_insert([policy])
+            run.bulk_insert([data])
+            self.check_class(run, correct, "Bulk: rules then data")
+            run.delete('q(2, 3)')
+            run.delete('r(2)')
+            self.check_class(run, 'q(1, 2) q(3, 4) q(1, 4) r(5) p(1) p(3) '
+                's(1, 2) s(3, 4) s(1, 4)', "Bulk: delete after bulk insert")
+
+        # reacts to all the changes at once
+        run = runtime.Runtime()
+        run.insert('act(x) :- p(x)', target=run.ENFORCEMENT_THEORY)
+        run.insert('action("act")', target=run.ACTION_THEORY)
+        changes = run.bulk_insert(['p(1) p(2)', ('p', 3)])
+        self.assertEqual(len(changes), 6, "Bulk: changes")
+        self.check_equal(run.logger.contents(), 'act(1) act(2) act(3)',
+            "Bulk: actions")
+
+    def test_transaction(self):
+        """ Test that the updates of a transaction are propagated and
+            acted upon together. """
+        supports = runtime.MaterializedViewTheory
+        for support in [None, supports.COUNTING_SUPPORT,
+                        supports.DRED_SUPPORT]:
+            run = runtime.Runtime(support=support)
+            run.insert('r(x) :- p(x), not q(x)')
+            run.insert('act(x) :- r(x)', target=run.ENFORCEMENT_THEORY)
+            run.insert('action("act")', target=run.ACTION_THEORY)
+            with run.transaction() as transaction:
+                run.insert('p(1) p(2) p(3)')
+                run.insert('q(1)')
+                with run.transaction():
+                    run.delete('p(3)')
+                self.check_class(run, '', "Transaction: buffered")
+                self.assertEqual(len(transaction), 4)
+            self.check_class(run, 'p(1) p(2) q(1) r(2)',
+                             "Transaction: committed")
+            self.check_equal(run.logger.contents(), 'act(2)',
+                             "Transaction: actions see the final state")
+            self.check_equal(compile.formulas_to_string(
+                [change.formula for change in transaction.changes]),
+                'p(1) p(2) q(1) r(2) act(2)', "Transaction: changes")
+
+            # updates that cancel out cause no changes
+            run.logger.empty()
+            with run.transaction() as transaction:
+                run.delete('p(2)')
+                run.insert('p(2)')
+                run.insert('p(4)')
+                run.delete('p(4)')
+            self.assertEqual(transaction.changes, [])
+            self.check_equal(run.logger.contents(), '',
+                             "Transaction: cancelled updates")
+
+            # exceptions discard the updates
+            try:
+                with run.transaction():
+                    run.insert('p(5)')
+                    raise ValueError()
+            except ValueError:
+                pass
+            self.assertTrue(run.current_transaction is None)
+            run.delete('q(1)')
+            self.check_class(run, 'p(1) p(2) r(1) r(2)',
+                             "Transaction: discarded")
+
+        # the views match those after updating one at a time
+        policy = ('q(x) :- p(x, y), not r(y)  r(y) :- p(y, y) '
+                  't(x, y) :- q(x), p(x, y)')
+        data = 'p(4, 1) p(3, 3) p(4, 3)'
+        for options in [{}, {'compiled': True}, {'optimize': True},
+                        {'batch': True}]:
+            run = runtime.Runtime(**options)
+            run.insert(policy)
+            with run.transaction():
+                run.insert(data)
+            self.check_class(run, data + ' q(4) r(3) t(4, 1) t(4, 3)',
+                             "Transaction: views")
+
+        # updates are only buffered within the WITH statement
+        run = runtime.Runtime()
+        transaction = run.transaction()
+        run.insert('p(1)')
+        with transaction:
+            run.insert('p(2)')
+            self.check_class(run, 'p(1)', "Transaction: entered late")
+        self.check_class(run, 'p(1) p(2)', "Transaction: entered late")
+
+    def test_replace_table(self):
+        """ Test that replacing a table only propagates the rows that
+            changed. """
+        for columnar in [False, True]:
+            run = runtime.Runtime(columnar=columnar)
+            run.insert('r(x) :- p(x, y), not q(x)')
+            run.insert('act(x) :- r(x)', target=run.ENFORCEMENT_THEORY)
+            run.insert('action("act")', target=run.ACTION_THEORY)
+            run.bulk_insert(['p(1, "a") p(2, "b") p(3, "c") p(4, "d") q(4)'])
+            run.logger.empty()
+            changes = run.replace_table('p',
+                [(2, "b"), (3, "c"), (4, "d"), [5, "e"], (5, "e")])
+            self.check_class(run, 'p(2, "b") p(3, "c") p(4, "d") p(5, "e") '
+                'q(4) r(2) r(3) r(5)', "Replace table")
+            self.check_equal(compile.formulas_to_string(
+                [change.formula.make_update(change.is_insert())
+                 for change in changes]),
+                'p-(1, "a") r-(1) act-(1) p+(5, "e") r+(5) act+(5)',
+                "Replace table: changes")
+            self.check_equal(run.logger.contents(), 'act(5)',
+                             "Replace table: actions")
+            self.assertEqual(run.replace_table('p',
+                [(2, "b"), (3, "c"), (4, "d"), (5, "e")]), [],
+                "Replace table: unchanged")
+            run.replace_table('p', [])
+            self.check_class(run, 'q(4)', "Replace table: empty")
+
+            # within a transaction, the buffered updates are replaced too
+            run.bulk_insert(['p(1, "a") p(2, "b")'])
+            with run.transaction():
+                run.insert('p(3, "c")')
+                run.delete('p(1, "a")')
+                run.replace_table('p', [(1, "a"), (4, "d")])
+            self.check_class(run, 'p(1, "a") p(4, "d") q(4) r(1)',
+                             "Replace table: within a transaction")
+
+    def test_semi_naive(self):
+        """ Test that computing views bottom-up when loading gives the
+            same proofs as inserting one formula at a time. """
+        def proofs_of(run):
+            db = run.theory[run.CLASSIFY_THEORY].database
+            return dict((table, dict((x.tuple, x.proofs) for x in db[table]))
+                        for table in db.data)
+        policy = ('connected(x, y) :- link(x, y) '
+                  'connected(x, y) :- link(x, z), connected(z, y) '
+                  'path(x, z) :- connected(x, y), connected(y, z) '
+                  'unreachable(x) :- node(x), not connected(1, x)')
+        data = 'link(1, 2) link(2, 3) link(3, 4) link(5, 6) node(3) node(6)'
+        correct = ('link(1, 2) link(2, 3) link(3, 4) link(5, 6) node(3) '
+                   'node(6) unreachable(6) connected(1, 2) connected(1, 3) '
+                   'connected(1, 4) connected(2, 3) connected(2, 4) '
+                   'connected(3, 4) connected(5, 6) '
+                   'path(1, 3) path(1, 4) path(2, 4)')
+        incremental = runtime.Runtime()
+        incremental.insert(policy)
+        incremental.insert(data)
+        self.check_class(incremental, correct, "Semi-naive: incremental")
+
+        run = runtime.Runtime()
+        run.debug_mode()
+        changes = run.bulk_insert([policy, data])
+        self.check_class(run, correct, "Semi-naive: rules then data")
+        self.assertEqual(proofs_of(run), proofs_of(incremental),
+                         "Semi-naive: proofs for rules then data")
+        self.assertEqual(
+            len([x for x in changes if isinstance(x, runtime.Event)]), 17,
+            "Semi-naive: changes")
+
+        run = runtime.Runtime()
+        run.debug_mode()
+        run.bulk_insert([data])
+        run.bulk_insert([policy])
+        self.check_class(run, correct, "Semi-naive: data then rules")
+        self.assertEqual(proofs_of(run), proofs_of(incremental),
+                         "Semi-naive: proofs for data then rules")
+
+        # updates afterwards are incremental
+        run.delete('link(2, 3)')
+        incremental.delete('link(2, 3)')
+        self.check_class(run, 'link(1, 2) link(3, 4) link(5, 6) node(3) '
+            'node(6) unreachable(3) unreachable(6) connected(1, 2) '
+            'connected(3, 4) connected(5, 6)',
+            "Semi-naive: delete after load")
+        self.assertEqual(proofs_of(run), proofs_of(incremental),
+                         "Semi-naive: proofs after delete")
+
+        # loading more data recomputes the views and reports the changes
+        changes = run.bulk_insert(['link(2, 3)'])
+        self.check_equal(' '.join(str(x.formula) for x in changes
+                                  if not x.is_insert()),
+            'unreachable(3)', "Semi-naive: deletions from load")
+        incremental.insert('link(2, 3)')
+        self.assertEqual(proofs_of(run), proofs_of(incremental),
+                         "Semi-naive: proofs after second load")
+
+        # cycles reach a fixpoint
+        run = runtime.Runtime()
+        run.bulk_insert([policy, 'link(1, 2) link(2, 1) node(2)'])
+        self.check_class(run, 'link(1, 2) link(2, 1) node(2) '
+            'connected(1, 1) connected(1, 2) connected(2, 1) '
+            'connected(2, 2) path(1, 1) path(1, 2) path(2, 1) path(2, 2)',
+            "Semi-naive: cycle")
+
+        # recursion through negation falls back to propagation
+        run = runtime.Runtime()
+        run.bulk_insert(['p(x) :- q(x), not r(x)  r(x) :- s(x), not p(x)',
+                         'q(1) s(2)'])
+        self.check_class(run, 'q(1) s(2) p(1) r(2)',
+                         "Semi-naive: recursion through negation")
+
+        # self-joins
+        run = runtime.Runtime()
+        run.bulk_insert(['t(x, z) :- q(x, y), q(y, z)',
+                         'q(1, 2) q(2, 3) q(3, 4)'])
+        self.check_class(run, 'q(1, 2) q(2, 3) q(3, 4) t(1, 3) t(2, 4)',
+                         "Semi-naive: self-join")
+
+        run = runtime.Runtime()
+        run.load_file(os.path.join(os.path.dirname(os.path.realpath(
+            __file__)), "../../../examples/recursion"))
+        run.bulk_insert(['link(1, 2) link(2, 3)'])
+        self.check_equal(run.select('connected(x, y)'),
+            'connected(1, 2) connected(2, 3) connected(1, 3)',
+            "Semi-naive: load_file")
+
+
+    def test_batch_propagation(self):
+        """ Test that propagating events in batches matches propagating
+            them one at a time. """
+        def support_of(run):
+            db = run.theory[run.CLASSIFY_THEORY].database
+            if db.counting:
+                return dict((table, dict((x.tuple, x.count) for x in db[table]))
+                            for table in db.data)
+            return dict((table, dict((x.tuple, x.proofs) for x in db[table]))
+                        for table in db.data)
+        policy = ('p(x) :- q(x, y), not r(y)  s(x, y) :- q(x, y) '
+                  's(x, z) :- s(x, y), q(y, z)  t(x, z) :- q(x, y), q(y, z) '
+                  'u(x) :- r(x), not t(x, x)')
+        data = [('q', 1, 2), ('q', 2, 3), ('q', 3, 4), ('q', 1, 4),
+                ('q', 1, 3), ('r', 2), ('r', 4), ('r', 5)]
+        correct = ('q(1, 2) q(2, 3) q(3, 4) q(1, 4) q(1, 3) r(2) r(4) r(5) '
+                   'p(1) p(2) s(1, 2) s(2, 3) s(3, 4) s(1, 4) s(1, 3) '
+                   't(1, 3) t(2, 4) t(1, 4) u(2) u(4) u(5)')
+        for support in [None, runtime.MaterializedViewTheory.COUNTING_SUPPORT]:
+            if support is None:
+                correct_support = correct + ' s(2, 4)'
+            else:
+                # counting support does not handle recursion
+                policy = policy.replace('s(x, z) :- s(x, y), q(y, z)', '')
+                correct_support = correct
+            runs = []
+            for batch in [False, True]:
+                run = runtime.Runtime(support=support, batch=batch)
+                run.debug_mode()
+                run.insert(policy)
+                run.bulk_insert(data)
+                runs.append(run)
+            self.check_class(runs[1], correct_support, "Batch: insert")
+            self.assertEqual(support_of(runs[0]), support_of(runs[1]),
+                             "Batch: same proofs")
+            for run in runs:
+                run.bulk_insert([('r', 3), ('r', 1), ('q', 4, 5)])
+                run.delete('q(1, 2)')
+            self.assertEqual(support_of(runs[0]), support_of(runs[1]),
+                             "Batch: same proofs after delete")
+
+        # a batch mixing inserts and deletes is rejected
+        classify = runs[1].theory[runs[1].CLASSIFY_THEORY]
+        delta_rule = classify.delta_rules.rules_with_trigger('r')[0]
+        events = [runtime.Event(formula=compile.parse1('r(6)')),
+                  runtime.Event(formula=compile.parse1('r(7)'), insert=False)]
+        self.assertRaises(AssertionError, classify.propagate_rule_batch,
+                          events, delta_rule)
+
     def test_nonrecursive_abduction(self):
         """ Test abduction for NonrecursiveRuleTheory. """
         def check(query, code, tablenames, correct, msg, find_all=True):
@@ -1022,6 +2100,38 @@ class TestRuntime(unittest.TestCase):
                 'q(2)')
         check(code, 'p+(1) p+(2) q(1) q(2)', 'Monadic with empty tables')
 
+    def test_parallel_consequences(self):
+        """ Test computing consequences with a pool of processes. """
+        code = ('p+(x) :- q(x)  p-(x) :- r(x)  s+(x, y) :- q(x), t(y) '
+                'u(x) :- q(x), not r(x)  q(1) q(2) r(2) t("a")')
+        sequential = runtime.NonrecursiveRuleTheory(compile.parse(code))
+        parallel = runtime.NonrecursiveRuleTheory(compile.parse(code),
+                                                  processes=2)
+        correct = compile.formulas_to_string(sequential.consequences())
+        self.check_same(compile.formulas_to_string(parallel.consequences()),
+                        correct, "Parallel consequences")
+        self.check_same(compile.formulas_to_string(
+            parallel.consequences(compile.is_update)),
+            'p+(1) p+(2) p-(2) s+(1, "a") s+(2, "a")',
+            "Parallel consequences with filter")
+        self.assertIsNone(runtime.TopDownTheory.forked_theory)
+
+        # projection uses the pool of the action theory
+        action_code = ('p+(x) :- q(x)  r-(x) :- q(x)  s+(x) :- q(x), t(x) '
+                       'action("q")')
+        classify_code = 'r(1) t(1) p(3)'
+        for processes in [None, 2]:
+            run = runtime.Runtime(processes=processes)
+            run.insert(action_code, target=run.ACTION_THEORY)
+            run.insert(classify_code)
+            self.check_equal(run.simulate('p(x)', 'q(1)'), 'p(1) p(3)',
+                             "Parallel simulate")
+            self.check_equal(run.simulate('s(x)', 'q(1)'), 's(1)',
+                             "Parallel simulate")
+            self.check_equal(run.simulate('r(x)', 'q(1)'), '',
+                             "Parallel simulate")
+            self.check_class(run, classify_code, "Parallel simulate rollback")
+
     def test_remediation(self):
         """Test remediation computation"""
         def check(action_code, classify_code, query, correct, msg):